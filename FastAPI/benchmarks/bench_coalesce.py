@@ -0,0 +1,82 @@
+"""
+Duplicate L2 expansions: a burst of identical concurrent `GET /l2nodes/{id}` requests
+(double clicks, frontend retries) followed by a repeat request once they are done.
+Prints the wall time, assistant runs, Exa calls and L2 nodes created per phase.
+
+    python benchmarks/bench_coalesce.py --duplicates 5 --latency 0.5 --exa-latency 1.5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+os.environ.setdefault("SEARCH_CACHE_ENABLED", "0")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_coalesce_"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+import utils  # noqa: E402
+from database import Hub, Node, create_db_and_tables, session_scope  # noqa: E402
+from fakes import FakeAsyncOpenAI, FakeExa  # noqa: E402
+
+
+def _seed() -> str:
+    with session_scope() as db:
+        hub = Hub(file_name="bench.csv", assistant_id="asst_bench")
+        db.add(hub)
+        db.flush()
+        node = Node(prompt="p", text="Rainfall is strongly correlated with humidity.", title="Rainfall",
+                    thread_id="thread_bench", hub_id=hub.id)
+        db.add(node)
+        db.flush()
+        return node.id
+
+
+def _children(node_id: str) -> int:
+    with session_scope() as db:
+        return db.query(Node).filter(Node.parent_node_id == node_id).count()
+
+
+def _runs() -> int:
+    # Assistant runs made so far (the counter hands out the next run number)
+    return next(utils.client._state.run_counter) - 1
+
+
+def _phase(name: str, client: TestClient, node_id: str, requests: int):
+    runs, exa_calls = _runs(), utils.exa.calls
+    start = time.perf_counter()
+    with ThreadPoolExecutor(requests) as pool:
+        responses = list(pool.map(lambda _: client.get(f"/l2nodes/{node_id}"), range(requests)))
+    elapsed = time.perf_counter() - start
+    for response in responses:
+        response.raise_for_status()
+    distinct = {tuple(node["id"] for node in response.json()) for response in responses}
+    print(f"{name:<22} {requests} requests in {elapsed:5.2f}s, {_runs() - runs - 1:3d} assistant runs, "
+          f"{utils.exa.calls - exa_calls:2d} Exa calls, {_children(node_id):3d} children, "
+          f"{len(distinct)} distinct responses")
+
+
+def main_(args):
+    create_db_and_tables()
+    utils.client = FakeAsyncOpenAI(latency=args.latency)
+    utils.exa = FakeExa(latency=args.exa_latency)
+    node_id = _seed()
+    with TestClient(main.app) as client:
+        _phase("concurrent duplicates", client, node_id, args.duplicates)
+        _phase("repeat", client, node_id, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duplicates", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per fake assistant run")
+    parser.add_argument("--exa-latency", type=float, default=1.5, help="seconds per fake Exa search")
+    main_(parser.parse_args())
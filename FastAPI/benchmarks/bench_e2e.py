@@ -0,0 +1,243 @@
+"""
+End-to-end benchmark: sessions driven through /session/start -> hub build ->
+/question -> /l2nodes at a set concurrency, against a real server whose OpenAI and
+Exa calls go to benchmarks/fake_server.py (started here, in its own process).
+
+Reports per-stage latency percentiles, session throughput, peak RSS of the API
+process and SQL statements per session. With --baseline, a run that is worse than
+the baseline by more than --tolerance on any of them exits with status 1; write a
+new baseline with --save-baseline after an intended change.
+
+    python benchmarks/bench_e2e.py --sessions 8 --concurrency 4 --baseline benchmarks/e2e_baseline.json
+
+Options not listed here go to the fake server, e.g. `--run-latency lognormal:2,0.3
+--error-rate 0.01 --image-every 3` (see `python benchmarks/fake_server.py --help`).
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, ".."))
+
+STAGES = ("start", "build", "question", "l2", "session")
+
+
+def _percentiles(values: list) -> dict:
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return {"p50": value, "p90": value, "p95": value, "p99": value, "max": value}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": statistics.median(values), "p90": cuts[89], "p95": cuts[94], "p99": cuts[98], "max": max(values)}
+
+
+class Driver:
+    def __init__(self, client, timings: dict, errors: list):
+        self.client = client
+        self.timings = timings
+        self.errors = errors
+
+    async def _timed(self, stage: str, request):
+        start = time.perf_counter()
+        response = await request
+        response.raise_for_status()
+        self.timings[stage].append(time.perf_counter() - start)
+        return response
+
+    async def _built(self, hub_id: str, timeout: float) -> float:
+        # Follow the hub's event stream as the frontend does, rather than polling (which would add SQL)
+        start = time.perf_counter()
+        async with asyncio.timeout(timeout):
+            async with self.client.stream("GET", f"/hubs/{hub_id}/stream") as response:
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: ") and event == "status":
+                        status = json.loads(line[len("data: "):])
+                        if status["status"] == "complete":
+                            return time.perf_counter() - start
+                        if status["status"] == "failed":
+                            raise RuntimeError(f"hub {hub_id} build failed: {status['detail']}")
+        raise RuntimeError(f"hub {hub_id} stream ended before the build finished")
+
+    async def session(self, index: int, build_timeout: float):
+        start = time.perf_counter()
+        try:
+            # Distinct bytes per session, so no session reuses another's assistant
+            data = "region,rainfall,humidity\n" + "".join(f"r{i},{i * 7 % 50},{index + i}\n" for i in range(200))
+            response = await self._timed("start", self.client.post(
+                "/session/start", files={"file": (f"bench_{index}.csv", data.encode())}))
+            hub_id = response.json()["hub"]
+            # The build is measured from the 202, through provisioning and every L1 node
+            self.timings["build"].append(await self._built(hub_id, build_timeout))
+            nodes = (await self.client.get(f"/hubs/{hub_id}/nodes")).json()
+            await self._timed("question", self.client.get(f"/question/{nodes[0]['questions'][0]['id']}"))
+            await self._timed("l2", self.client.get(f"/l2nodes/{nodes[0]['id']}"))
+            self.timings["session"].append(time.perf_counter() - start)
+        except Exception as e:
+            self.errors.append(f"session {index}: {e!r}")
+
+
+async def _drive(args, port: int, timings: dict, errors: list) -> float:
+    import httpx
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None, limits=limits) as client:
+        driver = Driver(client, timings, errors)
+
+        async def one(index: int):
+            async with semaphore:
+                await driver.session(index, args.build_timeout)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.sessions)))
+        return time.perf_counter() - start
+
+
+def _wait_for_port(port: int, timeout: float = 15):
+    import httpx
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise TimeoutError(f"fake server did not start on port {port}")
+
+
+def run(args, fake_argv: list) -> dict:
+    fake = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS, "fake_server.py"),
+                             "--port", str(args.fake_port), *fake_argv])
+    try:
+        _wait_for_port(args.fake_port)
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.fake_port}/v1"
+        os.environ["EXA_BASE_URL"] = f"http://127.0.0.1:{args.fake_port}/exa"
+        os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+        os.environ.setdefault("EXA_API_KEY", "fake")
+        os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+        # database.py creates ./test.db relative to the working directory, keep it out of the repo
+        os.chdir(tempfile.mkdtemp(prefix="bench_e2e_"))
+
+        import uvicorn
+        from sqlalchemy import event
+
+        import main
+        from database import engine
+
+        statements = [0]
+        lock = threading.Lock()
+
+        def count(*_):
+            with lock:
+                statements[0] += 1
+
+        event.listen(engine, "before_cursor_execute", count)
+
+        server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.05)
+        timings = {stage: [] for stage in STAGES}
+        errors = []
+        try:
+            before = statements[0]
+            elapsed = asyncio.run(_drive(args, args.port, timings, errors))
+            sql = statements[0] - before
+        finally:
+            server.should_exit = True
+            thread.join()
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    completed = len(timings["session"])
+    return {
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "completed": completed,
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput_per_min": completed / elapsed * 60 if elapsed else 0.0,
+        # ru_maxrss is in KiB on Linux
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "sql_per_session": sql / args.sessions,
+        "stages": {stage: _percentiles(values) for stage, values in timings.items()},
+    }
+
+
+def report(result: dict):
+    print(f"{result['completed']}/{result['sessions']} sessions at concurrency {result['concurrency']} "
+          f"in {result['elapsed']:.1f}s ({result['throughput_per_min']:.1f} sessions/min)")
+    print(f"{'stage':<10}{'p50':>10}{'p90':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage, cuts in result["stages"].items():
+        print(f"{stage:<10}" + "".join(f"{cuts[name] * 1000:8.0f}ms" for name in ("p50", "p90", "p95", "p99", "max")))
+    print(f"peak RSS {result['rss_peak_mb']:.0f} MiB, {result['sql_per_session']:.0f} SQL statements per session")
+    for error in result["errors"]:
+        print(f"error: {error}")
+
+
+def regressions(result: dict, baseline: dict, tolerance: float, tail_tolerance: float) -> list:
+    """
+    What got worse than the baseline by more than `tolerance` (a fraction), or by more
+    than `tail_tolerance` for the p95s, which a few sessions make noisy.
+    """
+    found = []
+
+    def check(name: str, value: float, base: float, higher_is_worse: bool = True, allowed: float = tolerance):
+        limit = base * (1 + allowed) if higher_is_worse else base * (1 - allowed)
+        if (value > limit) if higher_is_worse else (value < limit):
+            found.append(f"{name}: {value:.3f} vs baseline {base:.3f}")
+
+    for stage, cuts in baseline["stages"].items():
+        check(f"{stage} p50", result["stages"][stage]["p50"], cuts["p50"])
+        check(f"{stage} p95", result["stages"][stage]["p95"], cuts["p95"], allowed=tail_tolerance)
+    check("throughput_per_min", result["throughput_per_min"], baseline["throughput_per_min"], higher_is_worse=False)
+    check("rss_peak_mb", result["rss_peak_mb"], baseline["rss_peak_mb"])
+    check("sql_per_session", result["sql_per_session"], baseline["sql_per_session"])
+    if result["errors"] and not baseline["errors"]:
+        found.append(f"{len(result['errors'])} failed sessions")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--build-timeout", type=float, default=300)
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--fake-port", type=int, default=8900)
+    parser.add_argument("--baseline", help="fail when worse than this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--tail-tolerance", type=float, default=0.5, help="allowed relative regression of the p95s")
+    parser.add_argument("--save-baseline", help="write this run's results to the file")
+    args, fake_argv = parser.parse_known_args()
+    # The run changes into a temporary directory
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+
+    result = run(args, fake_argv)
+    report(result)
+    if save_path:
+        with open(save_path, "w") as f:
+            json.dump({**result, "fake_server": fake_argv}, f, indent=2)
+            f.write("\n")
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get("fake_server", []) != fake_argv:
+            print(f"warning: baseline was recorded with fake server options {baseline.get('fake_server')}")
+        found = regressions(result, baseline, args.tolerance, args.tail_tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,141 @@
+"""
+Compare hub-build wall time and memory between the asyncio pipeline in utils.py
+and the multiprocessing.Pool fan-out it replaced, using fake OpenAI/Exa clients.
+
+    python benchmarks/bench_hub_build.py --hubs 24 --latency 0.2
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_hub_build_"))
+
+import utils  # noqa: E402
+from consts import NUM_PROMPTS  # noqa: E402
+from database import Hub, Node, SessionLocal, create_db_and_tables  # noqa: E402
+from fakes import FakeAsyncOpenAI  # noqa: E402
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def _process_rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (FileNotFoundError, ProcessLookupError):
+        return 0
+
+
+def _tree_pids(pid: int) -> list:
+    pids = [pid]
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as children:
+                for child in children.read().split():
+                    pids.extend(_tree_pids(int(child)))
+    except FileNotFoundError:
+        pass
+    return pids
+
+
+class RssSampler:
+    """Samples the summed RSS of this process and all of its children."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, sum(_process_rss(pid) for pid in _tree_pids(os.getpid())))
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# Reference implementation of the previous fan-out: every hub forks a Pool and pickles the Hub into it
+def _pool_node(hub: Hub, prompt: str, latency: float):
+    for _ in range(3):  # prompt, title and suggested-question runs
+        time.sleep(latency)
+    return prompt
+
+
+def _pool_hub(hub: Hub, latency: float):
+    time.sleep(latency)  # INITIAL_PROMPT run
+    with multiprocessing.Pool() as pool:
+        pool.starmap(_pool_node, [(hub, f"prompt {i}", latency) for i in range(NUM_PROMPTS)])
+
+
+def bench_pool(hubs: int, latency: float) -> dict:
+    hub_rows = [Hub(id=f"hub-{i}", file_name="bench.csv", assistant_id="asst") for i in range(hubs)]
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        # Sync BackgroundTasks run on Starlette's threadpool, so hubs overlapped the same way
+        with ThreadPoolExecutor(max_workers=hubs) as executor:
+            list(executor.map(lambda hub: _pool_hub(hub, latency), hub_rows))
+        elapsed = time.perf_counter() - start
+    return {"wall_s": elapsed, "peak_rss_mb": sampler.peak / 2 ** 20}
+
+
+def bench_async(hubs: int, latency: float) -> dict:
+    utils.client = FakeAsyncOpenAI(latency=latency)
+
+    db = SessionLocal()
+    hub_rows = [Hub(file_name="bench.csv", assistant_id="asst") for _ in range(hubs)]
+    db.add_all(hub_rows)
+    db.commit()
+    for hub in hub_rows:
+        db.refresh(hub)
+    db.close()
+
+    async def run():
+        threads = [await utils.client.beta.threads.create() for _ in hub_rows]
+        await asyncio.gather(*(utils.l1_init(hub, thread.id) for hub, thread in zip(hub_rows, threads)))
+
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - start
+
+    db = SessionLocal()
+    created = db.query(Node).count()
+    db.close()
+    return {"wall_s": elapsed, "peak_rss_mb": sampler.peak / 2 ** 20, "nodes": created}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hubs", type=int, default=8, help="number of hubs built at once")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds per fake assistant run")
+    parser.add_argument("--skip-pool", action="store_true", help="only run the asyncio pipeline")
+    args = parser.parse_args()
+
+    create_db_and_tables()
+    print(f"{args.hubs} hubs x {NUM_PROMPTS} nodes, {args.latency}s per run, {os.cpu_count()} cores")
+    if not args.skip_pool:
+        pool = bench_pool(args.hubs, args.latency)
+        print(f"pool : {pool['wall_s']:7.2f}s  peak rss {pool['peak_rss_mb']:8.1f} MB")
+    result = bench_async(args.hubs, args.latency)
+    print(f"async: {result['wall_s']:7.2f}s  peak rss {result['peak_rss_mb']:8.1f} MB  ({result['nodes']} nodes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Canvas load transfer: bytes sent for a canvas of chart previews when each node shows
+its original PNG (`url`) versus its `thumbnail_url` fetched with a browser's Accept
+header, and the time node saving spends making the variants of each chart.
+
+    python benchmarks/bench_images.py --charts 24 --dpi 150
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+os.environ.setdefault("THREAD_POOL_SIZE", "0")  # no assistant threads are needed here
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_images_"))
+
+import matplotlib  # noqa: E402
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+import utils  # noqa: E402
+from database import Hub, Node, create_db_and_tables, session_scope  # noqa: E402
+
+# What Chrome sends for <img> requests
+BROWSER_ACCEPT = "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8"
+
+
+def _chart(index: int, dpi: int) -> bytes:
+    # The kinds of charts Code Interpreter draws: lines, bars and scatters with titles and legends
+    rng = np.random.default_rng(index)
+    fig, ax = plt.subplots(figsize=(10, 6), dpi=dpi)
+    kind = index % 3
+    if kind == 0:
+        for series in range(3):
+            ax.plot(np.cumsum(rng.normal(size=120)), label=f"series {series}")
+        ax.legend()
+    elif kind == 1:
+        ax.bar([f"r{i}" for i in range(12)], rng.uniform(10, 50, 12))
+    else:
+        ax.scatter(rng.normal(size=400), rng.normal(size=400), s=8, alpha=0.6)
+    ax.set_title(f"Chart {index}")
+    ax.grid(True, alpha=0.3)
+    out = BytesIO()
+    fig.savefig(out, format="png")
+    plt.close(fig)
+    return out.getvalue()
+
+
+def main_(args):
+    create_db_and_tables()
+    with session_scope() as db:
+        hub = Hub(file_name="bench.csv", assistant_id="asst_bench")
+        db.add(hub)
+        db.flush()
+        hub_id = hub.id
+
+    charts = [_chart(i, args.dpi) for i in range(args.charts)]
+    saves, images = [], []
+    for index, chart in enumerate(charts):
+        node = Node(prompt="p", text="t", title=f"Chart {index}", thread_id="", hub_id=hub_id)
+        start = time.perf_counter()
+        images.extend(asyncio.run(utils._save_node_with_images(node, [chart]))["images"])
+        saves.append(time.perf_counter() - start)
+
+    with TestClient(main.app) as client:
+        def transfer(url_key: str, accept: str) -> int:
+            total = 0
+            for image in images:
+                response = client.get(image[url_key].replace("http://localhost:8001", ""), headers={"accept": accept})
+                response.raise_for_status()
+                total += len(response.content)
+            return total
+
+        original = transfer("url", "image/png")
+        png_thumbnails = transfer("thumbnail_url", "image/png")
+        thumbnails = transfer("thumbnail_url", BROWSER_ACCEPT)
+
+    print(f"{args.charts} charts at {images[0]['width']}x{images[0]['height']}")
+    print(f"{'original PNGs':<28}{original / 1024:10.1f} KiB")
+    print(f"{'PNG thumbnails':<28}{png_thumbnails / 1024:10.1f} KiB  ({original / png_thumbnails:.1f}x smaller)")
+    print(f"{'thumbnails, browser Accept':<28}{thumbnails / 1024:10.1f} KiB  ({original / thumbnails:.1f}x smaller)")
+    print(f"node save with variants: median {statistics.median(saves) * 1000:.0f}ms per chart, "
+          f"max {max(saves) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--charts", type=int, default=24)
+    parser.add_argument("--dpi", type=int, default=150, help="chart resolution; 10x6 inch figures")
+    main_(parser.parse_args())
@@ -0,0 +1,75 @@
+"""
+Exa calls, time and sources used by L2 expansions of one hub whose L1 findings
+produce near-identical queries, with the search cache on and off. Every node is
+expanded twice, as users do when they come back to a finding.
+
+    python benchmarks/bench_l2_search.py --nodes 8 --exa-latency 1.5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_l2_search_"))
+
+import metrics  # noqa: E402
+import utils  # noqa: E402
+from database import Hub, Node, create_db_and_tables, session_scope  # noqa: E402
+from fakes import FakeAsyncOpenAI, FakeExa  # noqa: E402
+from search_cache import search_cache  # noqa: E402
+
+# Sibling findings that differ only in case, punctuation and word order
+TITLES = ["Rainfall peaks in spring", "rainfall peaks in Spring!", "In spring, rainfall peaks", "Humidity tracks rainfall"]
+
+
+def _seed(nodes: int):
+    with session_scope() as db:
+        hub = Hub(file_name="bench.csv", assistant_id="asst_bench")
+        db.add(hub)
+        db.flush()
+        rows = [Node(prompt="p", text="Rainfall is strongly correlated with humidity.", title=TITLES[i % len(TITLES)],
+                     thread_id=f"thread_{i}", hub_id=hub.id) for i in range(nodes)]
+        db.add_all(rows)
+    return hub, rows
+
+
+async def _run(args, cached: bool):
+    search_cache.enabled = cached
+    utils.exa = FakeExa(latency=args.exa_latency, pool=args.pool)
+    hub, nodes = _seed(args.nodes)
+    created = 0
+    start = time.perf_counter()
+    for _ in range(2):
+        for node in nodes:
+            created += len(await utils.l2_init(hub, node))
+    elapsed = time.perf_counter() - start
+    duplicates = sum(counter["value"] for counter in metrics.counters() if counter["name"] == "l2_duplicate_sources_total")
+    return elapsed, utils.exa.calls, created, duplicates
+
+
+async def main(args):
+    create_db_and_tables()
+    utils.client = FakeAsyncOpenAI(latency=args.latency)
+    previous = 0
+    for name, cached in (("no cache", False), ("cache", True)):
+        elapsed, calls, created, duplicates = await _run(args, cached)
+        print(f"{name:>8}: {2 * args.nodes} expansions in {elapsed:5.1f}s, {calls:3d} Exa calls, "
+              f"{created} L2 nodes, {duplicates - previous} duplicate sources skipped")
+        previous = duplicates
+    print(f"search cache: {search_cache.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake assistant run")
+    parser.add_argument("--exa-latency", type=float, default=1.5, help="seconds per fake Exa search")
+    parser.add_argument("--pool", type=int, default=60, help="distinct articles the fake search draws from")
+    asyncio.run(main(parser.parse_args()))
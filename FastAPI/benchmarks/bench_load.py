@@ -0,0 +1,126 @@
+"""
+Latency of quick requests (node listings, images, hub status) while slow follow-up
+questions and L2 expansions are in flight, against a real server and the fake OpenAI
+client. With handlers that block the event loop, the quick requests queue behind the
+slow ones; with the DB work offloaded they stay close to their idle latency.
+
+    python benchmarks/bench_load.py --latency 3 --slow 32 --fast 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_load_"))
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+
+import main  # noqa: E402
+import utils  # noqa: E402
+from database import Hub, Image, Node, SessionLocal, create_db_and_tables  # noqa: E402
+from fakes import FakeAsyncOpenAI, FakeExa  # noqa: E402
+from image_store import store_image  # noqa: E402
+
+PNG = bytes.fromhex("89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+                    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082")
+
+
+def _make_hub(nodes: int):
+    db = SessionLocal()
+    try:
+        hub = Hub(assistant_id="asst_bench")
+        db.add(hub)
+        db.commit()
+        image = Image(sha256=store_image(PNG), size=len(PNG))
+        db.add(image)
+        db.commit()
+        image.generate_url()
+        node_ids = []
+        for i in range(nodes):
+            node = Node(prompt="p", text="t" * 500, title=f"node {i}", thread_id=f"thread_bench_{i}", hub_id=hub.id)
+            if i == 0:
+                node.images.append(image)
+            db.add(node)
+            db.commit()
+            node_ids.append(node.id)
+        return hub.id, node_ids, image.id
+    finally:
+        db.close()
+
+
+async def _fast(client: httpx.AsyncClient, paths: list, count: int) -> list:
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        response = await client.get(paths[i % len(paths)])
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def _slow(client: httpx.AsyncClient, node_ids: list, count: int):
+    async def one(i):
+        node_id = node_ids[i % len(node_ids)]
+        if i % 4 == 3:
+            response = await client.get(f"/l2nodes/{node_id}")
+        else:
+            response = await client.post(f"/question/from/{node_id}", json={"prompt": f"Why {i}?"})
+        response.raise_for_status()
+
+    await asyncio.gather(*(one(i) for i in range(count)))
+
+
+def _summary(latencies: list) -> str:
+    p95 = statistics.quantiles(latencies, n=20)[-1]
+    return f"p50 {statistics.median(latencies) * 1000:7.1f}ms  p95 {p95 * 1000:7.1f}ms  max {max(latencies) * 1000:7.1f}ms"
+
+
+async def _bench(args, hub_id: str, node_ids: list, image_id: str):
+    paths = [f"/hubs/{hub_id}/nodes", f"/images/{image_id}", f"/hubs/{hub_id}/status", "/cache/stats"]
+    limits = httpx.Limits(max_connections=args.slow + 8)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=None, limits=limits) as client:
+        idle = await _fast(client, paths, args.fast)
+        print(f"  idle: {_summary(idle)}")
+        start = time.perf_counter()
+        slow = asyncio.create_task(_slow(client, node_ids, args.slow))
+        await asyncio.sleep(0.2)  # let the slow requests reach their handlers
+        loaded = await _fast(client, paths, args.fast)
+        await slow
+        print(f"loaded: {_summary(loaded)}  ({args.slow} slow requests done in {time.perf_counter() - start:.1f}s)")
+
+
+def main_(args):
+    utils.client = FakeAsyncOpenAI(latency=args.latency)
+    utils.exa = FakeExa(latency=args.latency / 4)
+    create_db_and_tables()
+    hub_id, node_ids, image_id = _make_hub(args.nodes)
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        asyncio.run(_bench(args, hub_id, node_ids, image_id))
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=3.0, help="seconds per fake assistant run")
+    parser.add_argument("--slow", type=int, default=32, help="concurrent questions and L2 expansions")
+    parser.add_argument("--fast", type=int, default=200, help="quick requests measured, one after another")
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8766)
+    main_(parser.parse_args())
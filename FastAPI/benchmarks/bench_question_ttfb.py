@@ -0,0 +1,92 @@
+"""
+Time-to-first-byte and total time of follow-up questions, polling versus
+`?stream=true`, against the fake OpenAI client with a realistic run latency.
+
+    python benchmarks/bench_question_ttfb.py --latency 8 --questions 3
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_question_ttfb_"))
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+
+import main  # noqa: E402
+import utils  # noqa: E402
+from database import Hub, Node, SessionLocal, create_db_and_tables  # noqa: E402
+from fakes import FakeAsyncOpenAI  # noqa: E402
+
+
+def _make_node() -> str:
+    db = SessionLocal()
+    try:
+        hub = Hub(assistant_id="asst_bench")
+        db.add(hub)
+        db.commit()
+        node = Node(prompt="p", text="t", title="t", thread_id="thread_bench", hub_id=hub.id)
+        db.add(node)
+        db.commit()
+        return node.id
+    finally:
+        db.close()
+
+
+def _polling(client: httpx.Client, node_id: str):
+    start = time.perf_counter()
+    response = client.post(f"/question/from/{node_id}", json={"prompt": "Why does rainfall peak?"})
+    response.raise_for_status()
+    elapsed = time.perf_counter() - start
+    # Nothing is sent until the node is complete
+    return elapsed, elapsed
+
+
+def _streaming(client: httpx.Client, node_id: str):
+    start = time.perf_counter()
+    first = None
+    with client.stream("POST", f"/question/from/{node_id}?stream=true",
+                       json={"prompt": "Why does rainfall peak?"}) as response:
+        for line in response.iter_lines():
+            if first is None and line.startswith("data:"):
+                first = time.perf_counter() - start
+            if line.startswith("event: error"):
+                raise RuntimeError("stream failed")
+    return first, time.perf_counter() - start
+
+
+def main_(args):
+    utils.client = FakeAsyncOpenAI(latency=args.latency)
+    create_db_and_tables()
+    node_id = _make_node()
+    # A real server, the test client buffers the whole response before returning it
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    with httpx.Client(base_url=f"http://127.0.0.1:{args.port}", timeout=None) as client:
+        for name, ask in (("polling", _polling), ("streaming", _streaming)):
+            results = [ask(client, node_id) for _ in range(args.questions)]
+            ttfb = statistics.median(result[0] for result in results)
+            total = statistics.median(result[1] for result in results)
+            print(f"{name:>9}: ttfb {ttfb:6.2f}s  total {total:6.2f}s")
+    server.should_exit = True
+    thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=8.0, help="seconds per fake assistant run")
+    parser.add_argument("--questions", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8765)
+    main_(parser.parse_args())
@@ -0,0 +1,67 @@
+"""
+Dataset reduction: size of the upload and the time to load it (what Code Interpreter
+does again in every run) for the raw CSV versus its reduced copy, per sampling, on a
+synthetic table with an ID, a constant, a date, a skewed category and numeric columns.
+
+    python benchmarks/bench_reduction.py --rows 2000000 --budget 200000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import reduction  # noqa: E402
+from profiling import profile_csv  # noqa: E402
+
+
+def _table(rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "id": np.arange(rows),
+        "source": "sensor-feed",
+        "timestamp": pd.date_range("2019-01-01", periods=rows, freq="1min").astype(str),
+        "region": rng.choice(["north", "south", "east", "west", "island"], rows, p=[.4, .3, .2, .099, .001]),
+        "temperature": rng.normal(15, 8, rows).round(2),
+        "humidity": rng.uniform(0, 100, rows).round(1),
+        "rain": rng.integers(0, 2, rows),
+    })
+
+
+def _load_seconds(path: str) -> float:
+    start = time.perf_counter()
+    pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path)
+    return time.perf_counter() - start
+
+
+def main_(args):
+    directory = tempfile.mkdtemp(prefix="bench_reduction_")
+    source = os.path.join(directory, "data.csv")
+    _table(args.rows).to_csv(source, index=False)
+    with open(source, "rb") as file:
+        start = time.perf_counter()
+        profile = profile_csv(file)
+        print(f"{args.rows} rows, {os.path.getsize(source) / 1024 ** 2:.1f} MiB CSV, "
+              f"profiled in {time.perf_counter() - start:.1f}s")
+    print(f"{'upload':<12}{'rows':>10}{'MiB':>9}{'reduce s':>10}{'load s':>8}")
+    print(f"{'raw CSV':<12}{args.rows:>10}{os.path.getsize(source) / 1024 ** 2:>9.1f}{'':>10}"
+          f"{_load_seconds(source):>8.2f}")
+    for sampling in ("time", "stratified", "random"):
+        params = reduction.plan(profile, args.budget, sampling)
+        target = os.path.join(directory, reduction.reduced_name(f"{sampling}.csv", params))
+        with open(source, "rb") as file:
+            result = reduction.reduce_file(file, target, params)
+        print(f"{sampling:<12}{result['rows_out']:>10}{result['bytes_out'] / 1024 ** 2:>9.1f}"
+              f"{result['seconds']:>10.1f}{_load_seconds(target):>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--budget", type=int, default=reduction.REDUCTION_ROW_BUDGET)
+    main_(parser.parse_args())
@@ -0,0 +1,70 @@
+"""
+Per-call latency of _message_and_wait_for_reply as threads grow, against the fake
+OpenAI client with a per-page listing latency. The previous implementation listed the
+whole thread oldest-first to take the last message, so its cost grew with the thread;
+fetching the run's newest message should stay flat.
+
+    python benchmarks/bench_reply_fetch.py --lengths 10 100 1000 --page-latency 0.02
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_reply_fetch_"))
+
+import utils  # noqa: E402
+from fakes import FakeAsyncOpenAI  # noqa: E402
+
+
+# Reference implementation of the previous retrieval: list the whole thread to take the last message
+async def _full_listing_reply(client, thread_id: str):
+    await client.beta.threads.runs.create_and_poll(thread_id=thread_id, assistant_id="asst_bench")
+    messages = [message async for message in client.beta.threads.messages.list(thread_id=thread_id, order="asc")]
+    return messages[-1]
+
+
+async def _measure(call, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await call()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+async def main(args):
+    print(f"{'messages':>9} {'full listing':>13} {'by run id':>10}")
+    for length in args.lengths:
+        client = FakeAsyncOpenAI(latency=args.latency, page_latency=args.page_latency)
+        utils.client = client
+        client.seed_thread("thread_old", length)
+        client.seed_thread("thread_new", length)
+
+        async def old():
+            await client.beta.threads.messages.create(thread_id="thread_old", role="user", content="q")
+            await _full_listing_reply(client, "thread_old")
+
+        async def new():
+            await utils._message_and_wait_for_reply("asst_bench", "thread_new", "q", use_cache=False)
+
+        old_time = await _measure(old, args.repeat)
+        new_time = await _measure(new, args.repeat)
+        print(f"{length:>9} {old_time * 1000:>11.1f}ms {new_time * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake assistant run")
+    parser.add_argument("--page-latency", type=float, default=0.02, help="seconds per listed page")
+    parser.add_argument("--repeat", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
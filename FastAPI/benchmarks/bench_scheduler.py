@@ -0,0 +1,78 @@
+"""
+Interactive-question latency while background hub builds saturate the run slots,
+with the scheduler's priority classes versus every call queued as one class (which
+is how the old per-process semaphore behaved).
+
+    python benchmarks/bench_scheduler.py --hubs 6 --runs-per-hub 30 --concurrency 4
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_scheduler_"))
+
+import utils  # noqa: E402
+from fakes import FakeAsyncOpenAI  # noqa: E402
+from scheduler import BACKGROUND, INTERACTIVE, OPENAI, priority_context, scheduler  # noqa: E402
+
+
+async def _background_hub(hub: int, runs: int):
+    with priority_context(BACKGROUND, f"session-{hub}"):
+        await asyncio.gather(*(
+            utils._message_and_wait_for_reply("asst_bench", f"thread-{hub}-{i}", "Analyse column group", use_cache=False)
+            for i in range(runs)
+        ))
+
+
+async def _questions(count: int, interval: float, priority: int) -> list:
+    latencies = []
+
+    async def ask(i):
+        await asyncio.sleep(i * interval)
+        start = time.perf_counter()
+        with priority_context(priority, "session-interactive"):
+            await utils._message_and_wait_for_reply("asst_bench", f"thread-q-{i}", "Why?", use_cache=False)
+        latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(ask(i) for i in range(count)))
+    return latencies
+
+
+async def _run(args, priority: int) -> list:
+    utils.client = FakeAsyncOpenAI(latency=args.latency, jitter=args.latency / 5)
+    background = asyncio.gather(*(_background_hub(hub, args.runs_per_hub) for hub in range(args.hubs)))
+    await asyncio.sleep(args.latency)  # let the builds fill the queue first
+    latencies = await _questions(args.questions, args.interval, priority)
+    await background
+    return latencies
+
+
+def _p95(values: list) -> float:
+    return statistics.quantiles(values, n=20)[-1]
+
+
+async def main(args):
+    scheduler._apis[OPENAI].concurrency = args.concurrency
+    for name, priority in (("one class", BACKGROUND), ("priorities", INTERACTIVE)):
+        latencies = await _run(args, priority)
+        print(f"{name:>10}: interactive p50 {statistics.median(latencies):6.2f}s  p95 {_p95(latencies):6.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hubs", type=int, default=6)
+    parser.add_argument("--runs-per-hub", type=int, default=30)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between interactive questions")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds per fake assistant run")
+    parser.add_argument("--concurrency", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,79 @@
+"""
+Latency of session start (time to the HTTP response and to a fully built hub) and of
+follow-up questions, against the fake OpenAI client with a round trip on every thread
+and assistant creation. Run it with THREAD_POOL_SIZE=0 to see the cost without the
+pool of ready threads.
+
+    python benchmarks/bench_session_start.py --sessions 5 --call-latency 0.3 --latency 1
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_session_start_"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+import utils  # noqa: E402
+from consts import NUM_PROMPTS  # noqa: E402
+from fakes import FakeAsyncOpenAI  # noqa: E402
+
+
+def _built(client: TestClient, hub_id: str, timeout: float = 120) -> list:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        nodes = client.get(f"/hubs/{hub_id}/nodes").json()
+        if len(nodes) >= NUM_PROMPTS:
+            return nodes
+        time.sleep(0.02)
+    raise TimeoutError(f"hub {hub_id} was not built in {timeout}s")
+
+
+def _summary(name: str, times: list):
+    print(f"{name:<24} median {statistics.median(times) * 1000:8.1f}ms  max {max(times) * 1000:8.1f}ms")
+
+
+def main_(args):
+    utils.client = FakeAsyncOpenAI(latency=args.latency, call_latency=args.call_latency)
+    responses, builds, questions = [], [], []
+    with TestClient(main.app) as client:
+        # Let the pool fill the way it does between requests of a running server
+        time.sleep(args.warmup)
+        for i in range(args.sessions):
+            # Distinct bytes per session, so no session reuses an earlier assistant
+            data = f"a,b\n{i},2\n3,4\n".encode()
+            start = time.perf_counter()
+            response = client.post("/session/start", files={"file": (f"bench_{i}.csv", data)})
+            response.raise_for_status()
+            responses.append(time.perf_counter() - start)
+            nodes = _built(client, response.json()["hub"])
+            builds.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            client.get(f"/question/{nodes[0]['questions'][0]['id']}").raise_for_status()
+            questions.append(time.perf_counter() - start)
+        pool = client.get("/cache/stats").json().get("threads", {"size": 0})
+
+    print(f"{args.sessions} sessions, {args.call_latency}s per API call, {args.latency}s per run, pool size {pool['size']}")
+    _summary("session/start response", responses)
+    _summary("hub built", builds)
+    _summary("follow-up question", questions)
+    print(f"thread pool: {pool}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds per fake assistant run and upload")
+    parser.add_argument("--call-latency", type=float, default=0.3, help="seconds per thread or assistant creation")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds the server idles before the first session")
+    main_(parser.parse_args())
@@ -0,0 +1,122 @@
+"""
+Subtree and ancestry of a synthetic 10k-node hub: the recursive-CTE endpoints against
+fetching the whole hub and rebuilding the tree client-side, and against walking the
+`children` relationship level by level. Also shows the CTE with and without the
+parent index. Prints latency and SQL statements per request.
+
+    python benchmarks/bench_tree.py --nodes 10000 --fanout 3
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="bench_tree_"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import event, text  # noqa: E402
+
+import main  # noqa: E402
+from database import Hub, Image, Node, Question, create_db_and_tables, engine, session_scope  # noqa: E402
+
+statements = []
+event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+
+def seed(count: int, fanout: int) -> tuple:
+    # A single tree: node i hangs under node (i - 1) // fanout, the way L2 expansions nest
+    with session_scope() as db:
+        hub = Hub(file_name="tree.csv", assistant_id="asst")
+        db.add(hub)
+        db.flush()
+        ids = []
+        for i in range(count):
+            node = Node(prompt="p", text="t" * 300, title=f"node {i}", thread_id="thread", hub_id=hub.id,
+                        parent_node_id=ids[(i - 1) // fanout] if i else None)
+            node.images = [Image(sha256=f"{i:064x}", size=1, url=f"http://localhost:8001/images/{i}")]
+            node.questions = [Question(content=f"question {j}") for j in range(2)]
+            db.add(node)
+            db.flush()
+            ids.append(node.id)
+        return hub.id, ids[0], ids[-1]
+
+
+def _rebuild(nodes: list) -> dict:
+    # What the frontend does with the flat listing
+    by_id = {node["id"]: dict(node, children=[]) for node in nodes}
+    root = None
+    for node in by_id.values():
+        if node["parent_node_id"]:
+            by_id[node["parent_node_id"]]["children"].append(node)
+        else:
+            root = node
+    return root
+
+
+def _walk_children(root_id: str) -> int:
+    # Naive ORM traversal: one query per node for its children
+    seen = 0
+    with session_scope() as db:
+        level = [db.get(Node, root_id)]
+        while level:
+            seen += len(level)
+            level = [child for node in level for child in node.children]
+            for node in level:
+                node.images, node.questions
+    return seen
+
+
+def _measure(name: str, run, repeat: int):
+    times, counts = [], []
+    for _ in range(repeat):
+        statements.clear()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+        counts.append(len(statements))
+    print(f"{name:<38} {statistics.median(times) * 1000:9.1f}ms  {max(counts):6d} statements")
+
+
+def main_(args):
+    create_db_and_tables()
+    hub_id, root_id, leaf_id = seed(args.nodes, args.fanout)
+    client = TestClient(main.app)
+
+    def listing():
+        response = client.get(f"/hubs/{hub_id}/nodes")
+        response.raise_for_status()
+        _rebuild(response.json())
+
+    def subtree(depth=None):
+        def run():
+            response = client.get(f"/nodes/{root_id}/subtree", params={"depth": depth} if depth is not None else {})
+            response.raise_for_status()
+        return run
+
+    def ancestors():
+        client.get(f"/nodes/{leaf_id}/ancestors").raise_for_status()
+
+    print(f"{args.nodes} nodes, fanout {args.fanout}")
+    _measure("whole hub + client-side rebuild", listing, args.repeat)
+    _measure("ORM walk of `children`", lambda: _walk_children(root_id), args.repeat)
+    _measure("CTE subtree, whole tree", subtree(), args.repeat)
+    _measure("CTE subtree, depth=2", subtree(2), args.repeat)
+    _measure("CTE ancestors of a leaf", ancestors, args.repeat)
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_nodes_parent_created"))
+    _measure("CTE subtree, depth=2, no parent index", subtree(2), args.repeat)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=10000)
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    main_(parser.parse_args())
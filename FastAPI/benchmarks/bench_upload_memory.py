@@ -0,0 +1,105 @@
+"""
+Upload increasingly large CSVs to /session/start on a local server backed by the fake
+OpenAI client, and report the server's peak RSS per upload. With the streaming upload
+path the peak should stay flat as the file grows.
+
+    python benchmarks/bench_upload_memory.py --sizes 16 64 256
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def serve(port: int):
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    sys.path.insert(0, HERE)
+    os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+    os.environ.setdefault("EXA_API_KEY", "fake")
+    os.chdir(tempfile.mkdtemp(prefix="bench_upload_memory_"))
+
+    import uvicorn
+
+    import main
+    import utils
+    from fakes import FakeAsyncOpenAI
+
+    utils.client = FakeAsyncOpenAI(latency=0.01)
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def _rss(pid: int) -> int:
+    with open(f"/proc/{pid}/statm") as statm:
+        return int(statm.read().split()[1]) * PAGE_SIZE
+
+
+def _write_csv(path: str, size_mb: int):
+    row = b"2024-01-01,Boston,12.5,0.81,1013.2,rain\n"
+    block = row * (1024 * 1024 // len(row))
+    with open(path, "wb") as f:
+        f.write(b"date,city,temp,humidity,pressure,weather\n")
+        for _ in range(size_mb):
+            f.write(block)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[8, 32, 128], help="file sizes in MB")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port)
+        return
+
+    server = subprocess.Popen([sys.executable, __file__, "--serve", "--port", str(args.port)])
+    base = f"http://127.0.0.1:{args.port}"
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"{base}/cache/stats")
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        idle = _rss(server.pid)
+        print(f"server idle rss {idle / 2 ** 20:.1f} MB")
+
+        for size_mb in args.sizes:
+            peak = 0
+            done = threading.Event()
+
+            def sample():
+                nonlocal peak
+                while not done.is_set():
+                    peak = max(peak, _rss(server.pid))
+                    time.sleep(0.005)
+
+            with tempfile.NamedTemporaryFile(suffix=".csv") as tmp:
+                _write_csv(tmp.name, size_mb)
+                sampler = threading.Thread(target=sample)
+                sampler.start()
+                start = time.perf_counter()
+                with open(tmp.name, "rb") as f:
+                    response = httpx.post(f"{base}/session/start", files={"file": ("data.csv", f)}, timeout=600)
+                elapsed = time.perf_counter() - start
+                done.set()
+                sampler.join()
+            response.raise_for_status()
+            print(f"{size_mb:6d} MB upload: {elapsed:6.2f}s, peak server rss {peak / 2 ** 20:8.1f} MB "
+                  f"(+{(peak - idle) / 2 ** 20:.1f} MB over idle)")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Save nodes with images from many threads at once, as concurrent hub builds and the
+API do, and check that every commit lands without "database is locked". Exits
+non-zero on a failure.
+
+    python benchmarks/check_concurrent_writes.py --threads 16 --nodes 50
+    DATABASE_URL=postgresql+psycopg://... python benchmarks/check_concurrent_writes.py
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="check_concurrent_writes_"))
+
+from sqlalchemy import event, text  # noqa: E402
+
+import utils  # noqa: E402
+from database import DATABASE_URL, Hub, Node, create_db_and_tables, engine, session_scope  # noqa: E402
+
+
+def _save_nodes(hub_id: str, worker: int, count: int, images: int) -> int:
+    failures = 0
+    for i in range(count):
+        node = Node(prompt="p", text="t" * 200, title=f"node {worker}-{i}", thread_id=f"thread_{worker}", hub_id=hub_id)
+        try:
+            columns = {"sha256": f"{worker:032x}{i:032x}", "size": 100, "width": 100, "height": 100,
+                       "derivatives": "[]"}
+            utils._store_node(node, [columns] * images)
+        except Exception as e:
+            print(f"worker {worker} node {i}: {e}")
+            failures += 1
+    return failures
+
+
+def main_(args) -> int:
+    create_db_and_tables()
+    if DATABASE_URL.startswith("sqlite"):
+        with engine.connect() as connection:
+            print(f"journal_mode={connection.execute(text('PRAGMA journal_mode')).scalar()}  "
+                  f"busy_timeout={connection.execute(text('PRAGMA busy_timeout')).scalar()}ms")
+    with session_scope() as db:
+        hub = Hub(file_name="writes.csv", assistant_id="asst")
+        db.add(hub)
+    statements = []
+    listener = lambda *a: statements.append(a[2])  # noqa: E731
+    event.listen(engine, "before_cursor_execute", listener)
+    _save_nodes(hub.id, -1, 1, args.images)
+    event.remove(engine, "before_cursor_execute", listener)
+    print(f"{len(statements)} statements in one transaction to save a node with {args.images} images")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        failures = sum(pool.map(lambda w: _save_nodes(hub.id, w, args.nodes, args.images), range(args.threads)))
+    elapsed = time.perf_counter() - start
+    with session_scope() as db:
+        saved = db.query(Node).filter(Node.hub_id == hub.id).count() - 1
+    expected = args.threads * args.nodes
+    print(f"{saved}/{expected} nodes saved by {args.threads} threads in {elapsed:.2f}s, {failures} failures")
+    return 0 if saved == expected and not failures else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--nodes", type=int, default=50, help="nodes saved per thread")
+    parser.add_argument("--images", type=int, default=2, help="images per node")
+    sys.exit(main_(parser.parse_args()))
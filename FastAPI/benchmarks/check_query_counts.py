@@ -0,0 +1,92 @@
+"""
+Pin the number of SQL statements issued per node-listing request, so N+1 lazy loads
+cannot creep back into NodeResponse serialization. Exits non-zero on a mismatch.
+
+    python benchmarks/check_query_counts.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+os.environ.setdefault("EXA_API_KEY", "fake")
+# The embedded worker polls the job table, which would be counted against the requests
+os.environ.setdefault("EMBEDDED_WORKER", "0")
+# database.py creates ./test.db relative to the working directory, keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="check_query_counts_"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import main  # noqa: E402
+from database import Hub, Image, Node, Question, SessionLocal, create_db_and_tables, engine  # noqa: E402
+
+NODES = 60
+
+# (description, path, params, expected statements)
+EXPECTED = [
+    ("full listing", "/hubs/{hub}/nodes", {}, 4),
+    ("since cursor", "/hubs/{hub}/nodes", {"since": "{cursor}"}, 5),
+    ("keyset page", "/hubs/{hub}/nodes", {"since": "{cursor}", "limit": 10}, 5),
+    ("sparse, no relationships", "/hubs/{hub}/nodes", {"fields": "id,title,parent_node_id"}, 2),
+    ("sparse, images only", "/hubs/{hub}/nodes", {"fields": "id,images"}, 3),
+    ("subtree", "/nodes/{root}/subtree", {}, 1),
+    ("subtree, depth 1", "/nodes/{root}/subtree", {"depth": 1}, 1),
+    ("ancestors", "/nodes/{cursor}/ancestors", {}, 1),
+]
+
+
+def seed() -> tuple:
+    db = SessionLocal()
+    hub = Hub(file_name="seed.csv", assistant_id="asst")
+    db.add(hub)
+    db.flush()
+    nodes = []
+    for i in range(NODES):
+        node = Node(prompt="p", text="t", title=f"node {i}", thread_id="thread", hub_id=hub.id,
+                    parent_node_id=nodes[i // 3].id if i >= 5 else None)
+        node.images = [Image(sha256=f"{i:064x}", size=1, url=f"http://localhost:8001/images/{i}-{j}") for j in range(2)]
+        node.questions = [Question(content=f"question {j}") for j in range(3)]
+        db.add(node)
+        db.flush()
+        nodes.append(node)
+    db.commit()
+    ids = hub.id, nodes[1].id, nodes[NODES // 2].id
+    db.close()
+    return ids
+
+
+def _count(body) -> int:
+    # Node listings are flat, subtrees nest through `children`
+    if isinstance(body, list):
+        return sum(_count(node) for node in body)
+    return 1 + sum(_count(child) for child in body.get("children", []))
+
+
+def main_():
+    create_db_and_tables()
+    hub_id, root, cursor = seed()
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    failures = 0
+    with TestClient(main.app) as client:
+        for description, path, params, expected in EXPECTED:
+            params = {key: str(value).format(cursor=cursor) for key, value in params.items()}
+            statements.clear()
+            response = client.get(path.format(hub=hub_id, root=root, cursor=cursor), params=params)
+            response.raise_for_status()
+            status = "ok" if len(statements) == expected else "FAIL"
+            failures += status == "FAIL"
+            print(f"{status:4} {description:26} {len(statements):3} statements (expected {expected}), "
+                  f"{_count(response.json())} nodes")
+            if status == "FAIL":
+                for statement in statements:
+                    print("      ", " ".join(statement.split())[:140])
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main_()
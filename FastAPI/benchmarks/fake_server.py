@@ -0,0 +1,398 @@
+"""
+Local stand-in for the OpenAI and Exa HTTP APIs, covering the subset utils.py uses:
+Files, Assistants, Threads, Messages, Runs (polled and streamed) and Exa search.
+Point the app at it with
+
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 EXA_BASE_URL=http://127.0.0.1:8900/exa
+
+and start it with, for example,
+
+    python benchmarks/fake_server.py --run-latency lognormal:2,0.4 --error-rate 0.01 --image-every 3
+
+Latencies are distributions: `const:S`, `uniform:A,B`, `normal:MEAN,SD` or
+`lognormal:MEDIAN,SIGMA`, in seconds. Replies are shaped like the real model output
+for the stage that asked (see fakes.py), so the whole pipeline runs against it.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+import uuid
+import zlib
+from io import BytesIO
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import uvicorn  # noqa: E402
+from fastapi import FastAPI, File, Form, Request, UploadFile  # noqa: E402
+from fastapi.responses import JSONResponse, Response, StreamingResponse  # noqa: E402
+
+from fakes import PNG_PIXEL, _reply_for, _structured_reply, run_format_error  # noqa: E402
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """A sampler for a latency distribution spec such as `lognormal:2,0.4`."""
+    kind, _, params = spec.partition(":")
+    if not params:
+        kind, params = "const", kind
+    values = [float(value) for value in params.split(",")]
+    if kind == "const":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution {spec!r}")
+
+
+def _png(width: int, height: int) -> bytes:
+    # Noise compresses about as badly as a real chart with many colors, a fair upper bound
+    if width <= 1 and height <= 1:
+        return PNG_PIXEL
+    from PIL import Image
+    image = Image.frombytes("RGB", (width, height), random.randbytes(width * height * 3))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeAPI:
+    def __init__(self, args):
+        self.args = args
+        self.run_latency = parse_latency(args.run_latency)
+        self.call_latency = parse_latency(args.call_latency)
+        self.exa_latency = parse_latency(args.exa_latency)
+        width, _, height = args.image_size.partition("x")
+        self.image = _png(int(width), int(height or width))
+        self.files: Dict[str, dict] = {}
+        self.contents: Dict[str, bytes] = {}
+        self.assistants: Dict[str, dict] = {}
+        self.threads: Dict[str, List[dict]] = {}
+        self.runs: Dict[str, dict] = {}
+        self.run_count = 0
+        # Requests and run tokens in the current one-minute rate-limit window
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.window_tokens = 0
+
+    def rate_limit_headers(self) -> Dict[str, str]:
+        """Count a request against the per-minute limits, and the x-ratelimit-* headers OpenAI sends."""
+        now = time.monotonic()
+        if now - self.window_start >= 60:
+            self.window_start, self.window_requests, self.window_tokens = now, 0, 0
+        self.window_requests += 1
+        reset = f"{max(0.0, 60 - (now - self.window_start)):.3f}s"
+        return {
+            "x-ratelimit-limit-requests": str(self.args.rpm),
+            "x-ratelimit-remaining-requests": str(max(0, self.args.rpm - self.window_requests)),
+            "x-ratelimit-reset-requests": reset,
+            "x-ratelimit-limit-tokens": str(self.args.tpm),
+            "x-ratelimit-remaining-tokens": str(max(0, self.args.tpm - self.window_tokens)),
+            "x-ratelimit-reset-tokens": reset,
+        }
+
+    def injected_error(self, rate_limited: bool = False) -> Optional[JSONResponse]:
+        """A 500 (or, for run creation, a 429) drawn at the configured rates."""
+        if random.random() < self.args.error_rate:
+            return JSONResponse({"error": {"message": "fake server error", "type": "server_error"}}, status_code=500)
+        if rate_limited and random.random() < self.args.rate_limit_rate:
+            return JSONResponse({"error": {"message": "fake rate limit", "type": "rate_limit_exceeded"}},
+                                status_code=429, headers={"retry-after": str(self.args.retry_after)})
+        return None
+
+    def message(self, thread_id: str, role: str, text: str, run_id: Optional[str] = None,
+                assistant_id: Optional[str] = None, image_file: Optional[str] = None) -> dict:
+        content = [{"type": "text", "text": {"value": text, "annotations": []}}]
+        if image_file:
+            content.append({"type": "image_file", "image_file": {"file_id": image_file}})
+        now = int(time.time())
+        return {"id": f"msg_{uuid.uuid4().hex}", "object": "thread.message", "created_at": now,
+                "thread_id": thread_id, "role": role, "content": content, "assistant_id": assistant_id,
+                "run_id": run_id, "attachments": [], "metadata": {}, "status": "completed",
+                "completed_at": now, "incomplete_at": None, "incomplete_details": None}
+
+    def invalid_run(self, body: dict) -> Optional[JSONResponse]:
+        """The 400 the real API answers for a json_schema response format on a run with non-function tools."""
+        message = run_format_error(body.get("response_format"), body["tools"] if "tools" in body else
+                                   self.assistants.get(body.get("assistant_id"), {}).get("tools", []))
+        if message is None:
+            return None
+        return JSONResponse({"error": {"message": message, "type": "invalid_request_error",
+                                       "param": "response_format"}}, status_code=400)
+
+    def new_run(self, thread_id: str, body: dict) -> dict:
+        run = {"id": f"run_{uuid.uuid4().hex}", "object": "thread.run", "created_at": int(time.time()),
+               "thread_id": thread_id, "assistant_id": body.get("assistant_id"), "status": "queued",
+               "model": "gpt-4o", "instructions": "", "tools": [], "metadata": {}, "last_error": None,
+               "usage": None, "response_format": body.get("response_format") or "auto"}
+        self.runs[run["id"]] = run
+        return run
+
+    def finish(self, run: dict) -> Optional[dict]:
+        """Complete (or fail, at the configured rate) a run, adding the reply to its thread."""
+        self.run_count += 1
+        messages = self.threads.setdefault(run["thread_id"], [])
+        prompt = messages[-1]["content"][0]["text"]["value"] if messages else ""
+        if random.random() < self.args.run_failure_rate:
+            run.update(status="failed", last_error={"code": "server_error", "message": "fake run failure"})
+            return None
+        response_format = run.get("response_format")
+        reply = _structured_reply(response_format) if isinstance(response_format, dict) else _reply_for(prompt)
+        image_file = None
+        if self.args.image_every and self.run_count % self.args.image_every == 0:
+            image_file = f"file_{uuid.uuid4().hex}"
+            self.contents[image_file] = self.image
+        message = self.message(run["thread_id"], "assistant", reply, run["id"], run["assistant_id"], image_file)
+        messages.append(message)
+        prompt_tokens = len(prompt) // 4
+        self.window_tokens += prompt_tokens + len(reply) // 4
+        run.update(status="completed", completed_at=int(time.time()),
+                   usage={"prompt_tokens": prompt_tokens, "completion_tokens": len(reply) // 4,
+                          "total_tokens": prompt_tokens + len(reply) // 4})
+        return message
+
+
+def _page(items: List[dict], limit: int, after: Optional[str], before: Optional[str]) -> dict:
+    ids = [item["id"] for item in items]
+    if after in ids:
+        items = items[ids.index(after) + 1:]
+    elif before in ids:
+        items = items[:ids.index(before)]
+    page = items[:limit]
+    return {"object": "list", "data": page, "first_id": page[0]["id"] if page else None,
+            "last_id": page[-1]["id"] if page else None, "has_more": len(items) > limit}
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {data if isinstance(data, str) else json.dumps(data)}\n\n"
+
+
+def create_app(args) -> FastAPI:
+    api = FakeAPI(args)
+    app = FastAPI()
+    app.state.api = api
+
+    @app.middleware("http")
+    async def plain_call_latency(request: Request, call_next):
+        # Every call pays a round trip; runs and searches add their own processing time
+        await asyncio.sleep(api.call_latency())
+        if not request.url.path.startswith("/v1/"):
+            return await call_next(request)
+        headers = api.rate_limit_headers()
+        if api.window_requests > args.rpm or api.window_tokens > args.tpm:
+            response = JSONResponse({"error": {"message": "Rate limit reached", "type": "requests"}}, status_code=429)
+            headers["retry-after"] = headers["x-ratelimit-reset-requests"].rstrip("s")
+        else:
+            response = await call_next(request)
+        response.headers.update(headers)
+        return response
+
+    @app.get("/stats")
+    async def stats():
+        return {"runs": api.run_count, "threads": len(api.threads), "assistants": len(api.assistants),
+                "files": len(api.files)}
+
+    # Files
+    @app.post("/v1/files")
+    async def create_file(file: UploadFile = File(...), purpose: str = Form(...)):
+        if error := api.injected_error():
+            return error
+        size = 0
+        while chunk := await file.read(1024 * 1024):
+            size += len(chunk)
+        record = {"id": f"file_{uuid.uuid4().hex}", "object": "file", "bytes": size,
+                  "created_at": int(time.time()), "filename": file.filename, "purpose": purpose,
+                  "status": "processed"}
+        api.files[record["id"]] = record
+        return record
+
+    @app.delete("/v1/files/{file_id}")
+    async def delete_file(file_id: str):
+        if api.files.pop(file_id, None) is None:
+            return JSONResponse({"error": {"message": "No such file"}}, status_code=404)
+        return {"id": file_id, "object": "file", "deleted": True}
+
+    @app.get("/v1/files/{file_id}/content")
+    async def file_content(file_id: str):
+        if error := api.injected_error():
+            return error
+        return Response(api.contents.get(file_id, PNG_PIXEL), media_type="application/octet-stream")
+
+    # Assistants
+    @app.post("/v1/assistants")
+    async def create_assistant(request: Request):
+        if error := api.injected_error():
+            return error
+        body = await request.json()
+        assistant = {"id": f"asst_{uuid.uuid4().hex}", "object": "assistant", "created_at": int(time.time()),
+                     "name": body.get("name"), "description": None, "model": body.get("model"),
+                     "instructions": body.get("instructions"), "tools": body.get("tools", []),
+                     "tool_resources": body.get("tool_resources"), "metadata": body.get("metadata", {})}
+        api.assistants[assistant["id"]] = assistant
+        return assistant
+
+    @app.get("/v1/assistants")
+    async def list_assistants(limit: int = 20, after: Optional[str] = None, before: Optional[str] = None):
+        return _page(list(api.assistants.values()), limit, after, before)
+
+    @app.get("/v1/assistants/{assistant_id}")
+    async def get_assistant(assistant_id: str):
+        if assistant_id not in api.assistants:
+            return JSONResponse({"error": {"message": "No such assistant"}}, status_code=404)
+        return api.assistants[assistant_id]
+
+    @app.delete("/v1/assistants/{assistant_id}")
+    async def delete_assistant(assistant_id: str):
+        if api.assistants.pop(assistant_id, None) is None:
+            return JSONResponse({"error": {"message": "No such assistant"}}, status_code=404)
+        return {"id": assistant_id, "object": "assistant.deleted", "deleted": True}
+
+    # Threads and messages
+    @app.post("/v1/threads")
+    async def create_thread():
+        if error := api.injected_error():
+            return error
+        thread_id = f"thread_{uuid.uuid4().hex}"
+        api.threads[thread_id] = []
+        return {"id": thread_id, "object": "thread", "created_at": int(time.time()), "metadata": {},
+                "tool_resources": None}
+
+    @app.post("/v1/threads/{thread_id}/messages")
+    async def create_message(thread_id: str, request: Request):
+        if error := api.injected_error():
+            return error
+        body = await request.json()
+        message = api.message(thread_id, body.get("role", "user"), body["content"])
+        api.threads.setdefault(thread_id, []).append(message)
+        return message
+
+    @app.get("/v1/threads/{thread_id}/messages")
+    async def list_messages(thread_id: str, limit: int = 20, order: str = "desc", run_id: Optional[str] = None,
+                            after: Optional[str] = None, before: Optional[str] = None):
+        messages = api.threads.get(thread_id, [])
+        if run_id:
+            messages = [message for message in messages if message["run_id"] == run_id]
+        if order == "desc":
+            messages = list(reversed(messages))
+        return _page(messages, limit, after, before)
+
+    # Runs
+    @app.post("/v1/threads/{thread_id}/runs")
+    async def create_run(thread_id: str, request: Request):
+        if error := api.injected_error(rate_limited=True):
+            return error
+        body = await request.json()
+        if error := api.invalid_run(body):
+            return error
+        run = api.new_run(thread_id, body)
+        latency = api.run_latency()
+        if body.get("stream"):
+            return StreamingResponse(_stream_run(api, run, latency), media_type="text/event-stream")
+
+        async def complete():
+            await asyncio.sleep(latency)
+            api.finish(run)
+
+        run["status"] = "in_progress"
+        asyncio.get_running_loop().create_task(complete())
+        return JSONResponse(run, headers={"openai-poll-after-ms": str(args.poll_after_ms)})
+
+    @app.get("/v1/threads/{thread_id}/runs/{run_id}")
+    async def get_run(thread_id: str, run_id: str):
+        if error := api.injected_error():
+            return error
+        run = api.runs.get(run_id)
+        if run is None:
+            return JSONResponse({"error": {"message": "No such run"}}, status_code=404)
+        return JSONResponse(run, headers={"openai-poll-after-ms": str(args.poll_after_ms)})
+
+    # Exa
+    @app.post("/exa/search")
+    async def exa_search(request: Request):
+        if error := api.injected_error():
+            return error
+        body = await request.json()
+        await asyncio.sleep(api.exa_latency())
+        query, num_results = body["query"], body.get("numResults", 10)
+        # Draw from a fixed pool of articles, so similar queries overlap as real ones do
+        start = zlib.crc32(query.encode()) % args.exa_pool
+        articles = [(start + i) % args.exa_pool for i in range(min(num_results, args.exa_pool))]
+        return {"results": [{"id": f"https://example.org/{i}", "url": f"https://example.org/{i}",
+                             "title": f"Article {i}", "summary": f"Summary {i} of {query}"} for i in articles],
+                "resolvedSearchType": "neural"}
+
+    return app
+
+
+async def _stream_run(api: FakeAPI, run: dict, latency: float):
+    # The run's latency is spread over the events, so the first delta arrives early as it does for real
+    yield _sse("thread.run.created", run)
+    run["status"] = "in_progress"
+    yield _sse("thread.run.in_progress", run)
+    step = {"id": f"step_{uuid.uuid4().hex}", "object": "thread.run.step", "run_id": run["id"],
+            "thread_id": run["thread_id"], "assistant_id": run["assistant_id"], "type": "tool_calls",
+            "status": "in_progress", "created_at": int(time.time()),
+            "step_details": {"type": "tool_calls", "tool_calls": []}}
+    yield _sse("thread.run.step.created", step)
+    code = {"index": 0, "id": f"call_{uuid.uuid4().hex}", "type": "code_interpreter",
+            "code_interpreter": {"input": "df.describe()", "outputs": [{"index": 0, "type": "logs", "logs": "count 100"}]}}
+    yield _sse("thread.run.step.delta", {"id": step["id"], "object": "thread.run.step.delta",
+                                         "delta": {"step_details": {"type": "tool_calls", "tool_calls": [code]}}})
+    step["status"] = "completed"
+    yield _sse("thread.run.step.completed", step)
+
+    # The reply is only known once the run finishes; its words are then sent as deltas
+    message = api.finish(run)
+    if message is None:
+        await asyncio.sleep(latency)
+        yield _sse("thread.run.failed", run)
+        yield _sse("done", "[DONE]")
+        return
+    words = [word + " " for word in message["content"][0]["text"]["value"].split(" ")]
+    pause = latency / (len(words) + 2)
+    yield _sse("thread.message.created", dict(message, content=[], status="in_progress"))
+    for word in words:
+        await asyncio.sleep(pause)
+        yield _sse("thread.message.delta", {"id": message["id"], "object": "thread.message.delta",
+                                            "delta": {"content": [{"index": 0, "type": "text",
+                                                                   "text": {"value": word, "annotations": []}}]}})
+    for index, block in enumerate(message["content"][1:], start=1):
+        yield _sse("thread.message.delta", {"id": message["id"], "object": "thread.message.delta",
+                                            "delta": {"content": [dict(block, index=index)]}})
+    await asyncio.sleep(pause)
+    yield _sse("thread.message.completed", message)
+    yield _sse("thread.run.completed", run)
+    yield _sse("done", "[DONE]")
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--run-latency", default="lognormal:2,0.3", help="processing time of an assistant run")
+    parser.add_argument("--call-latency", default="lognormal:0.15,0.3", help="round trip of every API call")
+    parser.add_argument("--exa-latency", default="lognormal:1,0.3", help="processing time of an Exa search")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of run creations answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="seconds sent with every 429")
+    parser.add_argument("--run-failure-rate", type=float, default=0.0, help="share of runs ending `failed`")
+    parser.add_argument("--image-every", type=int, default=3, help="attach a chart to every Nth run, 0 for none")
+    parser.add_argument("--image-size", default="800x600", help="chart dimensions, 1x1 for a tiny PNG")
+    parser.add_argument("--exa-pool", type=int, default=60, help="distinct articles searches draw from")
+    parser.add_argument("--poll-after-ms", type=int, default=200, help="run polling interval sent to the client")
+    parser.add_argument("--rpm", type=int, default=5000, help="OpenAI requests allowed per minute")
+    parser.add_argument("--tpm", type=int, default=2000000, help="OpenAI tokens allowed per minute")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the latency and error draws")
+    return parser
+
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    random.seed(args.seed)
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
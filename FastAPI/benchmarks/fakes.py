@@ -0,0 +1,346 @@
+"""
+In-process stand-ins for the OpenAI and Exa clients used by utils.py, so the
+pipeline can be driven without network access or API credits.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+import uuid
+import zlib
+from types import SimpleNamespace
+from typing import Optional
+
+import httpx
+import openai
+
+from consts import NUM_PROMPTS, NUM_QUESTIONS, ONE_LINER, L2_OUTPUT
+
+# Smallest valid PNG (1x1 transparent pixel), used as the fake chart payload
+PNG_PIXEL = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+# JSON bodies for the structured-output stages, keyed by schema name
+STRUCTURED_REPLIES = {
+    "Instructions": {"instructions": [f"Analyse column group {i}" for i in range(NUM_PROMPTS)]},
+    "Questions": {"questions": [f"Why does finding {i} hold?" for i in range(NUM_QUESTIONS)]},
+    "Title": {"title": "Rainfall peaks in spring"},
+    "SourceSummary": {"summary": "The source backs up the trend.", "title": "Source agrees"},
+}
+
+
+def _structured_reply(response_format: dict) -> str:
+    # Answer with exactly the fields the response format asks for
+    json_schema = response_format["json_schema"]
+    body = STRUCTURED_REPLIES[json_schema["name"]]
+    return json.dumps({name: body[name] for name in json_schema["schema"]["properties"]})
+
+
+def run_format_error(response_format, tools) -> Optional[str]:
+    """
+    The message the Assistants API rejects a run with when it asks for a json_schema
+    response format while a tool (the run's, else the assistant's) is not a function.
+    """
+    if not isinstance(response_format, dict) or response_format.get("type") != "json_schema":
+        return None
+    if all(_tool_type(tool) == "function" for tool in tools or ()):
+        return None
+    return "Invalid tools: all tools must be of type `function` when `response_format` is of type `json_schema`."
+
+
+def _tool_type(tool) -> Optional[str]:
+    return tool.get("type") if isinstance(tool, dict) else getattr(tool, "type", None)
+
+
+def _reply_for(prompt: str) -> str:
+    # Shape each reply like the real model output for the stage that asked for it
+    if "possible instructions" in prompt:
+        return json.dumps(STRUCTURED_REPLIES["Instructions"])
+    if "followup questions" in prompt:
+        return json.dumps(STRUCTURED_REPLIES["Questions"])
+    if "JSON object with a `summary`" in prompt:
+        return json.dumps(STRUCTURED_REPLIES["SourceSummary"])
+    if prompt.startswith(ONE_LINER):
+        return json.dumps(STRUCTURED_REPLIES["Title"])
+    if "create an exa query" in prompt:
+        # Queries follow the finding being expanded, as the real ones do
+        finding = prompt.split("Our findings about ", 1)[-1].split(" suggest", 1)[0]
+        return f"Here's a great article about {finding}:"
+    return "Rainfall is strongly correlated with humidity (r=0.81)."
+
+
+def _not_found(path: str) -> openai.NotFoundError:
+    request = httpx.Request("GET", f"https://api.openai.com/v1{path}")
+    return openai.NotFoundError("Not found", response=httpx.Response(404, request=request), body=None)
+
+
+def _bad_request(message: str) -> openai.BadRequestError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/threads/runs")
+    return openai.BadRequestError(message, response=httpx.Response(400, request=request), body=None)
+
+
+def _text_content(value: str):
+    return SimpleNamespace(type="text", text=SimpleNamespace(value=value, annotations=[]))
+
+
+def _image_content(file_id: str):
+    return SimpleNamespace(type="image_file", image_file=SimpleNamespace(file_id=file_id))
+
+
+class _FakePaginator:
+    # Mimics AsyncPaginator: it can be awaited for the first page or iterated across pages
+    def __init__(self, items, page_size=20, page_latency=0.0):
+        self._items = items
+        self._page_size = page_size
+        self._page_latency = page_latency
+        self.data = items[:page_size]
+
+    def __await__(self):
+        async def first_page():
+            await asyncio.sleep(self._page_latency)
+            return self
+        return first_page().__await__()
+
+    async def __aiter__(self):
+        for start in range(0, len(self._items), self._page_size):
+            await asyncio.sleep(self._page_latency)
+            for item in self._items[start:start + self._page_size]:
+                yield item
+
+
+class _FakeState:
+    def __init__(self, latency, jitter, image_every, page_latency):
+        self.latency = latency
+        self.jitter = jitter
+        self.image_every = image_every
+        self.page_latency = page_latency
+        self.call_latency = 0.0
+        self.threads = {}
+        self.files = {}
+        self.uploads = {}
+        self.assistants = {}
+        self.run_counter = itertools.count(1)
+        self.fail_every = 0
+        self.attempt_counter = itertools.count(1)
+
+    def delay(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+
+
+class _Messages:
+    def __init__(self, state):
+        self._state = state
+
+    async def create(self, thread_id, role, content, **kwargs):
+        message = SimpleNamespace(id=f"msg_{uuid.uuid4().hex}", role=role, run_id=None,
+                                  content=[_text_content(content)])
+        self._state.threads.setdefault(thread_id, []).append(message)
+        return message
+
+    def list(self, thread_id, order="desc", limit=20, run_id=None, **kwargs):
+        messages = self._state.threads.get(thread_id, [])
+        if run_id is not None:
+            messages = [message for message in messages if message.run_id == run_id]
+        if order == "desc":
+            messages = list(reversed(messages))
+        return _FakePaginator(messages, page_size=limit, page_latency=self._state.page_latency)
+
+
+class _Runs:
+    def __init__(self, state):
+        self._state = state
+
+    def _reply(self, thread_id, response_format):
+        # Append the assistant's reply to the thread, as a finished run would
+        run_number = next(self._state.run_counter)
+        run_id = f"run_{run_number}"
+        messages = self._state.threads.setdefault(thread_id, [])
+        prompt = messages[-1].content[0].text.value if messages else ""
+        reply = _structured_reply(response_format) if response_format else _reply_for(prompt)
+        content = [_text_content(reply)]
+        if self._state.image_every and run_number % self._state.image_every == 0:
+            file_id = f"file_{uuid.uuid4().hex}"
+            self._state.files[file_id] = PNG_PIXEL
+            content.append(_image_content(file_id))
+        message = SimpleNamespace(id=f"msg_{uuid.uuid4().hex}", role="assistant", run_id=run_id, content=content)
+        messages.append(message)
+        run = SimpleNamespace(id=run_id, status="completed", thread_id=thread_id, last_error=None,
+                              usage=SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=32,
+                                                    total_tokens=len(prompt) // 4 + 32))
+        return run, message
+
+    def _check(self, assistant_id, response_format, kwargs):
+        assistant = self._state.assistants.get(assistant_id)
+        tools = kwargs["tools"] if "tools" in kwargs else getattr(assistant, "tools", [])
+        if message := run_format_error(response_format, tools):
+            raise _bad_request(message)
+
+    async def create_and_poll(self, thread_id, assistant_id, response_format=None, **kwargs):
+        self._check(assistant_id, response_format, kwargs)
+        await asyncio.sleep(self._state.delay())
+        if self._state.fail_every and next(self._state.attempt_counter) % self._state.fail_every == 0:
+            # A run the service gave up on: no reply is added to the thread
+            return SimpleNamespace(id=f"run_{uuid.uuid4().hex}", status="failed", thread_id=thread_id,
+                                   last_error=SimpleNamespace(code="server_error", message="fake failure"),
+                                   usage=None)
+        run, _ = self._reply(thread_id, response_format)
+        return run
+
+    def stream(self, thread_id, assistant_id, response_format=None, **kwargs):
+        self._check(assistant_id, response_format, kwargs)
+        return _FakeRunStream(self._state, self._reply(thread_id, response_format))
+
+
+class _FakeRunStream:
+    # Mimics AsyncAssistantStreamManager: the run's latency is spread over the events,
+    # so the first delta arrives after a fraction of the full run time
+    def __init__(self, state, reply):
+        self._state = state
+        self._run, self._message = reply
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        def event(name, data):
+            return SimpleNamespace(event=name, data=data)
+
+        def delta(content):
+            return event("thread.message.delta", SimpleNamespace(delta=SimpleNamespace(content=[content])))
+
+        words = [word + " " for block in self._message.content if block.type == "text"
+                 for word in block.text.value.split(" ")]
+        step = self._state.delay() / (len(words) + 2)
+        await asyncio.sleep(step)
+        code = SimpleNamespace(type="code_interpreter", code_interpreter=SimpleNamespace(
+            input="df.describe()", outputs=[SimpleNamespace(type="logs", logs="count 100")]))
+        yield event("thread.run.step.delta", SimpleNamespace(delta=SimpleNamespace(
+            step_details=SimpleNamespace(type="tool_calls", tool_calls=[code]))))
+        for word in words:
+            await asyncio.sleep(step)
+            yield delta(SimpleNamespace(type="text", text=SimpleNamespace(value=word, annotations=None)))
+        for block in self._message.content:
+            if block.type == "image_file":
+                yield delta(block)
+        await asyncio.sleep(step)
+        yield event("thread.message.completed", self._message)
+        yield event("thread.run.completed", self._run)
+
+
+class _Threads:
+    def __init__(self, state):
+        self._state = state
+        self.messages = _Messages(state)
+        self.runs = _Runs(state)
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self._state.call_latency)
+        thread_id = f"thread_{uuid.uuid4().hex}"
+        self._state.threads[thread_id] = []
+        return SimpleNamespace(id=thread_id)
+
+
+class _Assistants:
+    def __init__(self, state):
+        self._state = state
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self._state.call_latency)
+        assistant = SimpleNamespace(id=f"asst_{uuid.uuid4().hex}", created_at=int(time.time()), **kwargs)
+        self._state.assistants[assistant.id] = assistant
+        return assistant
+
+    async def retrieve(self, assistant_id):
+        if assistant_id not in self._state.assistants:
+            raise _not_found(f"/assistants/{assistant_id}")
+        return self._state.assistants[assistant_id]
+
+    async def delete(self, assistant_id):
+        if self._state.assistants.pop(assistant_id, None) is None:
+            raise _not_found(f"/assistants/{assistant_id}")
+        return SimpleNamespace(id=assistant_id, deleted=True)
+
+    def list(self, limit=20, **kwargs):
+        return _FakePaginator(list(self._state.assistants.values()), page_size=limit)
+
+
+class _RawFiles:
+    def __init__(self, state):
+        self._state = state
+
+    async def retrieve_content(self, file_id):
+        await asyncio.sleep(self._state.latency / 10)
+        return SimpleNamespace(status_code=200, content=self._state.files.get(file_id, PNG_PIXEL))
+
+
+class _Files:
+    def __init__(self, state):
+        self._state = state
+        self.with_raw_response = _RawFiles(state)
+
+    async def create(self, file, purpose):
+        # Drain the upload the way the HTTP client would, one chunk at a time
+        handle = file[1] if isinstance(file, tuple) else None
+        if handle is not None:
+            while handle.read(1024 * 1024):
+                pass
+        await asyncio.sleep(self._state.latency)
+        file_id = f"file_{uuid.uuid4().hex}"
+        self._state.uploads[file_id] = purpose
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    async def delete(self, file_id):
+        if self._state.uploads.pop(file_id, None) is None:
+            raise _not_found(f"/files/{file_id}")
+        return SimpleNamespace(id=file_id, deleted=True)
+
+
+class FakeAsyncOpenAI:
+    """
+    Answers every assistant run after a configurable delay with output shaped like the
+    prompt that was sent (instruction lists, titles, questions, L2 summaries).
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, image_every: int = 0,
+                 page_latency: float = 0.0, fail_every: int = 0, call_latency: float = 0.0):
+        self._state = _FakeState(latency, jitter, image_every, page_latency)
+        self._state.fail_every = fail_every
+        # Round trip of the plain API calls (thread and assistant creation)
+        self._state.call_latency = call_latency
+        threads = _Threads(self._state)
+        self.beta = SimpleNamespace(threads=threads, assistants=_Assistants(self._state))
+        self.files = _Files(self._state)
+
+    def seed_thread(self, thread_id: str, length: int):
+        """Pre-fill a thread with `length` alternating user/assistant messages."""
+        messages = self._state.threads.setdefault(thread_id, [])
+        for i in range(length):
+            role = "user" if i % 2 == 0 else "assistant"
+            messages.append(SimpleNamespace(id=f"msg_{uuid.uuid4().hex}", role=role, run_id=None,
+                                            content=[_text_content(f"history {i}")]))
+
+
+class FakeExa:
+    """Results drawn from a pool of `pool` articles, so different queries overlap as real ones do."""
+
+    def __init__(self, latency: float = 0.05, pool: int = 12):
+        self.latency = latency
+        self.pool = pool
+        self.calls = 0
+
+    def search_and_contents(self, query, num_results=L2_OUTPUT, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        start = zlib.crc32(query.encode()) % self.pool
+        articles = [(start + i) % self.pool for i in range(min(num_results, self.pool))]
+        return SimpleNamespace(results=[
+            SimpleNamespace(title=f"Article {i}", url=f"https://example.org/{i}", summary=f"Summary {i} of {query}")
+            for i in articles
+        ])
@@ -2,18 +2,41 @@ INSTRUCTIONS = """
 You will use data as a database for a mind map of data. You will first use this data to perform basic analyses to derive correlations and distributions between different columns (variables) for the data. You will then return these to the user. The user will then ask for more open-ended analysis and to come up with creative meanings behind the data correlations and connections. Do not ask for Follow-up questions, or future directions. Just give the response to the instruction and only the response.
 You are an AI Data Scientist focusing on identifying valuable features in datasets and uncovering high-level causal relationships between variables. Techniques to utilize: Correlation Analysis: Compute correlation coefficients for numerical columns to identify relationships. Cross-tabulation: For categorical variables, create contingency tables. Time Series Analysis: Identify trends or seasonal patterns. Combine Columns: Suggest combinations of columns to derive more meaningful features.
 """
+MODEL = "gpt-4o"
 NUM_PROMPTS = 5
 
 DELIMITER = "~"
-INITIAL_PROMPT = f"Generate {NUM_PROMPTS} (don't forget this, it must be {NUM_PROMPTS}) possible instructions for the dataset specified. Instructions should be unique and precise in nature. Each instruction should be delimited by {DELIMITER} (dont forget this, must be {DELIMITER} before and {DELIMITER} after) before and after -- be concise! Each instruction should be different in nature "
-ONE_LINER = "Summarize the key findings in one sentence <= 50 characters."
+INITIAL_PROMPT = f"Generate {NUM_PROMPTS} (don't forget this, it must be {NUM_PROMPTS}) possible instructions for the dataset specified. Instructions should be unique and precise in nature -- be concise! Each instruction should be different in nature. Reply with a JSON object whose `instructions` field lists the instructions."
+PROFILE_PROMPT = " Use this precomputed profile of the dataset to choose the instructions with the most insight; do not spend instructions re-deriving these basics:\n"
+ONE_LINER = "Summarize the key findings in one sentence <= 50 characters. Reply with a JSON object whose `title` field is that sentence."
 SURPRISING = {"enabled": False, "prompt": "Include a 'surprising' score from 1 to 10 at the end to indicate how if finding is boring / generic. Example format {'title': '...', 'surprising': 5}"}
 NUM_QUESTIONS = 3
 
 L2_OUTPUT = 3
+L2_SEARCH_RESULTS = 6  # Exa results fetched per expansion, spares for sources the hub already has
+L2_MAX_SEARCH_RESULTS = 24  # Widest search when the hub already summarized the top results
 
-SUGGESTED_QUESTION_PROMPT = f"Generate {NUM_QUESTIONS} followup questions that a user might ask about the finding. The questions should focus on clarifications of difficult terms or implications of causal relationships found. Each question should be delimited by a {DELIMITER} before and after (this is important {DELIMITER} before and {DELIMITER} after)"
+SUGGESTED_QUESTION_PROMPT = f"Generate {NUM_QUESTIONS} followup questions that a user might ask about the finding. The questions should focus on clarifications of difficult terms or implications of causal relationships found. Reply with a JSON object whose `questions` field lists the questions."
 LEVEL_ONE_HALF_PROMPT = "Use the previous responses in the thread conversation in order to answer the question. Limit the response to <= 300 characters. Cite any sources or papers when referring to external concepts/ideas."
 LEVEL_ONE_PROMPT_SUFFIX = "Be precise with your results. Any plots should be made with matplotlib and seaborn and should have clearly defined axes and should not be convoluted by using heat maps and alpha values for appropriate graph types. Plots should use histograms for continuous values, and bar graphs for discrete plots. Aggregation of values should also be used for very volatile data values over time."
 
-RETRIES = 5 # number of times to retry prompt before raising error
\ No newline at end of file
+RETRIES = 5 # number of times to retry prompt before raising error
+RETRY_BASE_DELAY = 1.0 # seconds, first backoff ceiling; doubles per attempt with full jitter
+RETRY_MAX_DELAY = 30.0 # seconds, cap on a single backoff
+RATE_LIMIT_BACKOFF = 4 # rate-limited runs back off this many times longer than transient failures
+STRUCTURED_OUTPUTS = True # send JSON-schema response formats with the non-code runs
+REPAIR_ATTEMPTS = 2 # number of cheap follow-ups asking only for missing fields before giving up
+MAX_CONCURRENT_RUNS = 16 # number of assistant runs allowed in flight at once per process
+MAX_CONCURRENT_SEARCHES = 4 # number of Exa searches allowed in flight at once per process
+OPENAI_RPM = 500 # starting request budget per minute, replaced by the x-ratelimit headers OpenAI sends back
+OPENAI_TPM = 800000 # starting token budget per minute, likewise
+EXA_RPM = 300 # request budget per minute for Exa, which sends no rate-limit headers
+RUN_TOKEN_ESTIMATE = 2000 # tokens charged on top of the prompt when a run starts, settled from run.usage
+ASSISTANT_METADATA = {"app": "hackharvard-mindmap"} # tags remote assistants so orphans can be found
+DATASET_GC_INTERVAL = 3600 # seconds between sweeps for unused assistants and files
+DATASET_GC_GRACE = 24 * 3600 # seconds an unreferenced assistant is kept for re-uploads
+JOB_LEASE_SECONDS = 60 # a running job whose worker stops renewing its lease for this long is picked up again
+JOB_MAX_ATTEMPTS = 3 # claims of one job before it is marked failed
+JOB_POLL_INTERVAL = 0.5 # seconds between queue checks of an idle worker or a waiting request
+JOB_CONCURRENCY = {"question": 16, "l2": 8, "l1": 4, "l1_local": 2, "prefetch": 2} # jobs of each kind one worker runs at once
+PREFETCH_RESERVE = 0.5 # share of the run slots and rate budgets speculative prefetches leave free
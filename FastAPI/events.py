@@ -0,0 +1,84 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+from database import Node, NodeResponse
+
+# Build states reported on a hub's stream
+BUILDING = "building"
+COMPLETE = "complete"
+FAILED = "failed"
+
+KEEPALIVE_SECONDS = 15
+STREAM_POLL_SECONDS = 1.0  # how soon a hub stream built elsewhere reads new nodes and status from the database
+STREAM_POLL_MAX_SECONDS = 8.0  # the poll interval doubles up to this while nothing changes
+
+
+class HubEvents:
+    """
+    In-process fan-out of node and build-status events to every client streaming a hub.
+    Node tasks run on the same event loop as the request handlers, so plain asyncio
+    queues are enough to hand events across. A hub built by a separate worker process
+    publishes nothing here, so its streams poll the database instead (see main.hub_updates).
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self._status: Dict[str, dict] = {}
+
+    def subscribe(self, hub_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers[hub_id].add(queue)
+        return queue
+
+    def unsubscribe(self, hub_id: str, queue: asyncio.Queue):
+        self._subscribers[hub_id].discard(queue)
+        if not self._subscribers[hub_id]:
+            del self._subscribers[hub_id]
+            self._prune(hub_id)
+
+    def status(self, hub_id: str) -> Optional[dict]:
+        return self._status.get(hub_id)
+
+    def building(self, hub_id: str) -> bool:
+        """Whether a build of the hub is running in this process, so its events say when it changes."""
+        status = self._status.get(hub_id)
+        return bool(status) and status["status"] == BUILDING
+
+    def publish(self, hub_id: str, event: str, data: dict):
+        if event == "status":
+            self._status[hub_id] = data
+        for queue in self._subscribers.get(hub_id, ()):
+            queue.put_nowait((event, data))
+        self._prune(hub_id)
+
+    def _prune(self, hub_id: str):
+        # A finished build's status is only kept while someone streams the hub; after that
+        # the jobs table has it (see main.build_status)
+        status = self._status.get(hub_id)
+        if status and status["status"] in (COMPLETE, FAILED) and hub_id not in self._subscribers:
+            del self._status[hub_id]
+
+    def publish_node(self, node: Node):
+        # Serialize while the node's session is still open so relationships can load
+        self.publish(node.hub_id, "node", node_event(node))
+
+    def publish_status(self, hub_id: str, status: str, detail: Optional[str] = None):
+        self.publish(hub_id, "status", {"hub_id": hub_id, "status": status, "detail": detail})
+
+
+hub_events = HubEvents()
+
+
+def node_event(node: Node) -> dict:
+    """Payload of a `node` event; call it where the node's session is usable (e.g. in run_db)."""
+    return NodeResponse.model_validate(node, from_attributes=True).model_dump()
+
+
+def format_sse(event: str, data: dict, event_id: Optional[str] = None) -> str:
+    """Encode one server-sent event frame."""
+    frame = f"event: {event}\n"
+    if event_id:
+        frame += f"id: {event_id}\n"
+    return frame + f"data: {json.dumps(data)}\n\n"
@@ -0,0 +1,279 @@
+import asyncio
+import contextvars
+import hashlib
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import List, Optional
+
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from PIL import Image as PILImage, features
+
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "./image_store")
+CHUNK_SIZE = 64 * 1024
+# Content addressed files never change, so clients may cache them forever
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Derivatives made for each stored chart: downscaled copies at these widths (the canvas
+# shows charts as ~300px previews) and the full size, in the modern formats below
+IMAGE_VARIANT_WIDTHS = tuple(int(width) for width in os.getenv("IMAGE_VARIANT_WIDTHS", "320,960").split(",") if width)
+# Encoder qualities that look alike on charts; AVIF's scale runs lower than WebP's
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "75"))
+IMAGE_AVIF_QUALITY = int(os.getenv("IMAGE_AVIF_QUALITY", "60"))
+MEDIA_TYPES = {"avif": "image/avif", "webp": "image/webp", "png": "image/png"}
+# Formats this Pillow build cannot write are left out
+IMAGE_VARIANT_FORMATS = tuple(fmt for fmt in os.getenv("IMAGE_VARIANT_FORMATS", "avif,webp").split(",")
+                              if fmt and features.check(fmt))
+
+# Each encoder holds tens of MB while it runs, so concurrent node saves share a few threads
+# rather than each taking one of the default executor's
+IMAGE_ENCODE_THREADS = int(os.getenv("IMAGE_ENCODE_THREADS", str(min(2, os.cpu_count() or 1))))
+encode_executor = ThreadPoolExecutor(max_workers=IMAGE_ENCODE_THREADS, thread_name_prefix="image")
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+async def run_encode(fn, *args):
+    """Run image decoding and encoding (e.g. store_variants) on the bounded encoder threads, traced as the caller."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(encode_executor, partial(context.run, fn, *args))
+
+
+def image_path(digest: str) -> str:
+    """Path of a stored image, fanned out by the first two hex digits of its hash."""
+    return os.path.join(IMAGE_STORE_DIR, digest[:2], digest)
+
+
+def store_image(data: bytes) -> str:
+    """
+    Write image bytes to the content-addressed store, once per distinct payload.
+
+    Returns:
+    str: The SHA-256 hex digest the image is stored under.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = image_path(digest)
+    if not os.path.exists(path):
+        _write(path, data)
+    return digest
+
+
+def _write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temp file and rename so readers never see a partial image
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def legacy_image_bytes(data) -> Optional[bytes]:
+    """
+    The bytes of an image stored inline in the images table before the image store existed,
+    or None if the row has none (nor a digest in the store).
+    """
+    if data is None:
+        return None
+    if isinstance(data, str) and data.startswith("0x"):
+        return bytes.fromhex(data[2:])  # Remove "0x" and convert hex to binary
+    if isinstance(data, str):
+        return data.encode()
+    return data  # Already binary data
+
+
+def check_digest(digest):
+    """
+    Make sure a digest that came from outside (e.g. an imported archive) is a SHA-256 hex
+    digest, so the path built from it stays inside the image store.
+
+    Raises:
+    ValueError: If it is not.
+    """
+    if not isinstance(digest, str) or not _DIGEST.fullmatch(digest):
+        raise ValueError(f"Invalid image digest {digest!r}")
+
+
+def check_variant(digest, width, fmt):
+    """
+    Like check_digest, for a variant: its width must be a positive int and its format
+    one this server makes.
+
+    Raises:
+    ValueError: If any of them is not.
+    """
+    check_digest(digest)
+    if type(width) is not int or width < 1:
+        raise ValueError(f"Invalid variant width {width!r}")
+    if fmt not in IMAGE_VARIANT_FORMATS + ("png",):
+        raise ValueError(f"Unsupported variant format {fmt!r}")
+
+
+def variant_name(width: int, fmt: str) -> str:
+    return f"{width}.{fmt}"
+
+
+def variant_path(digest: str, width: int, fmt: str) -> str:
+    """Derivatives are a function of the original, so they are stored next to it under its digest."""
+    return f"{image_path(digest)}.{variant_name(width, fmt)}"
+
+
+def store_variant(digest: str, width: int, fmt: str, data: bytes):
+    """Write a variant made elsewhere (e.g. one in an imported session), unless it is stored already."""
+    check_variant(digest, width, fmt)
+    path = variant_path(digest, width, fmt)
+    if not os.path.exists(path):
+        _write(path, data)
+
+
+def _encode(image: PILImage.Image, fmt: str) -> bytes:
+    out = BytesIO()
+    # Encoder speeds trade a few percent of size for several times less CPU per chart
+    if fmt == "png":
+        image.save(out, "PNG")
+    elif fmt == "webp":
+        image.save(out, "WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
+    else:
+        image.save(out, "AVIF", quality=IMAGE_AVIF_QUALITY, speed=8)
+    return out.getvalue()
+
+
+def store_variants(digest: str, data: bytes) -> dict:
+    """
+    Make the thumbnails and modern-format copies of a stored image: each width of
+    IMAGE_VARIANT_WIDTHS below the original's, plus the full size, in every format of
+    IMAGE_VARIANT_FORMATS (and PNG for the downscaled ones, for clients without either).
+    Copies that come out no smaller than the original are left out. Files already
+    made for the same digest are reused.
+
+    Returns:
+    dict: The original's "width" and "height", and its "variants" as a list of
+    {"width", "height", "format", "size"}, smallest first. Data Pillow cannot
+    read gives no variants.
+    """
+    try:
+        original = PILImage.open(BytesIO(data))
+        original.load()
+    except (OSError, ValueError, PILImage.DecompressionBombError):
+        return {"width": None, "height": None, "variants": []}
+    has_alpha = original.mode in ("RGBA", "LA") or (original.mode == "P" and "transparency" in original.info)
+    source = original.convert("RGBA" if has_alpha else "RGB")
+
+    variants = []
+    for width in sorted({width for width in IMAGE_VARIANT_WIDTHS if width < source.width} | {source.width}):
+        height = max(round(source.height * width / source.width), 1)
+        resized = None
+        formats = IMAGE_VARIANT_FORMATS + (("png",) if width < source.width else ())
+        for fmt in formats:
+            path = variant_path(digest, width, fmt)
+            if not os.path.exists(path):
+                if resized is None:
+                    resized = source if width == source.width else source.resize((width, height), PILImage.LANCZOS)
+                _write(path, _encode(resized, fmt))
+            size = os.path.getsize(path)
+            if size < len(data):
+                variants.append({"width": width, "height": height, "format": fmt, "size": size})
+    return {"width": source.width, "height": source.height, "variants": variants}
+
+
+def accepted(accept: Optional[str]) -> set:
+    """The values an Accept (or Accept-Encoding) header allows, i.e. lists without q=0."""
+    allowed = set()
+    for item in (accept or "").split(","):
+        media_type, _, params = item.partition(";")
+        quality = re.search(r"q=(\d+(?:\.\d*)?)", params)
+        if quality and float(quality.group(1)) == 0:
+            continue
+        allowed.add(media_type.strip().lower())
+    return allowed
+
+
+def pick_variant(variants: List[dict], original_width: Optional[int], width: Optional[int] = None,
+                 fmt: Optional[str] = None, accept: Optional[str] = None) -> Optional[dict]:
+    """
+    The variant to serve for a request: the narrowest one at least `width` wide (the
+    widest there is when none is; full size without `width`), in the format asked for
+    or else the smallest file among the formats `accept` names explicitly (PNG always
+    qualifies). Returns None when the original is the best answer.
+    """
+    if not variants:
+        return None
+    widths = sorted({variant["width"] for variant in variants})
+    if width is None or (original_width and width >= original_width):
+        target = original_width
+    else:
+        target = next((candidate for candidate in widths if candidate >= width), widths[-1])
+    if fmt:
+        formats = {fmt}
+    else:
+        allowed = accepted(accept)
+        formats = {candidate for candidate in IMAGE_VARIANT_FORMATS if MEDIA_TYPES[candidate] in allowed} | {"png"}
+    candidates = [variant for variant in variants if variant["width"] == target and variant["format"] in formats]
+    return min(candidates, key=lambda variant: variant["size"]) if candidates else None
+
+
+def _iter_file(path: str, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _parse_range(range_header: str, size: int):
+    # Only single byte ranges are supported; anything else is served in full
+    match = _RANGE.match(range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    return start, end
+
+
+def image_response(digest: str, media_type: str, range_header: Optional[str] = None,
+                   if_none_match: Optional[str] = None, variant: Optional[dict] = None,
+                   vary: bool = False) -> Response:
+    """
+    Serve a stored image, or one of its `variant`s, with a strong ETag, immutable caching
+    and single-range support. With `vary`, the response depends on the Accept header.
+    """
+    if variant:
+        path = variant_path(digest, variant["width"], variant["format"])
+        etag = f'"{digest}.{variant_name(variant["width"], variant["format"])}"'
+        media_type = MEDIA_TYPES[variant["format"]]
+    else:
+        path = image_path(digest)
+        etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if vary:
+        headers["Vary"] = "Accept"
+
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    size = os.path.getsize(path)
+    byte_range = _parse_range(range_header, size) if range_header else None
+    if byte_range:
+        start, end = byte_range
+        if start >= size or start > end:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        length = end - start + 1
+        headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(length)})
+        return StreamingResponse(_iter_file(path, start, length), status_code=206, media_type=media_type,
+                                 headers=headers)
+
+    # FileResponse streams from disk (and uses sendfile where the server supports it)
+    return FileResponse(path, media_type=media_type, headers=headers)
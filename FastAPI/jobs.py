@@ -0,0 +1,216 @@
+"""
+SQLite-backed job queue for hub builds, L2 expansions and questions.
+
+Requests enqueue a job row, a worker (embedded in the API process or started with
+`python -m worker`) claims it under a lease it keeps renewing, and the job saves a
+checkpoint of its plan so that a job whose worker died resumes where it stopped.
+"""
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import case, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from consts import JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL
+import metrics
+import tracing
+from database import Job, run_db, session_scope
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Lower runs first: a user waiting on an answer beats a background hub build, and
+# speculative answers (prefetch.py) wait for everything else
+KIND_PRIORITY = {"question": 0, "l2": 1, "l1": 2, "l1_local": 2, "prefetch": 3}
+# Kinds that build a hub, whose state is the hub's build status
+BUILD_KINDS = ("l1", "l1_local")
+
+# Wakes requests waiting on a job finished by the embedded worker without polling
+_finished: Dict[str, Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = {}
+
+
+class JobRun:
+    """A claimed job as seen by its handler."""
+
+    def __init__(self, job: Job, worker_id: str):
+        self.id = job.id
+        self.kind = job.kind
+        self.hub_id = job.hub_id
+        self.attempts = job.attempts
+        self.payload = json.loads(job.payload) if job.payload else {}
+        self.checkpoint = json.loads(job.checkpoint) if job.checkpoint else {}
+        self.worker_id = worker_id
+
+    def save(self, **changes):
+        """Merge `changes` into the checkpoint and persist it, if this worker still holds the job."""
+        self.checkpoint.update(changes)
+        if not _update(self.id, self.worker_id, checkpoint=json.dumps(self.checkpoint)):
+            raise LeaseLost(self.id)
+
+
+class LeaseLost(Exception):
+    """The job's lease expired and another worker may have claimed it."""
+
+
+def active(db, dedup_key: str) -> Optional[Job]:
+    """The queued or running job with `dedup_key`, if any."""
+    return db.query(Job).filter(Job.dedup_key == dedup_key, Job.status.in_((QUEUED, RUNNING))).first()
+
+
+def enqueue(db, kind: str, hub_id: Optional[str], payload: dict, dedup_key: Optional[str] = None) -> Job:
+    """
+    Queue a job. With a `dedup_key`, a queued or running job with the same key is returned
+    instead of a new one, so the same expansion requested twice (or from two processes) runs once;
+    a queued one of a less urgent kind (with the same payload shape) is claimed as `kind` from then on.
+    The current trace goes in the payload, for the worker to continue it.
+    """
+    if dedup_key is not None:
+        job = active(db, dedup_key)
+        if job is not None:
+            return _join(db, job, kind)
+    payload = {**payload, "trace": tracing.carrier()}
+    job = Job(kind=kind, hub_id=hub_id, payload=json.dumps(payload), status=QUEUED, dedup_key=dedup_key)
+    db.add(job)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another request queued the same key between the lookup and the insert
+        db.rollback()
+        job = active(db, dedup_key)
+        if job is None:
+            raise
+        return _join(db, job, kind)
+    return job
+
+
+def _join(db, job: Job, kind: str) -> Job:
+    metrics.incr("jobs_coalesced_total", kind=kind)
+    # e.g. a user asking a question whose speculative answer is still queued: it must not wait behind every build
+    previous = job.kind
+    if job.status == QUEUED and KIND_PRIORITY.get(kind, len(KIND_PRIORITY)) < KIND_PRIORITY.get(previous, len(KIND_PRIORITY)):
+        promoted = db.query(Job).filter(Job.id == job.id, Job.status == QUEUED).update({Job.kind: kind})
+        db.commit()
+        if promoted:
+            metrics.incr("jobs_promoted_total", kind=previous, to=kind)
+            db.refresh(job)
+    return job
+
+
+def claim(worker_id: str, kinds: Iterable[str]) -> Optional[JobRun]:
+    """
+    Claim the most urgent claimable job of one of `kinds`: queued, or running under a
+    lease that has expired. Returns None when there is nothing to do.
+    """
+    kinds = list(kinds)
+    if not kinds:
+        return None
+    with session_scope() as db:
+        now = datetime.utcnow()
+        claimable = or_(Job.status == QUEUED, (Job.status == RUNNING) & (Job.lease_expires_at < now))
+        candidates = (
+            db.query(Job.id, Job.attempts)
+            .filter(Job.kind.in_(kinds), claimable)
+            .order_by(case(KIND_PRIORITY, value=Job.kind, else_=len(KIND_PRIORITY)), Job.created_at)
+            .limit(10)
+            .all()
+        )
+        for job_id, attempts in candidates:
+            if attempts >= JOB_MAX_ATTEMPTS:
+                # A job that keeps killing its workers, or keeps failing, is not tried again
+                db.execute(update(Job).where(Job.id == job_id, claimable)
+                           .values(status=FAILED, lease_owner=None, error=f"Gave up after {attempts} attempts"))
+                db.commit()
+                notify(job_id)
+                continue
+            # Conditional update: only one worker can move the row out of the claimable state
+            claimed = db.execute(
+                update(Job).where(Job.id == job_id, claimable).values(
+                    status=RUNNING, attempts=Job.attempts + 1, lease_owner=worker_id,
+                    lease_expires_at=now + timedelta(seconds=JOB_LEASE_SECONDS))
+            ).rowcount
+            db.commit()
+            if claimed:
+                return JobRun(db.get(Job, job_id), worker_id)
+        return None
+
+
+def _update(job_id: str, worker_id: str, **values) -> bool:
+    # Writes only go through while the worker still owns the lease
+    with session_scope() as db:
+        updated = db.execute(
+            update(Job).where(Job.id == job_id, Job.lease_owner == worker_id, Job.status == RUNNING).values(**values)
+        ).rowcount
+        return bool(updated)
+
+
+def renew(job_id: str, worker_id: str) -> bool:
+    """Extend the lease; False if it was lost."""
+    return _update(job_id, worker_id, lease_expires_at=datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS))
+
+
+def finish(job_id: str, worker_id: str, result) -> bool:
+    done = _update(job_id, worker_id, status=DONE, result=json.dumps(result), lease_owner=None,
+                   lease_expires_at=None, error=None)
+    notify(job_id)
+    return done
+
+
+def fail(job_id: str, worker_id: str, error: str, attempts: int) -> bool:
+    # Failed attempts go back to the queue until JOB_MAX_ATTEMPTS, resuming from the checkpoint
+    status = FAILED if attempts >= JOB_MAX_ATTEMPTS else QUEUED
+    failed = _update(job_id, worker_id, status=status, error=error, lease_owner=None, lease_expires_at=None)
+    if status == FAILED:
+        notify(job_id)
+    return failed
+
+
+def release(job_id: str, worker_id: str) -> bool:
+    """Hand a job cut short by a worker shutdown back to the queue, without using up an attempt."""
+    return _update(job_id, worker_id, status=QUEUED, attempts=Job.attempts - 1, lease_owner=None,
+                   lease_expires_at=None)
+
+
+def notify(job_id: str):
+    # Called from the DB executor threads, so the event is set on its own loop
+    waiter = _finished.get(job_id)
+    if waiter:
+        loop, event = waiter
+        loop.call_soon_threadsafe(event.set)
+
+
+def _load(job_id: str) -> Optional[Job]:
+    with session_scope() as db:
+        return db.get(Job, job_id)
+
+
+async def wait(job_id: str, timeout: Optional[float] = None) -> Optional[Job]:
+    """
+    Wait until the job is done or failed and return its row, or None if it was deleted.
+    Jobs finished by the embedded worker wake the waiter at once, others are noticed by polling.
+    """
+    loop = asyncio.get_running_loop()
+    _, event = _finished.setdefault(job_id, (loop, asyncio.Event()))
+    deadline = loop.time() + timeout if timeout else None
+    try:
+        while True:
+            job = await run_db(_load, job_id)
+            if job is None or job.status in (DONE, FAILED):
+                return job
+            if deadline is not None and loop.time() >= deadline:
+                raise asyncio.TimeoutError(f"Job {job_id} did not finish in {timeout}s")
+            try:
+                await asyncio.wait_for(event.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        _finished.pop(job_id, None)
+
+
+def new_id() -> str:
+    """Id planned for a row a job will create, stored in its checkpoint before the work starts."""
+    return str(uuid.uuid4())
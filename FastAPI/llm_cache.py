@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from image_store import image_path, store_image
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./llm_cache.db")
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") != "0"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(30 * 24 * 3600)))  # seconds
+
+# Lineage of a thread that has had no messages yet
+FRESH = ""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    texts TEXT NOT NULL,
+    images TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+CREATE TABLE IF NOT EXISTS assistants (
+    assistant_id TEXT PRIMARY KEY,
+    dataset_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    lineage TEXT,
+    pending TEXT NOT NULL DEFAULT '[]'
+);
+"""
+
+
+class LLMCache:
+    """
+    Persistent cache of assistant replies, keyed by the dataset the assistant was built on,
+    the model, the conversation so far in the thread (its lineage) and the prompt.
+
+    A thread's lineage is the key of the last exchange in it, so two threads that received
+    the same prompts over the same dataset share cache entries. Cache hits are not sent to
+    OpenAI; they are queued as `pending` and replayed into the remote thread the next time
+    that thread needs a real run, so the model always sees the full conversation.
+    Threads with unknown history (not created through `register_thread`) are never cached.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 ttl: float = LLM_CACHE_TTL, enabled: bool = LLM_CACHE_ENABLED):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def register_assistant(self, assistant_id: str, dataset_hash: str):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO assistants VALUES (?, ?)", (assistant_id, dataset_hash))
+
+    def register_thread(self, thread_id: str):
+        """Record a newly created, empty thread so its replies can be cached."""
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO threads (thread_id, lineage) VALUES (?, ?)", (thread_id, FRESH))
+
+    def key_for(self, assistant_id: str, thread_id: str, prompt: str, model: str) -> Optional[str]:
+        """Cache key for sending `prompt` next in `thread_id`, or None if the exchange is not cacheable."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            dataset = self.conn.execute("SELECT dataset_hash FROM assistants WHERE assistant_id = ?",
+                                        (assistant_id,)).fetchone()
+            thread = self.conn.execute("SELECT lineage FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+        if not dataset or not thread or thread[0] is None:
+            return None
+        return hashlib.sha256(json.dumps([model, dataset[0], thread[0], prompt]).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[List[str], List[bytes]]]:
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute("SELECT texts, images, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[2] > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.evictions += 1
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        images = []
+        for digest in json.loads(row[1]):
+            try:
+                with open(image_path(digest), "rb") as f:
+                    images.append(f.read())
+            except FileNotFoundError:
+                # The chart is gone from the image store, treat the entry as a miss
+                with self._lock:
+                    self.misses += 1
+                return None
+        with self._lock:
+            self.hits += 1
+        return json.loads(row[0]), images
+
+    def put(self, key: str, texts: List[str], images: List[bytes]):
+        digests = [store_image(image) for image in images]
+        now = time.time()
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                              (key, json.dumps(texts), json.dumps(digests), now, now))
+            self._evict(now)
+
+    def _evict(self, now: float):
+        # Expired entries first, then the least recently used beyond the size limit
+        expired = self.conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)).rowcount
+        overflow = self.conn.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at DESC "
+            "LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+        self.evictions += expired + overflow
+
+    def advance(self, thread_id: str, key: Optional[str], prompt: str = None, texts: List[str] = None):
+        """
+        Move a thread's lineage past an exchange. Passing `prompt` and `texts` marks the
+        exchange as served from cache, to be replayed into the remote thread later.
+        A `key` of None means the exchange bypassed the cache and the thread's history is
+        no longer known.
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT pending FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+            pending = json.loads(row[0]) if row else []
+            if prompt is not None:
+                pending.append({"prompt": prompt, "texts": texts})
+            if key is None:
+                self.bypasses += 1
+            self.conn.execute("INSERT OR REPLACE INTO threads VALUES (?, ?, ?)", (thread_id, key, json.dumps(pending)))
+
+    def take_pending(self, thread_id: str) -> List[dict]:
+        """Pop the cached exchanges that still need to be written into the remote thread."""
+        with self._lock:
+            row = self.conn.execute("SELECT pending FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+            if not row or row[0] == "[]":
+                return []
+            self.conn.execute("UPDATE threads SET pending = '[]' WHERE thread_id = ?", (thread_id,))
+        return json.loads(row[0])
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+llm_cache = LLMCache()
@@ -1,20 +1,49 @@
+import asyncio
 import json
 import multiprocessing
+import os
+import time
 import uuid
 from io import BytesIO
-from typing import BinaryIO, List, Optional
+from typing import BinaryIO, List, Literal, Optional, Tuple
 from uuid import UUID
 from pydantic import BaseModel
 
+import anyio
+import jobs
+import metrics
+import prefetch
+import reduction
+import snapshots
+import tracing
 import uvicorn
-from database import (Hub, Image, Node, NodeResponse, Question, Session,
-                      create_db_and_tables)
-from fastapi import (BackgroundTasks, Depends, FastAPI, File, Form,
-                     HTTPException, Response, UploadFile)
+from database import (API_THREADS, Hub, Image, ImageResponse, Job, Node, NodeResponse, NodeTreeResponse,
+                      Question, QuestionResponse, Session, SessionResponse, create_db_and_tables, run_db, session_scope)
+from events import (BUILDING, COMPLETE, FAILED, KEEPALIVE_SECONDS, STREAM_POLL_MAX_SECONDS, STREAM_POLL_SECONDS,
+                    format_sse, hub_events, node_event)
+from fastapi import (BackgroundTasks, Depends, FastAPI, File, Form, Header,
+                     HTTPException, Query, Request, Response, UploadFile)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from image_store import (image_path, image_response, legacy_image_bytes, pick_variant, run_encode, store_image,
+                         store_variants)
+from llm_cache import llm_cache
+from prefetch import prefetcher
+from scheduler import scheduler
+from search_cache import search_cache
+from singleflight import inflight
+from snapshots import (bump_version, etag, export_rows, import_rows, iter_archive, load_session, not_modified,
+                       not_modified_response, read_archive, session_version, snapshot_format, snapshot_response,
+                       write_archive)
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session as _Session
-from utils import (ExaSearchResponse, create_assistant_for_file, get_db,
-                   l1_init, l2_init, create_level_one_half_node, create_level_one_half_node_prompted)
+from sqlalchemy.orm import selectinload
+from uploads import UploadLimitMiddleware, hash_upload, remove_upload, save_upload
+from utils import (ExaSearchResponse, collect_datasets_forever, get_db,
+                   release_dataset, stream_level_one_half_node, thread_pool)
+from tree import MAX_TREE_DEPTH, ancestors, subtree
+from worker import run_worker
+from consts import LEVEL_ONE_HALF_PROMPT
 
 app = FastAPI()
 
@@ -24,28 +53,91 @@ origins = [
     "http://localhost:3000",
 ]
 
+app.add_middleware(UploadLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
+# Outermost, so the whole request (and the jobs it queues) share its trace
+app.add_middleware(tracing.TraceMiddleware)
+
+# Set on shutdown so the embedded worker hands its running jobs back to the queue; made
+# at startup since an asyncio.Event belongs to the loop that first waits on it
+worker_stop: Optional[asyncio.Event] = None
+
 
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
+    global worker_stop
     create_db_and_tables()
-@app.post("/session/start")
+    # Plain `def` endpoints run on this pool; bound it so their connections fit the engine's pool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = API_THREADS
+    # Periodically remove assistants and files no hub uses anymore
+    asyncio.create_task(collect_datasets_forever())
+    # Create the first assistant threads before any request needs one
+    thread_pool.start()
+    # Run queued jobs in this process too, unless builds are left to `python -m worker` processes
+    if os.getenv("EMBEDDED_WORKER", "1") != "0":
+        worker_stop = asyncio.Event()
+        asyncio.create_task(run_worker(worker_stop))
+    else:
+        # The embedded worker writes this process's spans, without it they are written here
+        asyncio.create_task(tracing.flush_forever())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if worker_stop is not None:
+        worker_stop.set()
+    thread_pool.stop()
+
+
+def enqueue_job(kind: str, hub_id: str, payload: dict, dedup_key: Optional[str] = None) -> str:
+    with session_scope() as db:
+        return jobs.enqueue(db, kind, hub_id, payload, dedup_key).id
+
+
+async def run_job(kind: str, hub_id: str, payload: dict, dedup_key: Optional[str] = None) -> dict:
+    """
+    Enqueue a job (or join the active one with the same `dedup_key`) and wait for a
+    worker to finish it; returns its result.
+    No session is held while waiting, the job may take minutes.
+    """
+    job = await jobs.wait(await run_db(enqueue_job, kind, hub_id, payload, dedup_key))
+    if job is None:
+        # Deleted while it waited, e.g. along with its hub
+        raise HTTPException(status_code=404, detail="Job not found, its hub may have been deleted")
+    if job.status != jobs.DONE:
+        raise HTTPException(status_code=502, detail=job.error or "Job failed")
+    return json.loads(job.result)
+
+@app.post("/session/start", status_code=202)
 async def start_session(
-        background_tasks: BackgroundTasks,
         file: UploadFile = File(...),
         session_id: Optional[UUID] = Form(None),
-        db: _Session = Depends(get_db),
+        mode: Literal["llm", "local"] = Form("llm"),
+        reduce: Optional[bool] = Form(None),
+        row_budget: Optional[int] = Form(None, ge=1),
+        sampling: Optional[Literal["auto", "stratified", "time", "random"]] = Form(None),
+        sample_by: Optional[str] = Form(None),
+        seed: Optional[int] = Form(None),
 ):
     """
     Create a new session and hub, or create a new hub for an existing session.
+    Returns 202 once the file is saved: profiling it, the dataset upload and assistant
+    creation are the first steps of the hub build, whose progress is on `/hubs/{hub_id}/stream`.
     - `file`: The file to be uploaded and associated with the hub.
     - `session_id`: Optional, if provided a new hub is created for the existing session.
+    - `mode`: `llm` (default) builds L1 nodes with the assistant, `local` builds them from the
+      local dataset profile only, with locally rendered charts and no LLM calls.
+    - `reduce`: Upload a reduced copy of the dataset to the assistant (default: REDUCTION_ENABLED), with
+      constant and ID-like columns dropped and at most about `row_budget` rows, sampled per `sampling`
+      (by `sample_by`, with `seed`). The hub keeps the full-data profile and records the reduction.
+      A dataset the reduction does not fit (e.g. `sampling=time` without a date column) fails the build.
 
     Curl:
     curl -X POST "http://127.0.0.1:8001/session/start" \
@@ -53,109 +145,595 @@ async def start_session(
     -H "Content-Type: multipart/form-data"
     """
     file_name = file.filename
-    file_content = file.file.read()  # This reads the binary content of the file
+    # Hash the spooled upload in chunks, never holding the whole bytes
+    content_hash, _ = await hash_upload(file)
+
+    # Find existing session by session_id
+    if session_id and not await run_db(session_exists, str(session_id)):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    # The build job profiles the saved copy (and uploads it to OpenAI) after this request (and its
+    # spooled file) is gone; local builds are durable jobs like LLM builds, so a restart does not lose them
+    hub_id = str(uuid.uuid4())
+    await asyncio.to_thread(save_upload, file.file, hub_id)
+    if mode == "local":
+        new_hub = await run_db(create_hub, session_id, file_name, hub_id=hub_id, build={}, build_kind="l1_local")
+    else:
+        build = {"file_name": file_name, "content_hash": content_hash}
+        if reduce is None:
+            reduce = reduction.REDUCTION_ENABLED
+        if reduce:
+            # Planned by the build from the profile, see utils._prepare_dataset
+            build["reduce"] = {"row_budget": row_budget, "sampling": sampling, "sample_by": sample_by, "seed": seed}
+        new_hub = await run_db(create_hub, session_id, file_name, hub_id=hub_id, build=build)
 
-    if session_id:
-        # Find existing session by session_id
-        existing_session = db.query(Session).filter(Session.id == session_id).first()
-        if not existing_session:
-            raise HTTPException(status_code=404, detail="Session not found")
+    return {
+        "session": new_hub.session_id,
+        "hub": new_hub.id
+    }
 
-        assistant_id, initial_thread = create_assistant_for_file(file_content)
-        new_hub = Hub(file_name=file_name, assistant_id=assistant_id, session_id=session_id)
-        db.add(new_hub)
-        db.commit()
-        background_tasks.add_task(l1_init, new_hub, initial_thread)
-        return {
-            "session": session_id,
-            "hub": new_hub.id
-        }
-    else:
-        # Create a new session and associate a new hub with it
-        new_session = Session()
-        assistant_id, initial_thread = create_assistant_for_file(file_content)
-        new_hub = Hub(file_name=file_name, assistant_id=assistant_id, session=new_session)
-        db.add(new_session)
+
+def session_exists(session_id: str) -> bool:
+    with session_scope() as db:
+        return db.query(Session.id).filter(Session.id == session_id).first() is not None
+
+
+def create_hub(session_id: Optional[UUID], file_name: str, hub_id: Optional[str] = None, build: Optional[dict] = None, build_kind: str = "l1") -> Hub:
+    """
+    Create the hub (and its session, unless it joins `session_id`) and, given a `build`
+    payload, enqueue its `build_kind` build job; runs on the DB executor.
+    """
+    with session_scope() as db:
+        if session_id:
+            session = db.get(Session, str(session_id))
+            bump_version(db, session_id=session.id)
+        else:
+            # Create a new session and associate a new hub with it
+            session = Session()
+            db.add(session)
+        new_hub = Hub(id=hub_id or str(uuid.uuid4()), file_name=file_name, session=session)
         db.add(new_hub)
-        db.commit()
-        background_tasks.add_task(l1_init, new_hub, initial_thread)
-        return {
-            "session": new_session.id,
-            "hub": new_hub.id
-        }
+        db.flush()
+        if build is not None:
+            # The build is a durable job, it survives API restarts and resumes from its last node
+            jobs.enqueue(db, build_kind, new_hub.id, build)
+        db.refresh(new_hub)
+        return new_hub
+
+
+@app.get("/sessions/{session_id}", response_model=SessionResponse)
+async def get_session(
+        session_id: str,
+        format: Optional[Literal["json", "msgpack"]] = None,
+        accept: Optional[str] = Header(None),
+        accept_encoding: Optional[str] = Header(None),
+        if_none_match: Optional[str] = Header(None),
+):
+    """
+    The whole session in one response: its hubs with their nodes, questions and images.
+    - `format`: `msgpack` for a msgpack body, which `Accept: application/msgpack` also selects; JSON by default.
 
+    The weak ETag changes whenever the session does, so a client sending it back in
+    `If-None-Match` gets a 304 until then. Bodies are gzip or brotli compressed as
+    Accept-Encoding allows.
+    """
+    fmt = snapshot_format(format, accept)
+    if fmt == "msgpack" and snapshots.msgpack is None:
+        raise HTTPException(status_code=406, detail="msgpack is not installed on this server")
+    version = await run_db(session_version, session_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if not_modified(if_none_match, etag(version, fmt)):
+        return not_modified_response(etag(version, fmt))
+
+    loaded = await run_db(load_session, session_id)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    # The session may have changed since the version was read, the ETag is the loaded one's
+    version, snapshot = loaded
+    # Encoding and compressing a large session takes a while, keep it off the event loop
+    return await asyncio.to_thread(snapshot_response, snapshot, etag(version, fmt), fmt, accept_encoding)
+
+
+@app.get("/sessions/{session_id}/export")
+async def export_session(session_id: str):
+    """
+    The session as a zip archive for `/sessions/import`: its hubs, nodes, questions and
+    images, with the chart files and their variants.
+    """
+    manifest = await run_db(export_rows, session_id)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    archive = await asyncio.to_thread(write_archive, manifest)
+    return StreamingResponse(iter_archive(archive), media_type="application/zip",
+                             headers={"Content-Disposition": f'attachment; filename="session-{session_id}.zip"'})
 
 
-@app.get("/question/{question_id}", response_model=NodeResponse)
-async def answer_question(question_id: str, db: _Session = Depends(get_db)):
+@app.post("/sessions/import", status_code=201)
+async def import_session(file: UploadFile = File(...)):
     """
-    Get the question and answer for a specific node.
+    Restore a session from an `/sessions/{session_id}/export` archive as a new session,
+    without running the pipeline. Returns the new session's id and hub ids.
+    Hubs whose dataset this server does not know can be browsed but not asked further questions.
     """
+    try:
+        manifest = await asyncio.to_thread(read_archive, file.file)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid session archive: {e}")
+    return await run_db(import_rows, manifest)
 
-    question = db.query(Question).filter(Question.id == question_id).first()
-    if not question:
-        raise HTTPException(status_code=404, detail="Question not found")
 
-    prev_node = db.query(Node).filter(Node.id == question.node_id).first()
-    if not prev_node:
-        raise HTTPException(status_code=404, detail="Node not found")
+def stream_answer(key: tuple, node_id: str, prompt: str, message: str,
+                  question_id: Optional[str] = None) -> StreamingResponse:
+    """
+    Server-sent events for an answer as it is generated: `text` deltas, `code` and
+    `code_output` from the Code Interpreter, `image` and `status` progress, then the
+    finished `node` (or an `error`). A second request for the same `key` while the
+    answer is generated follows the same generation, from its first event.
+    """
+    async def event_stream():
+        try:
+            events = inflight.stream(key, lambda: stream_level_one_half_node(node_id, prompt, message, question_id))
+            async for event, data in events:
+                yield format_sse(event, data)
+        except Exception as e:
+            print(f"Streaming answer for node {node_id} failed: {e}")
+            yield format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
-    new_node = create_level_one_half_node(question, prev_node)
-    return new_node
+def stream_stored(node: NodeResponse) -> StreamingResponse:
+    """An answer generated before, as the `node` event a streaming client waits for."""
+    async def event_stream():
+        yield format_sse("node", node.model_dump())
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/question/{question_id}", response_model=NodeResponse)
+async def answer_question(question_id: str, background_tasks: BackgroundTasks, stream: bool = False,
+                          refresh: bool = False):
+    """
+    Get the question and answer for a specific node.
+
+    The answer is generated once and returned as is by later requests; `?refresh=true`
+    generates a new one. With `?stream=true` the answer is sent as server-sent events
+    while it is generated. Suggested questions may have been answered ahead of the
+    request (see prefetch.py), or be in the middle of it, which the request then joins.
+    """
+    while True:
+        answer = await _answer_question(question_id, background_tasks, stream, refresh)
+        if answer is not None:
+            return answer
+        # The joined prefetch gave up (e.g. the question was answered by a stream meanwhile), ask again
+
+
+async def _answer_question(question_id: str, background_tasks: BackgroundTasks, stream: bool, refresh: bool):
+    # One attempt of answer_question; None when the prefetch it joined gave up without an answer
+    content, node_id, hub_id, answer_node_id, prefetched = await run_db(question_target, question_id)
+    await prefetcher.touch(hub_id)
+
+    if answer_node_id and not refresh:
+        stored = await run_db(load_nodes, [answer_node_id])
+        if stored:
+            if prefetched and await run_db(prefetch.served, question_id):
+                prefetcher.record(prefetch.HIT)
+                # The user reads this answer now, its questions are the likely next clicks
+                background_tasks.add_task(prefetcher.schedule, hub_id, stored[0].model_dump())
+            return stream_stored(stored[0]) if stream else stored[0]
+
+    joined = False
+    if prefetch.PREFETCH_ENABLED and not refresh:
+        joined = await run_db(prefetch.is_prefetching, question_id)
+        prefetcher.record(prefetch.JOINED if joined else prefetch.MISS)
+        if joined:
+            prefetcher.promote(question_id)
+
+    prompt = content + LEVEL_ONE_HALF_PROMPT
+    # A running prefetch is waited for rather than streamed, it is already past its first events
+    if stream and not joined:
+        return stream_answer(("question-stream", question_id), node_id, prompt, prompt, question_id)
+
+    result = await inflight.do(("question", question_id), lambda: run_job("question", hub_id, {
+        "node_id": node_id, "prompt": prompt, "message": prompt, "answer_node_id": jobs.new_id(),
+        "question_id": question_id}, dedup_key=prefetch.dedup_key(question_id)))
+    if "node_id" not in result:
+        return None
+    if joined:
+        # Served now, so it does not count as a hit later as well
+        await run_db(prefetch.served, question_id)
+    node = (await run_db(load_nodes, [result["node_id"]]))[0]
+    return stream_stored(node) if stream else node
+
+
+def question_target(question_id: str) -> Tuple[str, str, str, Optional[str], bool]:
+    with session_scope() as db:
+        question = db.query(Question).filter(Question.id == question_id).first()
+        if not question:
+            raise HTTPException(status_code=404, detail="Question not found")
+
+        prev_node = db.query(Node).filter(Node.id == question.node_id).first()
+        if not prev_node:
+            raise HTTPException(status_code=404, detail="Node not found")
+        return question.content, prev_node.id, prev_node.hub_id, question.answer_node_id, bool(question.prefetched)
+
+
+def node_hub_id(node_id: str) -> str:
+    with session_scope() as db:
+        node = db.query(Node.hub_id).filter(Node.id == node_id).first()
+        if not node:
+            raise HTTPException(status_code=404, detail="Node not found")
+        return node.hub_id
+
+
+def load_nodes(node_ids: List[str]) -> List[NodeResponse]:
+    """Serialized nodes in the order of `node_ids`; runs on the DB executor."""
+    with session_scope() as db:
+        nodes = {node.id: node for node in
+                 db.query(Node).filter(Node.id.in_(node_ids)).options(*node_load_options())}
+        return [NodeResponse.model_validate(nodes[node_id], from_attributes=True)
+                for node_id in node_ids if node_id in nodes]
 
 
 class QuestionRequest(BaseModel):
     prompt: str
 @app.post("/question/from/{node_id}", response_model=NodeResponse)
-async def answer_question(node_id: str, request: QuestionRequest, db: _Session = Depends(get_db)):
+async def ask_question(node_id: str, request: QuestionRequest, stream: bool = False):
     """
     Get the question and answer for a specific node.
+
+    With `?stream=true` the answer is sent as server-sent events while it is generated.
     """
 
     prompt = request.prompt
 
-    prev_node = db.query(Node).filter(Node.id == node_id).first()
-    if not prev_node:
-        raise HTTPException(status_code=404, detail="Node not found")
+    hub_id = await run_db(node_hub_id, node_id)
+    await prefetcher.touch(hub_id)
+
+    # Free-form questions are not stored, only identical ones in flight are answered once
+    if stream:
+        return stream_answer(("ask-stream", node_id, prompt), node_id, prompt, prompt + LEVEL_ONE_HALF_PROMPT)
+
+    result = await inflight.do(("ask", node_id, prompt), lambda: run_job("question", hub_id, {
+        "node_id": node_id, "prompt": prompt, "message": prompt + LEVEL_ONE_HALF_PROMPT,
+        "answer_node_id": jobs.new_id()}))
+    return (await run_db(load_nodes, [result["node_id"]]))[0]
+
+MAX_PAGE_SIZE = 500
+NODE_FIELDS = set(NodeResponse.model_fields)
+
+
+def node_load_options(fields=NODE_FIELDS):
+    """
+    Bulk-load the relationships NodeResponse serializes (one SELECT each instead of one
+    per node), and only the image columns the response needs, never the payload.
+    """
+    options = []
+    if "images" in fields:
+        options.append(selectinload(Node.images).load_only(
+            Image.id, Image.url, Image.width, Image.height, Image.derivatives))
+    if "questions" in fields:
+        options.append(selectinload(Node.questions).load_only(Question.id, Question.content))
+    return options
+
+
+def query_hub_nodes(db: _Session, hub_id: str, since: Optional[str] = None, fields=NODE_FIELDS):
+    """
+    Nodes of a hub in creation order, optionally only those created after the `since` node.
+    """
+    query = db.query(Node).filter(Node.hub_id == hub_id).options(*node_load_options(fields))
+    if since:
+        cursor = db.query(Node.created_at, Node.id).filter(Node.id == since, Node.hub_id == hub_id).first()
+        if not cursor:
+            raise HTTPException(status_code=400, detail="Unknown since cursor")
+        query = query.filter(or_(
+            Node.created_at > cursor.created_at,
+            and_(Node.created_at == cursor.created_at, Node.id > cursor.id),
+        ))
+    return query.order_by(Node.created_at, Node.id)
+
+
+def sparse_node(node: Node, fields) -> dict:
+    """Serialize only the requested NodeResponse fields of a node."""
+    data = {field: getattr(node, field) for field in fields}
+    if "images" in data:
+        data["images"] = [ImageResponse.model_validate(image, from_attributes=True).model_dump()
+                          for image in data["images"]]
+    if "questions" in data:
+        data["questions"] = [QuestionResponse.model_validate(question, from_attributes=True).model_dump()
+                             for question in data["questions"]]
+    return data
 
-    new_node = create_level_one_half_node_prompted(prompt, prev_node)
-    return new_node
 
 @app.get("/hubs/{hub_id}/nodes", response_model=List[NodeResponse])
-async def get_hub_nodes(hub_id: str, db: _Session = Depends(get_db)):
+def get_hub_nodes(
+        hub_id: str,
+        response: Response,
+        since: Optional[str] = None,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        fields: Optional[str] = None,
+        db: _Session = Depends(get_db),
+):
     """
     Get all nodes for the given hub ID.
+    - `since`: Optional node ID, only nodes created after it are returned (for reconnecting clients).
+    - `limit`: Optional page size. When the page is full, `X-Next-Cursor` holds the `since` value for the next page.
+    - `fields`: Optional comma-separated subset of NodeResponse fields, e.g. `id,title,parent_node_id`.
     """
-    print(hub_id)
+    selected = NODE_FIELDS
+    if fields:
+        selected = {field.strip() for field in fields.split(",") if field.strip()} | {"id"}
+        unknown = selected - NODE_FIELDS
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
     # Fetch the hub by hub_id
+    if not db.query(Hub.id).filter(Hub.id == hub_id).first():
+        raise HTTPException(status_code=404, detail="Hub not found")
+
+    # Fetch the nodes associated with this hub, one page at a time if asked to
+    query = query_hub_nodes(db, hub_id, since, selected)
+    if limit:
+        query = query.limit(limit)
+    nodes = query.all()
+
+    headers = {}
+    if limit and len(nodes) == limit:
+        headers["X-Next-Cursor"] = nodes[-1].id
+
+    if fields:
+        # Sparse mode bypasses the full response model
+        return JSONResponse([sparse_node(node, selected) for node in nodes], headers=headers)
+
+    response.headers.update(headers)
+    # Serialize and return the nodes
+    return nodes
+
+@app.delete("/hubs/{hub_id}", status_code=204)
+def delete_hub(hub_id: str, db: _Session = Depends(get_db)):
+    """
+    Delete a hub with its nodes, and release its reference on the shared assistant.
+    """
     hub = db.query(Hub).filter(Hub.id == hub_id).first()
+    if not hub:
+        raise HTTPException(status_code=404, detail="Hub not found")
 
+    node_ids = db.query(Node.id).filter(Node.hub_id == hub_id)
+    db.query(Image).filter(Image.node_id.in_(node_ids)).delete(synchronize_session=False)
+    db.query(Question).filter(Question.node_id.in_(node_ids)).delete(synchronize_session=False)
+    db.query(Node).filter(Node.hub_id == hub_id).delete(synchronize_session=False)
+    tracing.delete_hub_spans(db, hub_id)
+    release_dataset(db, hub.dataset_hash)
+    bump_version(db, session_id=hub.session_id)
+    db.delete(hub)
+    db.commit()
+    # Dataset saved for a build that never uploaded it
+    remove_upload(hub_id)
+    return Response(status_code=204)
+
+@app.get("/hubs/{hub_id}/status")
+def get_hub_status(hub_id: str, db: _Session = Depends(get_db)):
+    """
+    Progress of the hub's jobs: the L1 build and any L2 expansions, questions or prefetches,
+    with the nodes each one has saved so far out of the nodes it planned.
+    """
+    hub = db.get(Hub, hub_id)
     if not hub:
         raise HTTPException(status_code=404, detail="Hub not found")
 
-    # Fetch all nodes associated with this hub
-    nodes = db.query(Node).filter(Node.hub_id == hub_id).all()
+    hub_jobs = db.query(Job).filter(Job.hub_id == hub_id).order_by(Job.created_at).all()
+    def planned_nodes(job: Job) -> list:
+        # Builds plan their node ids in the checkpoint, a question plans its answer node up front
+        checkpoint = json.loads(job.checkpoint) if job.checkpoint else {}
+        payload = json.loads(job.payload) if job.payload else {}
+        return checkpoint.get("node_ids") or ([payload["answer_node_id"]] if "answer_node_id" in payload else [])
 
-    # If no nodes are found, return an empty list
-    if not nodes:
-        nodes = []
+    planned = {job.id: planned_nodes(job) for job in hub_jobs}
+    planned_ids = [node_id for node_ids in planned.values() for node_id in node_ids]
+    saved = {node_id for (node_id,) in db.query(Node.id).filter(Node.id.in_(planned_ids))} if planned_ids else set()
+
+    def describe(job: Job) -> dict:
+        return {
+            "id": job.id,
+            "kind": job.kind,
+            "status": job.status,
+            "attempts": job.attempts,
+            "nodes_done": sum(node_id in saved for node_id in planned[job.id]),
+            "nodes_total": len(planned[job.id]),
+            "error": job.error,
+            "created_at": job.created_at.isoformat() if job.created_at else None,
+            "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+        }
+
+    build = next((job for job in reversed(hub_jobs) if job.kind in jobs.BUILD_KINDS), None)
+    return {
+        "hub_id": hub_id,
+        "status": build.status if build else (hub_events.status(hub_id) or {}).get("status"),
+        "build": describe(build) if build else None,
+        "jobs": [describe(job) for job in hub_jobs],
+        "nodes": db.query(Node).filter(Node.hub_id == hub_id).count(),
+    }
+
+
+@app.get("/hubs/{hub_id}/timings")
+async def get_hub_timings(hub_id: str):
+    """
+    Where the hub's time went, across its build, expansions and answers: time and
+    count per stage (assistant runs and their slot waits, message fetches, image
+    downloads, Exa searches, DB commits, ...), token usage, the slowest spans and
+    the failed ones. Spans from other worker processes arrive within TRACE_FLUSH_INTERVAL.
+    """
+    if not await run_db(hub_exists, hub_id):
+        raise HTTPException(status_code=404, detail="Hub not found")
+    # Include this process's spans not written yet
+    await tracing.flush()
+    return await run_db(tracing.hub_timings, hub_id)
+
+
+def hub_exists(hub_id: str) -> bool:
+    with session_scope() as db:
+        return db.query(Hub.id).filter(Hub.id == hub_id).first() is not None
+
+
+@app.get("/hubs/{hub_id}/stream")
+async def stream_hub_nodes(
+        hub_id: str,
+        request: Request,
+        since: Optional[str] = None,
+        last_event_id: Optional[str] = Header(None),
+):
+    """
+    Server-sent events for a hub: one `node` event per node as it is committed, and a
+    `status` event when the build starts, completes or fails.
+    - `since`: Optional node ID, nodes created after it are replayed first. Browsers
+      reconnecting an EventSource send the same cursor as the `Last-Event-ID` header.
+
+    Curl:
+    curl -N "http://127.0.0.1:8001/hubs/<hub_id>/stream"
+    """
+    await prefetcher.touch(hub_id)
+    # Subscribe before reading the backlog so nothing committed in between is lost
+    queue = hub_events.subscribe(hub_id)
+    cursor = since or last_event_id
+    try:
+        status, nodes = await run_db(hub_updates, hub_id, cursor)
+    except HTTPException:
+        hub_events.unsubscribe(hub_id, queue)
+        raise
+    cursor = nodes[-1]["id"] if nodes else cursor
+
+    async def event_stream():
+        # Events of a build in this process are sent as they come; a hub built by a separate
+        # worker is polled from the database instead, backing off while nothing changes.
+        # Only polled nodes move the cursor, so a poll never skips a node committed out of order
+        nonlocal cursor, status, nodes
+        sent, sent_status, last_sent = set(), None, time.monotonic()
+        delay = STREAM_POLL_SECONDS
+        try:
+            while True:
+                for node in nodes:
+                    if node["id"] in sent:
+                        continue
+                    sent.add(node["id"])
+                    last_sent = time.monotonic()
+                    yield format_sse("node", node, node["id"])
+                if status and status != sent_status:
+                    sent_status, last_sent = status, time.monotonic()
+                    yield format_sse("status", status)
+                    if status["status"] in (COMPLETE, FAILED):
+                        return
+
+                nodes, local = [], hub_events.building(hub_id)
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS if local else delay)
+                except asyncio.TimeoutError:
+                    event = None
+                if await request.is_disconnected():
+                    return
+                if time.monotonic() - last_sent >= KEEPALIVE_SECONDS:
+                    last_sent = time.monotonic()
+                    yield ": keepalive\n\n"
+                if event == "node":
+                    nodes, delay = [data], STREAM_POLL_SECONDS
+                elif event == "status":
+                    status, delay = data, STREAM_POLL_SECONDS
+                elif not local:
+                    polled_status, nodes = await run_db(hub_updates, hub_id, cursor)
+                    changed = nodes or polled_status != status
+                    delay = STREAM_POLL_SECONDS if changed else min(delay * 2, STREAM_POLL_MAX_SECONDS)
+                    status, cursor = polled_status, nodes[-1]["id"] if nodes else cursor
+        finally:
+            hub_events.unsubscribe(hub_id, queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def hub_updates(hub_id: str, since: Optional[str]) -> Tuple[Optional[dict], List[dict]]:
+    """The hub's build status and the nodes created after `since`; runs on the DB executor."""
+    with session_scope() as db:
+        if not db.query(Hub.id).filter(Hub.id == hub_id).first():
+            raise HTTPException(status_code=404, detail="Hub not found")
+        # Status first: nodes are committed before their build finishes, so none are missed
+        status = build_status(db, hub_id)
+        return status, [node_event(node) for node in query_hub_nodes(db, hub_id, since)]
+
+
+def build_status(db: _Session, hub_id: str) -> Optional[dict]:
+    """The hub's build state from its latest build job, or as last published here for hubs without one."""
+    build = db.query(Job).filter(Job.hub_id == hub_id, Job.kind.in_(jobs.BUILD_KINDS)) \
+        .order_by(Job.created_at.desc()).first()
+    if build is None:
+        return hub_events.status(hub_id)
+    state = {jobs.DONE: COMPLETE, jobs.FAILED: FAILED}.get(build.status, BUILDING)
+    return {"hub_id": hub_id, "status": state, "detail": build.error if state == FAILED else None}
+
+
+@app.get("/nodes/{node_id}/subtree", response_model=NodeTreeResponse)
+def get_node_subtree(
+        node_id: str,
+        depth: Optional[int] = Query(None, ge=0, le=MAX_TREE_DEPTH),
+        db: _Session = Depends(get_db),
+):
+    """
+    The node and its descendants as a nested tree, in one query.
+    - `depth`: Optional number of levels below the node to include (0 is the node alone).
+    """
+    root = subtree(db, node_id, depth)
+    if root is None:
+        raise HTTPException(status_code=404, detail="Node not found")
+    return root
+
+
+@app.get("/nodes/{node_id}/ancestors", response_model=List[NodeResponse])
+def get_node_ancestors(node_id: str, db: _Session = Depends(get_db)):
+    """
+    The nodes from the root of the node's tree down to its parent, in one query.
+    """
+    path = ancestors(db, node_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Node not found")
+    return path
+
+
+def l2_expansion(node_id: str) -> Tuple[str, List[str]]:
+    """The node's hub and the ids of the L2 nodes it was expanded into, if the expansion finished."""
+    with session_scope() as db:
+        node = db.query(Node.hub_id).filter(Node.id == node_id).first()
+        if not node:
+            raise HTTPException(status_code=404, detail="Node not found")
+        if jobs.active(db, f"l2:{node_id}") is not None:
+            # Children saved so far are a partial expansion, the caller joins the job instead
+            return node.hub_id, []
+        children = (db.query(Node.id).filter(Node.parent_node_id == node_id)
+                    .order_by(Node.created_at, Node.id).all())
+        return node.hub_id, [child_id for (child_id,) in children]
 
-    # Serialize and return the nodes
-    return nodes
 
 @app.get("/l2nodes/{l1_node_id}", response_model=List[NodeResponse])
-async def create_level_two_node(l1_node_id: str, db: _Session = Depends(get_db)):
+async def create_level_two_node(l1_node_id: str, refresh: bool = False):
     """
     Create a new level two node and return the response.
+
+    A node is expanded once: later requests get the same L2 nodes back, and requests
+    made while the expansion runs wait for it. `?refresh=true` expands it again from
+    new sources.
     """
     # Retrieve the L1 node from the database
-    l1_node = db.get(Node, l1_node_id)
+    hub_id, existing = await run_db(l2_expansion, l1_node_id)
+    await prefetcher.touch(hub_id)
 
     # FOR DEBUGGING:
     # l1_node = db.query(Node).filter(Node.parent_node_id == None).first()
 
-    response = l2_init(l1_node.hub, l1_node)
-    nodes = db.query(Node).filter(Node.id.in_(response)).all()
+    if existing and not refresh:
+        return await run_db(load_nodes, existing)
+
+    result = await inflight.do(("l2", l1_node_id), lambda: run_job(
+        "l2", hub_id, {"node_id": l1_node_id}, dedup_key=f"l2:{l1_node_id}"))
+    nodes = await run_db(load_nodes, result["node_ids"])
 
     # Serialize and return the nodes
     return nodes
@@ -168,9 +746,10 @@ async def runfull():
     process.start()
 
 # FOR DEBUGGING
-def run_utils_main( db: Session = next(get_db())):
+def run_utils_main():
     import requests
-    single_node = db.query(Node).filter(Node.parent_node_id == None).first()
+    with session_scope() as db:
+        single_node = db.query(Node).filter(Node.parent_node_id == None).first()
     response = requests.post(f"http://localhost:8000/l2nodes", params={"l1_node_id": single_node.id})
     if response.status_code == 200:
         print("L2 node created successfully:", response.json())
@@ -179,21 +758,87 @@ def run_utils_main( db: Session = next(get_db())):
     return
 
 
+@app.get("/cache/stats")
+def get_cache_stats():
+    """
+    Hit/miss counters and size of the LLM response cache, of the Exa search cache under
+    `search`, of the pool of ready assistant threads under `threads`, and the share of
+    question requests answered ahead of time under `prefetch`.
+    """
+    return {**llm_cache.stats(), "search": search_cache.stats(), "threads": thread_pool.stats(),
+            "prefetch": prefetcher.stats()}
+
+
+@app.get("/stats")
+async def get_stats():
+    """
+    Pipeline counters (e.g. structured-output repairs per stage), gauges such as the
+    scheduler's queue depth per priority, and the scheduler's current budgets.
+    """
+    return {"counters": metrics.counters(), "gauges": metrics.gauges(), "scheduler": scheduler.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Counters, gauges and histograms (span and request durations) of this process in
+    the Prometheus text format; worker processes keep their own.
+    """
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/images/{image_id}")
-async def get_image(image_id: str, db: Session = Depends(get_db)):
+def get_image(
+        image_id: str,
+        w: Optional[int] = Query(None, gt=0, description="Serve the narrowest variant at least this wide"),
+        format: Optional[Literal["avif", "webp", "png"]] = Query(None, description="Serve this format rather than negotiating it through Accept"),
+        range: Optional[str] = Header(None),
+        if_none_match: Optional[str] = Header(None),
+        accept: Optional[str] = Header(None),
+        db: Session = Depends(get_db),
+):
+    """
+    A chart: the original, or with `w` and/or `format` (or an Accept header naming
+    image/avif or image/webp) the thumbnail or modern-format variant that fits best.
+    """
     # Fetch the image from the database
     image = read_image_from_db(image_id, db)
-    if image:
-        # If the image data is in hex format, convert it to binary
-        if isinstance(image.data, str) and image.data.startswith("0x"):
-            image_data = bytes.fromhex(image.data[2:])  # Remove "0x" and convert hex to binary
-        else:
-            image_data = image.data  # Already binary data
-
-        return Response(content=image_data, media_type="image/png")
-    else:
+    if not image:
         raise HTTPException(status_code=404, detail="Image not found")
 
+    if not image.sha256:
+        # Move a legacy inline payload into the image store the first time it is served
+        image_data = legacy_image_bytes(image.data)
+        if image_data is None:
+            raise HTTPException(status_code=404, detail="Image has no data")
+        image.sha256 = store_image(image_data)
+        image.size = len(image_data)
+        image.data = None
+        if image.node is not None:
+            bump_version(db, hub_id=image.node.hub_id)
+        db.commit()
+
+    if image.derivatives is None:
+        # Images stored before variants existed get theirs the first time they are served, encoded on
+        # the bounded encoder threads like those of new charts (this handler runs on an API thread)
+        variants = anyio.from_thread.run(run_encode, make_variants, image.sha256)
+        image.width, image.height = variants["width"], variants["height"]
+        image.derivatives = json.dumps(variants["variants"])
+        # The image's thumbnail_url and variants in its session's snapshot change
+        if image.node is not None:
+            bump_version(db, hub_id=image.node.hub_id)
+        db.commit()
+
+    variant = pick_variant(json.loads(image.derivatives), image.width, w, format, accept)
+    # Without an explicit format the response depends on Accept, so caches must key on it
+    return image_response(image.sha256, image.media_type or "image/png", range, if_none_match, variant,
+                          vary=format is None)
+
+
+def make_variants(digest: str) -> dict:
+    with open(image_path(digest), "rb") as f:
+        return store_variants(digest, f.read())
+
 
 def read_image_from_db(image_id: str, db: Session) -> Image:
     """Read the image from the database by its ID."""
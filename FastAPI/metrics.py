@@ -0,0 +1,102 @@
+import bisect
+import threading
+from collections import Counter
+from typing import Dict, List, Sequence, Tuple
+
+# Upper bounds in seconds: spans range from cache lookups and commits to multi-minute runs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_counters: Counter = Counter()
+_gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+# Per histogram: its bucket bounds, the count in each bucket (plus +Inf), sum and count
+_histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], list] = {}
+
+
+def _key(name: str, labels: Dict[str, str]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def incr(name: str, amount: float = 1, **labels):
+    """Add `amount` to the counter `name` with the given labels."""
+    with _lock:
+        _counters[_key(name, labels)] += amount
+
+
+def counters() -> List[dict]:
+    """Current value of every counter, one entry per name and label set."""
+    with _lock:
+        items = list(_counters.items())
+    return [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(items)]
+
+
+def gauge(name: str, value: float, **labels):
+    """Set the gauge `name` with the given labels to `value`."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def gauges() -> List[dict]:
+    """Current value of every gauge, one entry per name and label set."""
+    with _lock:
+        items = list(_gauges.items())
+    return [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(items)]
+
+
+def observe(name: str, value: float, buckets: Sequence[float] = DEFAULT_BUCKETS, **labels):
+    """Add `value` to the histogram `name` with the given labels."""
+    with _lock:
+        histogram = _histograms.get(_key(name, labels))
+        if histogram is None:
+            histogram = _histograms[_key(name, labels)] = [tuple(buckets), [0] * (len(buckets) + 1), 0.0, 0]
+        histogram[1][bisect.bisect_left(histogram[0], value)] += 1
+        histogram[2] += value
+        histogram[3] += 1
+
+
+def histograms() -> List[dict]:
+    """Bucket counts (not cumulative), sum and count of every histogram."""
+    with _lock:
+        items = [(key, (bounds, list(counts), total, count)) for key, (bounds, counts, total, count) in _histograms.items()]
+    return [{"name": name, "labels": dict(labels), "buckets": dict(zip([*bounds, "+Inf"], counts)),
+             "sum": total, "count": count}
+            for (name, labels), (bounds, counts, total, count) in sorted(items)]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, str], **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def render_prometheus() -> str:
+    """Every counter, gauge and histogram in the Prometheus text exposition format."""
+    lines = []
+    typed = set()
+
+    def header(name: str, kind: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for entry in counters():
+        header(entry["name"], "counter")
+        lines.append(f"{entry['name']}{_labels(entry['labels'])} {entry['value']}")
+    for entry in gauges():
+        header(entry["name"], "gauge")
+        lines.append(f"{entry['name']}{_labels(entry['labels'])} {entry['value']}")
+    for entry in histograms():
+        name, labels = entry["name"], entry["labels"]
+        header(name, "histogram")
+        cumulative = 0
+        for bound, count in entry["buckets"].items():
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {entry['sum']}")
+        lines.append(f"{name}_count{_labels(labels)} {entry['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,85 @@
+"""
+Schema migrations for databases created by an older version of the app.
+
+`create_all` only creates missing tables, so columns and indexes added to existing
+tables are applied here: each migration runs once per database, in order, and the
+last applied version is recorded in the `schema_version` table. Migrations must be
+safe on a database that `create_all` just created with the current schema.
+
+To change the schema, update the models in database.py and append a migration.
+"""
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+from database import Base
+
+_meta = MetaData()
+schema_version = Table(
+    "schema_version", _meta,
+    Column("version", Integer, primary_key=True),
+    Column("name", String),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+
+def _add_missing_columns(connection: Connection):
+    # Columns added to the models since the tables were first created (image store
+    # digests, node cursors, dataset references, ...); all of them are nullable
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+def _create_indexes(*names: str) -> Callable[[Connection], None]:
+    def create(connection: Connection):
+        indexes = {index.name: index for table in Base.metadata.sorted_tables for index in table.indexes}
+        for name in names:
+            indexes[name].create(connection, checkfirst=True)
+    return create
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "add columns added since the first schema", _add_missing_columns),
+    (2, "index foreign keys and tree walks", _create_indexes(
+        "ix_nodes_hub_created", "ix_nodes_parent_created", "ix_questions_node_id",
+        "ix_images_node_id", "ix_hubs_session_id")),
+    (3, "add nodes.source_url", _add_missing_columns),
+    (4, "index hub sources", _create_indexes("ix_nodes_hub_source")),
+    (5, "add questions.answer_node_id and jobs.dedup_key", _add_missing_columns),
+    (6, "unique key of active jobs", _create_indexes("ix_jobs_active_dedup")),
+    (7, "add images.width, images.height and images.derivatives", _add_missing_columns),
+    (8, "add sessions.last_active_at and questions.prefetched", _add_missing_columns),
+    (9, "add sessions.version", _add_missing_columns),
+    (10, "add hubs.reduction", _add_missing_columns),
+]
+
+
+def migrate(engine: Engine) -> int:
+    """Apply the migrations this database has not had yet; returns how many ran."""
+    _meta.create_all(bind=engine)
+    applied = 0
+    for version, name, apply in MIGRATIONS:
+        # One transaction per migration, so a failed one is retried on the next start
+        try:
+            with engine.begin() as connection:
+                if connection.execute(select(schema_version.c.version)
+                                      .where(schema_version.c.version == version)).first():
+                    continue
+                print(f"Applying migration {version}: {name}")
+                apply(connection)
+                connection.execute(schema_version.insert().values(version=version, name=name))
+                applied += 1
+        except IntegrityError:
+            # The API and a worker started together and the other one recorded it first
+            continue
+    return applied
@@ -0,0 +1,181 @@
+"""
+Speculative answers to suggested questions. Once a node and its questions are saved,
+the first PREFETCH_PER_NODE questions are queued as `prefetch` jobs, which answer them
+exactly as a click would (see utils.run_prefetch_job) and store the answer on the
+question, so `GET /question/{question_id}` returns it at once.
+
+Prefetches never compete with work a user is waiting for: their jobs are claimed
+after every other kind, their runs only get the scheduler's spare budget (see
+PREFETCH_RESERVE). A click on a question joins its prefetch: a queued one becomes a
+question job, a running one goes on at question priority. Budgets cap the prefetches queued per session and
+in flight overall, and a session idle for PREFETCH_IDLE_SECONDS gets no more: its
+queued prefetches are skipped and a running one stops before its follow-up runs.
+
+Off unless PREFETCH_ENABLED=1. Hit rates are on /cache/stats under `prefetch`.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import jobs
+import metrics
+from consts import LEVEL_ONE_HALF_PROMPT
+from database import Hub, Job, Question, Session, run_db, session_scope
+from scheduler import INTERACTIVE, PREFETCH, priority_context, scheduler
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "0") != "0"
+PREFETCH_PER_NODE = int(os.getenv("PREFETCH_PER_NODE", "1"))  # suggested questions answered ahead per node
+PREFETCH_PER_SESSION = int(os.getenv("PREFETCH_PER_SESSION", "10"))  # prefetches queued per session, ever
+PREFETCH_MAX_ACTIVE = int(os.getenv("PREFETCH_MAX_ACTIVE", "32"))  # prefetches queued or running, all sessions
+PREFETCH_IDLE_SECONDS = float(os.getenv("PREFETCH_IDLE_SECONDS", "300"))
+TOUCH_INTERVAL = 30  # seconds between writes of one hub's session activity from this process
+
+HIT, JOINED, MISS = "hit", "joined", "miss"
+
+
+def dedup_key(question_id: str) -> str:
+    # Shared with the question endpoint, so a click joins the prefetch of the same question
+    return f"question:{question_id}"
+
+
+def _owner(question_id: str) -> str:
+    # Each prefetch is its own scheduler owner, so the one a user joins can be promoted alone
+    return f"prefetch:{question_id}"
+
+
+class Prefetcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._touched: Dict[str, float] = {}
+        self._running = set()  # questions whose prefetch runs in this process
+        self.requests = {HIT: 0, JOINED: 0, MISS: 0}
+
+    @contextmanager
+    def running(self, question_id: str):
+        """Run the enclosed calls as the prefetch of the question, at prefetch priority until promoted."""
+        owner = _owner(question_id)
+        self._running.add(question_id)
+        try:
+            with priority_context(PREFETCH, owner):
+                yield
+        finally:
+            self._running.discard(question_id)
+            scheduler.end_promotion(owner)
+
+    def promote(self, question_id: str):
+        """A user is waiting on the question: its prefetch, if running here, goes on at question priority."""
+        if question_id in self._running:
+            metrics.incr("prefetch_promoted_total")
+            scheduler.promote(_owner(question_id), INTERACTIVE)
+
+    async def touch(self, hub_id: str):
+        """Note activity on the hub's session, which keeps its prefetches going."""
+        if not PREFETCH_ENABLED:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._touched.get(hub_id, float("-inf")) < TOUCH_INTERVAL:
+                return
+            self._touched[hub_id] = now
+        await run_db(_touch, hub_id)
+
+    async def schedule(self, hub_id: str, node: dict):
+        """Queue prefetches for the questions of a just saved node (its `node` event payload), within budget."""
+        if not PREFETCH_ENABLED or not node.get("questions"):
+            return
+        try:
+            queued = await run_db(_schedule, hub_id, node["id"], node["questions"][:PREFETCH_PER_NODE])
+        except Exception as e:
+            # Speculation must never fail the build that triggered it
+            print(f"Scheduling prefetches for node {node['id']} failed: {e}")
+            return
+        metrics.incr("prefetch_queued_total", queued)
+
+    def record(self, result: str):
+        """Count a question request as served by a finished prefetch, joined to a running one, or missed."""
+        with self._lock:
+            self.requests[result] += 1
+        metrics.incr("prefetch_requests_total", result=result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = dict(self.requests)
+        total = sum(requests.values())
+        return {
+            "enabled": PREFETCH_ENABLED,
+            **requests,
+            "hit_rate": requests[HIT] / total if total else 0.0,
+            # Joined requests still skipped part of the wait
+            "coverage": (requests[HIT] + requests[JOINED]) / total if total else 0.0,
+            "budget": {"per_node": PREFETCH_PER_NODE, "per_session": PREFETCH_PER_SESSION,
+                       "max_active": PREFETCH_MAX_ACTIVE, "idle_seconds": PREFETCH_IDLE_SECONDS},
+        }
+
+
+def _touch(hub_id: str):
+    with session_scope() as db:
+        session_id = db.query(Hub.session_id).filter(Hub.id == hub_id).scalar()
+        if session_id:
+            db.query(Session).filter(Session.id == session_id).update({Session.last_active_at: datetime.utcnow()})
+
+
+def _idle(last_active_at: Optional[datetime]) -> bool:
+    return last_active_at is None or datetime.utcnow() - last_active_at > timedelta(seconds=PREFETCH_IDLE_SECONDS)
+
+
+def _schedule(hub_id: str, node_id: str, questions: List[dict]) -> int:
+    with session_scope() as db:
+        hub = db.get(Hub, hub_id)
+        if hub is None or _idle(hub.session.last_active_at):
+            metrics.incr("prefetch_skipped_total", reason="idle")
+            return 0
+        session_hubs = db.query(Hub.id).filter(Hub.session_id == hub.session_id)
+        used = db.query(Job).filter(Job.kind == "prefetch", Job.hub_id.in_(session_hubs)).count()
+        active = db.query(Job).filter(Job.kind == "prefetch", Job.status.in_((jobs.QUEUED, jobs.RUNNING))).count()
+        allowed = min(PREFETCH_PER_SESSION - used, PREFETCH_MAX_ACTIVE - active, len(questions))
+        if allowed < len(questions):
+            metrics.incr("prefetch_skipped_total", len(questions) - max(allowed, 0), reason="budget")
+        for question in questions[:max(allowed, 0)]:
+            prompt = question["content"] + LEVEL_ONE_HALF_PROMPT
+            jobs.enqueue(db, "prefetch", hub_id, {
+                "node_id": node_id, "prompt": prompt, "message": prompt, "answer_node_id": jobs.new_id(),
+                "question_id": question["id"]}, dedup_key=dedup_key(question["id"]))
+        return max(allowed, 0)
+
+
+def skip_reason(question_id: str) -> Optional[str]:
+    """Why a prefetch should not run (any more): its session went idle, or the question is gone or answered."""
+    with session_scope() as db:
+        row = (db.query(Question.answer_node_id, Session.last_active_at)
+               .join(Question.node).join(Hub).join(Session)
+               .filter(Question.id == question_id).first())
+        if row is None:
+            reason = "gone"
+        elif row.answer_node_id:
+            reason = "answered"
+        elif _idle(row.last_active_at):
+            reason = "idle"
+        else:
+            return None
+    metrics.incr("prefetch_skipped_total", reason=reason)
+    return reason
+
+
+def served(question_id: str) -> bool:
+    """Mark a prefetched answer as served; True the first time, so each prefetch counts as one hit."""
+    with session_scope() as db:
+        return bool(db.query(Question).filter(Question.id == question_id, Question.prefetched.is_(True))
+                    .update({Question.prefetched: False}))
+
+
+def is_prefetching(question_id: str) -> bool:
+    """Whether a prefetch of the question is queued or running."""
+    with session_scope() as db:
+        job = jobs.active(db, dedup_key(question_id))
+        return job is not None and job.kind == "prefetch"
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,291 @@
+import io
+from itertools import combinations
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+CHUNK_ROWS = 200_000
+MAX_CATEGORY_LEVELS = 20  # categorical columns with more levels are not cross-tabulated
+TOP_VALUES = 10
+TOP_CORRELATIONS = 10
+TOP_CONTINGENCY_TABLES = 3
+DATETIME_PARSE_RATE = 0.9  # share of values that must parse for a text column to count as dates
+SEASONAL_LAGS = {"D": 7, "M": 12}  # candidate season length per aggregation period
+
+
+def _detect_datetime_columns(chunk: pd.DataFrame) -> List[str]:
+    columns = []
+    for column in chunk.select_dtypes(include=["object", "string"]).columns:
+        sample = chunk[column].dropna().head(500)
+        if sample.empty:
+            continue
+        parsed = pd.to_datetime(sample, errors="coerce", format="mixed")
+        if parsed.notna().mean() >= DATETIME_PARSE_RATE:
+            columns.append(column)
+    return columns
+
+
+class _Profiler:
+    """
+    Accumulates per-column statistics, pairwise correlation sums, cross-tabs and
+    time-series aggregates one chunk at a time, so memory does not grow with the file.
+    """
+
+    def __init__(self, first_chunk: pd.DataFrame):
+        self.columns = list(first_chunk.columns)
+        self.datetime_columns = _detect_datetime_columns(first_chunk)
+        self.numeric_columns = [column for column in first_chunk.select_dtypes(include="number").columns]
+        self.categorical_columns = [column for column in self.columns
+                                    if column not in self.numeric_columns and column not in self.datetime_columns]
+        self.rows = 0
+        self.nulls = pd.Series(0, index=self.columns, dtype="int64")
+        self.value_counts: Dict[str, pd.Series] = {}
+        self.minimum = pd.Series(np.inf, index=self.numeric_columns)
+        self.maximum = pd.Series(-np.inf, index=self.numeric_columns)
+
+        # Pairwise-complete sums for the correlation matrix
+        k = len(self.numeric_columns)
+        self.n = np.zeros((k, k))
+        self.sx = np.zeros((k, k))
+        self.sxx = np.zeros((k, k))
+        self.sxy = np.zeros((k, k))
+
+        self.crosstabs: Dict[Tuple[str, str], pd.Series] = {}
+        self.series: Dict[Tuple[str, str], pd.DataFrame] = {}
+
+    def add(self, chunk: pd.DataFrame):
+        self.rows += len(chunk)
+        self.nulls += chunk.isna().sum().reindex(self.columns, fill_value=0)
+
+        for column in self.categorical_columns:
+            counts = chunk[column].astype("string").value_counts()
+            previous = self.value_counts.get(column)
+            self.value_counts[column] = counts if previous is None else previous.add(counts, fill_value=0)
+
+        numeric = chunk[self.numeric_columns].apply(pd.to_numeric, errors="coerce")
+        if self.numeric_columns:
+            self.minimum = np.fmin(self.minimum, numeric.min())
+            self.maximum = np.fmax(self.maximum, numeric.max())
+            values = numeric.to_numpy(dtype="float64")
+            mask = ~np.isnan(values)
+            values = np.where(mask, values, 0.0)
+            m = mask.astype("float64")
+            self.n += m.T @ m
+            self.sx += values.T @ m
+            self.sxx += (values ** 2).T @ m
+            self.sxy += values.T @ values
+
+        low_cardinality = [column for column in self.categorical_columns
+                           if len(self.value_counts[column]) <= MAX_CATEGORY_LEVELS]
+        for pair in combinations(low_cardinality, 2):
+            counts = chunk.groupby(list(pair), observed=True).size()
+            previous = self.crosstabs.get(pair)
+            self.crosstabs[pair] = counts if previous is None else previous.add(counts, fill_value=0)
+
+        for date_column in self.datetime_columns:
+            dates = pd.to_datetime(chunk[date_column], errors="coerce", format="mixed")
+            for period in SEASONAL_LAGS:
+                periods = dates.dt.to_period(period)
+                grouped = numeric.groupby(periods).agg(["sum", "count"])
+                previous = self.series.get((date_column, period))
+                self.series[(date_column, period)] = grouped if previous is None \
+                    else previous.add(grouped, fill_value=0)
+
+    def _correlations(self) -> List[dict]:
+        n, sx, sxx, sxy = self.n, self.sx, self.sxx, self.sxy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            covariance = n * sxy - sx * sx.T
+            variance = (n * sxx - sx ** 2) * (n * sxx.T - sx.T ** 2)
+            corr = covariance / np.sqrt(variance)
+        pairs = []
+        for i, j in combinations(range(len(self.numeric_columns)), 2):
+            if np.isfinite(corr[i, j]) and n[i, j] > 2:
+                pairs.append({"x": self.numeric_columns[i], "y": self.numeric_columns[j],
+                              "r": round(float(corr[i, j]), 3), "n": int(n[i, j])})
+        return sorted(pairs, key=lambda pair: -abs(pair["r"]))[:TOP_CORRELATIONS]
+
+    def _contingency_tables(self) -> List[dict]:
+        tables = []
+        for (a, b), counts in self.crosstabs.items():
+            table = counts.unstack(fill_value=0)
+            if table.shape[0] < 2 or table.shape[1] < 2:
+                continue
+            total = table.to_numpy().sum()
+            expected = np.outer(table.sum(axis=1), table.sum(axis=0)) / total
+            chi2 = float(((table.to_numpy() - expected) ** 2 / expected).sum())
+            cramers_v = (chi2 / (total * (min(table.shape) - 1))) ** 0.5
+            tables.append({"rows": a, "columns": b, "cramers_v": round(cramers_v, 3),
+                           "table": {str(row): {str(col): int(value) for col, value in values.items()}
+                                     for row, values in table.iterrows()}})
+        return sorted(tables, key=lambda table: -table["cramers_v"])[:TOP_CONTINGENCY_TABLES]
+
+    def _seasonal_candidates(self) -> List[dict]:
+        candidates = []
+        for (date_column, period), grouped in self.series.items():
+            lag = SEASONAL_LAGS[period]
+            for column in self.numeric_columns:
+                sums, counts = grouped[(column, "sum")], grouped[(column, "count")]
+                means = (sums / counts.replace(0, np.nan)).dropna().sort_index()
+                if len(means) < 2 * lag:
+                    continue
+                values = means.to_numpy()
+                slope = float(np.polyfit(np.arange(len(values)), values, 1)[0])
+                detrended = values - np.polyval(np.polyfit(np.arange(len(values)), values, 1), np.arange(len(values)))
+                if detrended.std() <= 1e-9 * (np.abs(values).max() or 1):
+                    continue  # a pure trend (e.g. an ID column) has no seasonal component
+                autocorrelation = float(pd.Series(detrended).autocorr(lag))
+                if not np.isfinite(autocorrelation):
+                    continue
+                candidates.append({"date": date_column, "value": column, "period": period, "lag": lag,
+                                   "seasonal_autocorr": round(autocorrelation, 3), "trend_per_period": slope,
+                                   "series": {str(index): round(float(value), 4) for index, value in means.items()}})
+        return sorted(candidates, key=lambda candidate: -candidate["seasonal_autocorr"])[:TOP_CORRELATIONS]
+
+    def result(self) -> dict:
+        columns = []
+        for column in self.columns:
+            entry = {"name": column, "nulls": int(self.nulls[column])}
+            if column in self.numeric_columns:
+                i = self.numeric_columns.index(column)
+                count = self.n[i, i]
+                mean = self.sx[i, i] / count if count else None
+                variance = self.sxx[i, i] / count - mean ** 2 if count else None
+                entry.update(type="numeric", mean=mean, std=max(variance, 0) ** 0.5 if count else None,
+                             min=float(self.minimum[column]) if count else None,
+                             max=float(self.maximum[column]) if count else None)
+            elif column in self.datetime_columns:
+                entry.update(type="datetime")
+            else:
+                counts = self.value_counts[column].sort_values(ascending=False)
+                entry.update(type="categorical", distinct=int(len(counts)),
+                             top={str(value): int(count) for value, count in counts.head(TOP_VALUES).items()})
+            columns.append(entry)
+
+        return {
+            "rows": self.rows,
+            "columns": columns,
+            "correlations": self._correlations(),
+            "contingency_tables": self._contingency_tables(),
+            "seasonal_candidates": self._seasonal_candidates(),
+        }
+
+
+def profile_csv(file: BinaryIO, chunk_rows: int = CHUNK_ROWS) -> Optional[dict]:
+    """
+    Compute a dataset profile (column types, summary stats, correlation matrix, top
+    contingency tables and seasonal decomposition candidates) from a CSV, reading it in
+    chunks of `chunk_rows`. The file is rewound afterwards.
+
+    Returns:
+    Optional[dict]: The profile, or None if the file cannot be read as CSV.
+    """
+    try:
+        profiler = None
+        for chunk in pd.read_csv(file, chunksize=chunk_rows, low_memory=False):
+            if profiler is None:
+                profiler = _Profiler(chunk)
+            profiler.add(chunk)
+        return profiler.result() if profiler else None
+    except (pd.errors.ParserError, UnicodeDecodeError, ValueError) as e:
+        print(f"Could not profile dataset: {e}")
+        return None
+    finally:
+        file.seek(0)
+
+
+def profile_summary(profile: dict, max_chars: int = 2000) -> str:
+    """Compact text rendering of a profile for use inside a prompt."""
+    lines = [f"Rows: {profile['rows']}"]
+    for column in profile["columns"]:
+        if column["type"] == "numeric" and column["mean"] is not None:
+            lines.append(f"- {column['name']} (numeric): mean {column['mean']:.4g}, std {column['std']:.4g}, "
+                         f"range {column['min']:.4g}..{column['max']:.4g}, {column['nulls']} nulls")
+        elif column["type"] == "categorical":
+            top = ", ".join(list(column["top"])[:3])
+            lines.append(f"- {column['name']} (categorical, {column['distinct']} levels): top {top}")
+        else:
+            lines.append(f"- {column['name']} ({column['type']})")
+    if profile["correlations"]:
+        lines.append("Strongest correlations: " + "; ".join(
+            f"{pair['x']}~{pair['y']} r={pair['r']}" for pair in profile["correlations"][:5]))
+    if profile["contingency_tables"]:
+        lines.append("Strongest categorical associations: " + "; ".join(
+            f"{table['rows']}x{table['columns']} V={table['cramers_v']}" for table in profile["contingency_tables"]))
+    if profile["seasonal_candidates"]:
+        lines.append("Seasonality candidates: " + "; ".join(
+            f"{candidate['value']} by {candidate['date']} ({candidate['period']}, lag {candidate['lag']}, "
+            f"acf {candidate['seasonal_autocorr']})" for candidate in profile["seasonal_candidates"][:3]))
+    summary = "\n".join(lines)
+    return summary if len(summary) <= max_chars else summary[:max_chars - 3] + "..."
+
+
+def _figure_png(figure) -> bytes:
+    buffer = io.BytesIO()
+    figure.tight_layout()
+    figure.savefig(buffer, format="png", dpi=100)
+    return buffer.getvalue()
+
+
+def profile_nodes(profile: dict) -> List[dict]:
+    """
+    Render a profile as L1 node contents (title, text, prompt and PNG charts) without any
+    LLM call. Charts follow LEVEL_ONE_PROMPT_SUFFIX: bar charts for discrete values and
+    aggregated lines for time series, no heat maps.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    nodes = []
+
+    numeric = [column for column in profile["columns"] if column["type"] == "numeric" and column["mean"] is not None]
+    overview = "\n".join(
+        [f"The dataset has {profile['rows']} rows and {len(profile['columns'])} columns."] +
+        [f"- **{column['name']}**: mean {column['mean']:.4g}, std {column['std']:.4g}, "
+         f"min {column['min']:.4g}, max {column['max']:.4g}" for column in numeric])
+    nodes.append({"title": f"{profile['rows']} rows, {len(profile['columns'])} columns",
+                  "text": overview, "prompt": "local:overview", "images": []})
+
+    if profile["correlations"]:
+        pairs = profile["correlations"]
+        figure, axis = plt.subplots(figsize=(7, 4))
+        axis.barh([f"{pair['x']} / {pair['y']}" for pair in pairs][::-1], [pair["r"] for pair in pairs][::-1])
+        axis.set_xlabel("Pearson r")
+        axis.set_title("Strongest correlations")
+        top = pairs[0]
+        nodes.append({"title": f"{top['x']} vs {top['y']}: r={top['r']}"[:50],
+                      "text": "\n".join(f"- {pair['x']} and {pair['y']}: r = {pair['r']} (n = {pair['n']})"
+                                        for pair in pairs),
+                      "prompt": "local:correlations", "images": [_figure_png(figure)]})
+        plt.close(figure)
+
+    for table in profile["contingency_tables"]:
+        frame = pd.DataFrame(table["table"]).T
+        figure, axis = plt.subplots(figsize=(7, 4))
+        frame.plot.bar(ax=axis)
+        axis.set_xlabel(table["rows"])
+        axis.set_ylabel("Rows")
+        axis.set_title(f"{table['rows']} by {table['columns']}")
+        nodes.append({"title": f"{table['rows']} by {table['columns']}: V={table['cramers_v']}"[:50],
+                      "text": f"Cramér's V between {table['rows']} and {table['columns']} is {table['cramers_v']}."
+                              f"\n\n```\n{frame.to_string()}\n```",
+                      "prompt": "local:crosstab", "images": [_figure_png(figure)]})
+        plt.close(figure)
+
+    for candidate in profile["seasonal_candidates"][:2]:
+        series = pd.Series(candidate["series"])
+        figure, axis = plt.subplots(figsize=(7, 4))
+        axis.plot(range(len(series)), series.to_numpy())
+        ticks = list(range(0, len(series), max(len(series) // 8, 1)))
+        axis.set_xticks(ticks, [series.index[i] for i in ticks], rotation=45)
+        axis.set_xlabel(candidate["date"])
+        axis.set_ylabel(f"mean {candidate['value']}")
+        nodes.append({"title": f"{candidate['value']} repeats every {candidate['lag']} {candidate['period']}"[:50],
+                      "text": f"Mean {candidate['value']} aggregated per {candidate['period']} of {candidate['date']} "
+                              f"has autocorrelation {candidate['seasonal_autocorr']} at lag {candidate['lag']} after "
+                              f"removing a linear trend of {candidate['trend_per_period']:.4g} per period.",
+                      "prompt": "local:seasonality", "images": [_figure_png(figure)]})
+        plt.close(figure)
+
+    return nodes
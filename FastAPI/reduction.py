@@ -0,0 +1,301 @@
+"""
+Dataset reduction before upload. Code Interpreter re-reads the uploaded file in every
+run of every thread, so a multi-million-row CSV is parsed again for each L1 prompt,
+follow-up and title. A reduced hub uploads a smaller copy instead: constant and ID-like
+columns dropped, rows sampled down to a budget, written as Parquet (CSV without pyarrow).
+
+The build job makes the plan from the full-data profile, which the hub keeps, records it
+on `Hub.reduction` and applies it before the upload: the same source bytes and plan
+always give the same file, so a hub can be reproduced from it.
+
+Sampling keeps the shape of the data the row budget cannot hold:
+- `stratified`: every level of a categorical column keeps its share of the rows, and rare
+  levels keep at least MIN_PER_STRATUM of theirs (fewer if the budget cannot give every
+  level that many); the total stays within the budget.
+- `time`: rows are spread over TIME_BINS equal stretches of a date column's range, so
+  every period keeps its share instead of whichever dates a random sample happens to hit.
+- `random`: a uniform sample.
+`auto` picks `time` if there is a date column, else `stratified` if there is a column to
+stratify by, else `random`. Off unless REDUCTION_ENABLED=1 or the request asks for it.
+"""
+import hashlib
+import json
+import os
+import time
+from typing import BinaryIO, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from profiling import CHUNK_ROWS
+
+try:
+    import pyarrow  # noqa: F401 (pandas writes Parquet with it)
+except ImportError:
+    pyarrow = None
+
+REDUCTION_ENABLED = os.getenv("REDUCTION_ENABLED", "0") != "0"
+REDUCTION_ROW_BUDGET = int(os.getenv("REDUCTION_ROW_BUDGET", "200000"))  # rows uploaded at most (about)
+REDUCTION_SAMPLING = os.getenv("REDUCTION_SAMPLING", "auto")  # auto, stratified, time or random
+REDUCTION_SEED = int(os.getenv("REDUCTION_SEED", "0"))
+REDUCTION_FORMAT = os.getenv("REDUCTION_FORMAT", "parquet")  # parquet or csv
+SAMPLINGS = ("auto", "stratified", "time", "random")
+MAX_STRATA = 50  # categorical columns with more levels are not stratified by
+MIN_PER_STRATUM = 30  # rows kept of every stratum (all of a smaller one), out of the row budget
+TIME_BINS = 100
+ID_MIN_ROWS = 100  # smaller tables keep all their columns
+PLAN_VERSION = 1  # bump when the same plan would reduce to different rows
+NA_STRATUM = "<NA>"
+TIME_RESOLUTION = "h"  # dates are binned at this resolution
+
+
+def _is_constant(column: dict, rows: int) -> bool:
+    if column["nulls"] >= rows:
+        return True
+    if column["nulls"]:
+        return False  # value vs. missing still tells rows apart
+    if column["type"] == "numeric":
+        return column["min"] == column["max"]
+    return column["type"] == "categorical" and column["distinct"] <= 1
+
+
+def _is_id_like(column: dict, rows: int) -> bool:
+    if rows < ID_MIN_ROWS or column["nulls"]:
+        return False
+    if column["type"] == "categorical":
+        return column["distinct"] == rows
+    if column["type"] == "numeric" and column["min"] is not None:
+        # A row counter: consecutive integers, once each (their spread is that of 0..rows-1)
+        low, high = column["min"], column["max"]
+        return (float(low).is_integer() and high - low + 1 == rows and abs(column["mean"] - (low + high) / 2) < 1e-6
+                and abs(column["std"] - ((rows ** 2 - 1) / 12) ** 0.5) <= 1e-3 * column["std"])
+    return False
+
+
+def _strata_column(profile: dict, drop: List[str]) -> Optional[str]:
+    # The categorical column with the fewest levels (at least two) splits the rows most evenly
+    candidates = [column for column in profile["columns"]
+                  if column["type"] == "categorical" and 2 <= column["distinct"] <= MAX_STRATA
+                  and column["name"] not in drop]
+    return min(candidates, key=lambda column: column["distinct"])["name"] if candidates else None
+
+
+def plan(profile: dict, row_budget: Optional[int] = None, sampling: Optional[str] = None,
+         sample_by: Optional[str] = None, seed: Optional[int] = None) -> dict:
+    """
+    Decide how to reduce a dataset from its full-data profile; unset arguments take the
+    REDUCTION_* defaults.
+
+    Args:
+    profile (dict): The dataset profile from profiling.profile_csv.
+    row_budget (int): Rows to keep at most.
+    sampling (str): `auto`, `stratified`, `time` or `random`.
+    sample_by (str): Column to stratify or bin by, instead of the one `sampling` would pick.
+    seed (int): Seed of the sample.
+
+    Returns:
+    dict: The reduction parameters recorded on the hub and applied by `reduce_file`.
+
+    Raises:
+    ValueError: If the sampling cannot be done on this dataset.
+    """
+    row_budget = row_budget or REDUCTION_ROW_BUDGET
+    sampling = sampling or REDUCTION_SAMPLING
+    seed = REDUCTION_SEED if seed is None else seed
+    if sampling not in SAMPLINGS:
+        raise ValueError(f"Unknown sampling {sampling!r}, expected one of {', '.join(SAMPLINGS)}")
+    if row_budget < 1:
+        raise ValueError("The row budget must be positive")
+
+    rows = profile["rows"]
+    columns = {column["name"]: column for column in profile["columns"]}
+    constant = [name for name, column in columns.items() if _is_constant(column, rows)]
+    id_like = [name for name, column in columns.items() if name not in constant and _is_id_like(column, rows)]
+    drop = constant + id_like
+    if sample_by is not None:
+        if sample_by not in columns:
+            raise ValueError(f"No column {sample_by!r} to sample by")
+        if sample_by in drop:
+            raise ValueError(f"Column {sample_by!r} is {'constant' if sample_by in constant else 'ID-like'}")
+    if len(drop) == len(columns):
+        drop, constant, id_like = [], [], []  # nothing would be left to analyze
+
+    dates = [name for name, column in columns.items() if column["type"] == "datetime" and name not in drop]
+    column = None
+    if rows > row_budget:
+        if sampling == "auto":
+            if sample_by is not None:
+                sampling = "time" if columns[sample_by]["type"] == "datetime" else "stratified"
+            else:
+                sampling = "time" if dates else "stratified" if _strata_column(profile, drop) else "random"
+        if sampling == "time":
+            column = sample_by or (dates[0] if dates else None)
+            if column is None or columns[column]["type"] != "datetime":
+                raise ValueError("Time-aware sampling needs a date column")
+        elif sampling == "stratified":
+            column = sample_by or _strata_column(profile, drop)
+            if column is None or columns[column]["type"] != "categorical" \
+                    or columns[column]["distinct"] > MAX_STRATA:
+                raise ValueError(f"Stratified sampling needs a categorical column of at most {MAX_STRATA} levels")
+    else:
+        sampling = "none"  # the whole table fits the budget
+
+    return {
+        "version": PLAN_VERSION,
+        "rows": rows,
+        "row_budget": row_budget,
+        "sampling": sampling,
+        "column": column,
+        "seed": seed,
+        "dropped": {"constant": constant, "id_like": id_like},
+        "format": "parquet" if REDUCTION_FORMAT == "parquet" and pyarrow is not None else "csv",
+        "time_bins": TIME_BINS,
+        "min_per_stratum": MIN_PER_STRATUM,
+        "datetime_columns": dates,
+    }
+
+
+def reduced_hash(content_hash: str, params: dict) -> str:
+    """Dataset key of a reduced upload: the source bytes and every parameter that shapes the result."""
+    key = {name: value for name, value in params.items() if name != "result"}
+    return hashlib.sha256(f"{content_hash}:{json.dumps(key, sort_keys=True)}".encode()).hexdigest()
+
+
+def reduced_name(file_name: str, params: dict) -> str:
+    stem = os.path.splitext(file_name)[0] or "dataset"
+    return f"{stem}.{params['format']}"
+
+
+def _raw_keys(chunk: pd.DataFrame, params: dict) -> pd.Series:
+    # The value each row is grouped by before strata are formed: the column's value, or its date
+    # at TIME_RESOLUTION (as nanoseconds), or one group for a plain random sample
+    if params["sampling"] == "stratified":
+        return chunk[params["column"]].astype("string").fillna(NA_STRATUM)
+    if params["sampling"] == "time":
+        dates = pd.to_datetime(chunk[params["column"]], errors="coerce", format="mixed").dt.floor(TIME_RESOLUTION)
+        return pd.Series(dates.to_numpy(dtype="datetime64[ns]").astype("int64"), index=chunk.index) \
+            .where(dates.notna(), -1)
+    return pd.Series(0, index=chunk.index)
+
+
+def _strata(raw_counts: pd.Series, params: dict) -> pd.Series:
+    # Map from raw key to stratum; dates go to TIME_BINS equal-width bins of their range, undated rows to -1
+    if params["sampling"] != "time":
+        return pd.Series(np.arange(len(raw_counts)), index=raw_counts.index)
+    dated = raw_counts.index[raw_counts.index >= 0]
+    if not len(dated):
+        return pd.Series(-1, index=raw_counts.index)
+    edges = np.linspace(dated.min(), dated.max(), params["time_bins"] + 1)[1:-1]
+    bins = np.searchsorted(edges, raw_counts.index.to_numpy(), side="right")
+    return pd.Series(np.where(raw_counts.index >= 0, bins, -1), index=raw_counts.index)
+
+
+def _choose(counts: pd.Series, params: dict) -> Dict[int, np.ndarray]:
+    # Every stratum gets MIN_PER_STRATUM (less if the budget cannot give each that many), the
+    # rest of the budget is shared in proportion to the rows left over, then which of its rows
+    rng = np.random.default_rng(params["seed"])
+    counts = counts.sort_index()
+    sizes = counts.to_numpy()
+    floors = np.minimum(sizes, min(params["min_per_stratum"], params["row_budget"] // len(sizes)))
+    rest = sizes - floors
+    spare = max(params["row_budget"] - int(floors.sum()), 0)
+    quotas = np.minimum(sizes, floors + (spare * rest // rest.sum() if rest.sum() else 0))
+    chosen = {}
+    for stratum, count, quota in zip(counts.index, sizes, quotas):
+        chosen[stratum] = np.sort(rng.choice(count, size=quota, replace=False))
+    return chosen
+
+
+def _read(file: BinaryIO, columns: Optional[List[str]] = None):
+    file.seek(0)
+    return pd.read_csv(file, chunksize=CHUNK_ROWS, low_memory=False, usecols=columns)
+
+
+def _sample(file: BinaryIO, params: dict, keep: List[str]):
+    # Two passes: count the rows of each stratum, then keep the chosen ordinals of each.
+    # Yields the kept rows of each chunk, with the `keep` columns.
+    raw_counts = pd.Series({0: params["rows"]})  # a random sample has one stratum, of all rows
+    if params["column"]:
+        raw_counts = None
+        for chunk in _read(file, [params["column"]]):
+            counts = _raw_keys(chunk, params).value_counts()
+            raw_counts = counts if raw_counts is None else raw_counts.add(counts, fill_value=0)
+        raw_counts = raw_counts.astype("int64")
+    strata = _strata(raw_counts, params)
+    chosen = _choose(raw_counts.groupby(strata).sum(), params)
+
+    seen = {stratum: 0 for stratum in chosen}
+    for chunk in _read(file, keep):
+        stratum = _raw_keys(chunk, params).map(strata).to_numpy()
+        keep_row = np.zeros(len(chunk), dtype=bool)
+        for value in np.unique(stratum):
+            rows = np.flatnonzero(stratum == value)
+            ordinals = seen[value] + np.arange(len(rows))
+            picked = chosen[value]
+            if len(picked):
+                at = np.minimum(np.searchsorted(picked, ordinals), len(picked) - 1)
+                keep_row[rows] = picked[at] == ordinals
+            seen[value] += len(rows)
+        yield chunk[keep_row][keep]
+
+
+def _typed(frame: pd.DataFrame, params: dict) -> pd.DataFrame:
+    for column in frame.columns:
+        if column in params["datetime_columns"]:
+            # Dates go in as dates, unless some would be lost to parsing
+            parsed = pd.to_datetime(frame[column], errors="coerce", format="mixed")
+            if parsed.notna().sum() == frame[column].notna().sum():
+                frame[column] = parsed
+                continue
+        if frame[column].dtype == object:
+            # Chunks may have read a column with different types; Parquet needs one
+            frame[column] = frame[column].astype("string")
+    return frame
+
+
+def reduce_file(source: BinaryIO, target: str, params: dict) -> dict:
+    """
+    Write the reduced dataset `params` describes (see `plan`) from the CSV `source` to
+    `target`, reading the source in chunks; at most the sample is held in memory.
+
+    Returns:
+    dict: Rows and bytes before and after, and the seconds it took.
+    """
+    start = time.perf_counter()
+    dropped = set(params["dropped"]["constant"]) | set(params["dropped"]["id_like"])
+    keep = [column for column in _columns(source) if column not in dropped]
+    if params["sampling"] == "none":
+        parts = (chunk for chunk in _read(source, keep))
+    else:
+        parts = _sample(source, params, keep)
+    frame = _typed(pd.concat(list(parts), ignore_index=True), params)
+
+    if params["format"] == "parquet":
+        frame.to_parquet(target, index=False)
+    else:
+        frame.to_csv(target, index=False)
+    source.seek(0, os.SEEK_END)
+    return {"rows_in": params["rows"], "rows_out": len(frame), "columns_out": len(frame.columns),
+            "bytes_in": source.tell(), "bytes_out": os.path.getsize(target),
+            "seconds": round(time.perf_counter() - start, 3)}
+
+
+def _columns(file: BinaryIO) -> List[str]:
+    file.seek(0)
+    return list(pd.read_csv(file, nrows=0).columns)
+
+
+def describe(params: dict) -> str:
+    """Instructions addendum telling the assistant what its file holds, compared to the full dataset."""
+    result = params.get("result", {})
+    lines = [f"The attached file is a reduced copy of the user's dataset, in {params['format'].upper()} format."]
+    if params["sampling"] != "none":
+        how = {"stratified": f"stratified by `{params['column']}` (its rarest values keep more than their share)",
+               "time": f"spread evenly over the range of `{params['column']}`",
+               "random": "drawn uniformly"}[params["sampling"]]
+        lines.append(f"It holds a sample of {result.get('rows_out', params['row_budget'])} of the "
+                     f"{params['rows']} rows, {how}; scale counts and totals up to the full row count.")
+    dropped = params["dropped"]["constant"] + params["dropped"]["id_like"]
+    if dropped:
+        lines.append(f"Constant and ID-like columns were left out: {', '.join(dropped)}.")
+    return " ".join(lines)
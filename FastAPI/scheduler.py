@@ -0,0 +1,325 @@
+"""
+Central scheduler for calls to OpenAI and Exa.
+
+Every assistant run and Exa search waits for a slot here. Slots are handed out by
+priority class (interactive questions before L2 expansions before background L1
+builds before speculative prefetches), round-robin across sessions within a class,
+and only while the API's request/token buckets have budget; prefetches only get what
+is left above PREFETCH_RESERVE. The OpenAI buckets follow the x-ratelimit-* headers
+of every response, so the budget tracks what the service actually allows.
+"""
+import asyncio
+import contextvars
+import re
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional
+
+import httpx
+from openai import DefaultAsyncHttpxClient
+
+import metrics
+import tracing
+from consts import (EXA_RPM, MAX_CONCURRENT_RUNS, MAX_CONCURRENT_SEARCHES,
+                    OPENAI_RPM, OPENAI_TPM, PREFETCH_RESERVE, RUN_TOKEN_ESTIMATE)
+
+INTERACTIVE = 0
+L2 = 1
+BACKGROUND = 2
+PREFETCH = 3
+PRIORITY_NAMES = {INTERACTIVE: "interactive", L2: "l2", BACKGROUND: "background", PREFETCH: "prefetch"}
+PREFETCH_RECHECK = 1.0  # seconds before a prefetch held back for lack of spare budget is looked at again
+
+OPENAI = "openai"
+EXA = "exa"
+
+_priority = contextvars.ContextVar("priority", default=INTERACTIVE)
+_owner = contextvars.ContextVar("owner", default=None)
+
+
+@contextmanager
+def priority_context(priority: int, owner: Optional[str] = None):
+    """
+    Run the enclosed calls (and the tasks they spawn) at `priority`, on behalf of `owner`
+    (the session the work is for, used for fairness).
+    """
+    priority_token = _priority.set(priority)
+    owner_token = _owner.set(owner if owner is not None else _owner.get())
+    try:
+        yield
+    finally:
+        _owner.reset(owner_token)
+        _priority.reset(priority_token)
+
+
+class TokenBucket:
+    """Budget refilled continuously at `capacity` per minute; may go into debt."""
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.level = capacity
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken (0 if it can be taken now)."""
+        self._refill()
+        pause = max(0.0, self.paused_until - time.monotonic())
+        amount = min(amount, self.capacity)  # a request larger than the bucket waits for a full bucket
+        if self.level >= amount:
+            return pause
+        return max(pause, (amount - self.level) * 60 / self.capacity)
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def spare(self, amount: float, reserve: float) -> bool:
+        """Whether `amount` can be taken while keeping a `reserve` share of the capacity."""
+        self._refill()
+        return time.monotonic() >= self.paused_until and self.level - amount >= self.capacity * reserve
+
+    def sync(self, limit: Optional[float], remaining: Optional[float], reset: Optional[float]):
+        # The service's view wins: adopt its limit and never assume more budget than it reports
+        self._refill()
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.level = min(self.level, remaining)
+            if remaining <= 0 and reset:
+                self.pause(reset)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def _duration(value: Optional[str]) -> Optional[float]:
+    # Rate-limit reset headers look like "1s", "6m0s" or "20ms"
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"([\d.]+)(ms|s|m|h)", value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+def _number(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class _Api:
+    def __init__(self, name: str, concurrency: int, rpm: float, tpm: Optional[float], metered: bool):
+        self.name = name
+        self.metered = metered  # every HTTP request is charged by the client's hook, not per slot
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm) if tpm else None
+        # priority -> owner -> waiting (future, tokens); owners rotate for round-robin
+        self.waiting: Dict[int, "OrderedDict[Optional[str], deque]"] = {p: OrderedDict() for p in PRIORITY_NAMES}
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class Scheduler:
+    def __init__(self):
+        self._apis = {
+            OPENAI: _Api(OPENAI, MAX_CONCURRENT_RUNS, OPENAI_RPM, OPENAI_TPM, metered=True),
+            EXA: _Api(EXA, MAX_CONCURRENT_SEARCHES, EXA_RPM, None, metered=False),
+        }
+        # owner -> priority its calls run at instead of their own (see promote)
+        self._promoted: Dict[str, int] = {}
+
+    def promote(self, owner: str, priority: int):
+        """
+        Run `owner`'s calls at `priority` from now on, the waiting ones included, e.g. a
+        prefetch a user has started waiting for. Lasts until `end_promotion(owner)`.
+        """
+        self._promoted[owner] = priority
+        for state in self._apis.values():
+            for lower in PRIORITY_NAMES:
+                if lower > priority and owner in state.waiting[lower]:
+                    state.waiting[priority].setdefault(owner, deque()).extend(state.waiting[lower].pop(owner))
+            self._dispatch(state)
+
+    def end_promotion(self, owner: str):
+        self._promoted.pop(owner, None)
+
+    @asynccontextmanager
+    async def slot(self, api: str = OPENAI, tokens: float = RUN_TOKEN_ESTIMATE):
+        """
+        Wait for a slot to call `api` at the current priority, charging `tokens` against
+        its token budget. Returns a handle whose `settle(actual)` corrects the estimate.
+        """
+        state = self._apis[api]
+        priority, owner = _priority.get(), _owner.get()
+        priority = min(priority, self._promoted.get(owner, priority))
+        future = asyncio.get_running_loop().create_future()
+        state.waiting[priority].setdefault(owner, deque()).append((future, tokens))
+        self._gauges(state)
+        enqueued = time.monotonic()
+        self._dispatch(state)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(state)  # admitted just as the waiter went away
+            else:
+                self._forget(state, owner, future)
+            raise
+        waited = time.monotonic() - enqueued
+        metrics.incr("scheduler_admitted_total", api=api, priority=PRIORITY_NAMES[priority])
+        metrics.incr("scheduler_wait_seconds_total", waited, api=api, priority=PRIORITY_NAMES[priority])
+        tracing.record(f"{api}.queue", waited, priority=PRIORITY_NAMES[priority])
+        try:
+            yield _Settlement(state, tokens)
+        finally:
+            self._release(state)
+
+    def _forget(self, state: _Api, owner: Optional[str], future: asyncio.Future):
+        # Looked up in every class, the waiter may have been promoted since it queued
+        for owners in state.waiting.values():
+            queue = owners.get(owner)
+            if queue:
+                for entry in list(queue):
+                    if entry[0] is future:
+                        queue.remove(entry)
+                if not queue:
+                    del owners[owner]
+        self._gauges(state)
+
+    def _release(self, state: _Api):
+        state.in_flight -= 1
+        self._gauges(state)
+        self._dispatch(state)
+
+    def _dispatch(self, state: _Api):
+        # Admit waiters in priority order while there is concurrency and budget. A class that
+        # is waiting for budget blocks the classes below it, so background work cannot use up
+        # the budget an interactive call is waiting for.
+        while state.in_flight < state.concurrency:
+            priority = next((p for p in sorted(state.waiting) if state.waiting[p]), None)
+            if priority is None:
+                break
+            owners = state.waiting[priority]
+            owner, queue = next(iter(owners.items()))
+            future, tokens = queue[0]
+            wait = state.requests.wait_time(1)
+            if state.tokens is not None:
+                wait = max(wait, state.tokens.wait_time(tokens))
+            if wait > 0:
+                self._schedule(state, wait)
+                return
+            if priority == PREFETCH and not self._spare(state, tokens):
+                # Nothing else is waiting (prefetch is the lowest class), look again shortly
+                metrics.incr("scheduler_prefetch_deferred_total", api=state.name)
+                if state.timer is not None:
+                    state.timer.cancel()
+                state.timer = asyncio.get_running_loop().call_later(PREFETCH_RECHECK, self._dispatch, state)
+                return
+            queue.popleft()
+            # Round-robin: this owner goes to the back of its class
+            del owners[owner]
+            if queue:
+                owners[owner] = queue
+            if future.done():
+                continue
+            if not state.metered:
+                state.requests.take(1)
+            if state.tokens is not None:
+                state.tokens.take(tokens)
+            state.in_flight += 1
+            future.set_result(None)
+        self._gauges(state)
+
+    def _spare(self, state: _Api, tokens: float) -> bool:
+        # Speculative runs leave PREFETCH_RESERVE of the run slots and of the budgets free for
+        # the requests a user is waiting on
+        if state.in_flight >= state.concurrency * (1 - PREFETCH_RESERVE):
+            return False
+        if not state.requests.spare(1, PREFETCH_RESERVE):
+            return False
+        return state.tokens is None or state.tokens.spare(tokens, PREFETCH_RESERVE)
+
+    def _schedule(self, state: _Api, delay: float):
+        if state.timer is not None:
+            state.timer.cancel()
+        metrics.incr("scheduler_throttled_total", api=state.name)
+        state.timer = asyncio.get_running_loop().call_later(delay, self._dispatch, state)
+
+    def _gauges(self, state: _Api):
+        for priority, owners in state.waiting.items():
+            metrics.gauge("scheduler_queue_depth", sum(len(queue) for queue in owners.values()),
+                          api=state.name, priority=PRIORITY_NAMES[priority])
+        metrics.gauge("scheduler_in_flight", state.in_flight, api=state.name)
+
+    def record_request(self, api: str = OPENAI):
+        """Charge one request that did not go through a slot (polling, uploads, listings)."""
+        self._apis[api].requests.take(1)
+
+    def observe(self, api: str, headers: httpx.Headers, status_code: int):
+        """Update the budgets of `api` from the rate-limit headers of a response."""
+        state = self._apis[api]
+        state.requests.sync(_number(headers.get("x-ratelimit-limit-requests")),
+                            _number(headers.get("x-ratelimit-remaining-requests")),
+                            _duration(headers.get("x-ratelimit-reset-requests")))
+        if state.tokens is not None:
+            state.tokens.sync(_number(headers.get("x-ratelimit-limit-tokens")),
+                              _number(headers.get("x-ratelimit-remaining-tokens")),
+                              _duration(headers.get("x-ratelimit-reset-tokens")))
+        if status_code == 429:
+            metrics.incr("scheduler_rate_limited_total", api=api)
+            state.requests.pause(_duration(headers.get("retry-after")) or 1.0)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "in_flight": state.in_flight,
+                "concurrency": state.concurrency,
+                "queued": {PRIORITY_NAMES[p]: sum(len(q) for q in owners.values())
+                           for p, owners in state.waiting.items()},
+                "requests_budget": round(state.requests.level, 1),
+                "tokens_budget": round(state.tokens.level, 1) if state.tokens is not None else None,
+            }
+            for name, state in self._apis.items()
+        }
+
+
+class _Settlement:
+    def __init__(self, state: _Api, estimate: float):
+        self._state = state
+        self._estimate = estimate
+
+    def settle(self, actual: Optional[float]):
+        """Charge the difference between the estimated and the actual token usage."""
+        if actual is not None and self._state.tokens is not None:
+            self._state.tokens.take(actual - self._estimate)
+            self._estimate = actual
+
+
+scheduler = Scheduler()
+
+
+def openai_http_client() -> httpx.AsyncClient:
+    """
+    HTTP client for AsyncOpenAI that charges every request to the OpenAI request budget
+    and feeds the rate-limit headers of every response back into the scheduler.
+    """
+    async def on_request(request: httpx.Request):
+        scheduler.record_request(OPENAI)
+
+    async def on_response(response: httpx.Response):
+        scheduler.observe(OPENAI, response.headers, response.status_code)
+
+    return DefaultAsyncHttpxClient(event_hooks={"request": [on_request], "response": [on_response]})
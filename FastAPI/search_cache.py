@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import List, Optional
+
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "./search_cache.db")
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE_ENABLED", "1") != "0"
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "5000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", str(7 * 24 * 3600)))  # seconds, the web changes
+
+# Words that change nothing about what a search finds, dropped before comparing queries
+_STOPWORDS = {
+    "a", "an", "the", "of", "on", "in", "to", "for", "and", "or", "about", "with", "its", "it", "is",
+    "are", "this", "that", "here", "here's", "heres", "great", "article", "articles", "paper",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS searches (
+    key TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    results TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS searches_accessed_at ON searches (accessed_at);
+CREATE TABLE IF NOT EXISTS expansions (
+    node_id TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def normalize_query(query: str) -> str:
+    """
+    Canonical form of a search query: case, punctuation, quotes, filler words and word
+    order are dropped, so the near-identical queries sibling nodes generate
+    ("Here's a great article on X and Y:" / "An article about Y and X:") share an entry.
+    """
+    text = unicodedata.normalize("NFKC", query).lower()
+    words = re.findall(r"[\w']+", text)
+    return " ".join(sorted({word.strip("'") for word in words} - _STOPWORDS - {""}))
+
+
+class SearchCache:
+    """
+    Persistent cache of Exa results (title, url and summary of each), keyed by the
+    normalized query and the number of results asked for, with a TTL and LRU eviction.
+
+    It also remembers the query each node was expanded with, so expanding the same node
+    again skips both the query generation and the search.
+    """
+
+    def __init__(self, path: str = SEARCH_CACHE_PATH, max_entries: int = SEARCH_CACHE_MAX_ENTRIES,
+                 ttl: float = SEARCH_CACHE_TTL, enabled: bool = SEARCH_CACHE_ENABLED):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.node_hits = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    @staticmethod
+    def key_for(query: str, num_results: int) -> str:
+        return hashlib.sha256(json.dumps([normalize_query(query), num_results]).encode()).hexdigest()
+
+    def _read(self, key: str, now: float) -> Optional[List[dict]]:
+        # Caller holds the lock
+        row = self.conn.execute("SELECT results, created_at FROM searches WHERE key = ?", (key,)).fetchone()
+        if row and now - row[1] > self.ttl:
+            self.conn.execute("DELETE FROM searches WHERE key = ?", (key,))
+            self.evictions += 1
+            row = None
+        if not row:
+            return None
+        self.conn.execute("UPDATE searches SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def get(self, query: str, num_results: int) -> Optional[List[dict]]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            results = self._read(self.key_for(query, num_results), time.time())
+            if results is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return results
+
+    def query_for_node(self, node_id: str) -> Optional[str]:
+        """The query `node_id` was last expanded with, if it is recent enough to reuse."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self.conn.execute("SELECT query FROM expansions WHERE node_id = ? AND created_at >= ?",
+                                    (node_id, time.time() - self.ttl)).fetchone()
+            if row:
+                self.node_hits += 1
+        return row[0] if row else None
+
+    def put(self, query: str, num_results: int, results: List[dict]):
+        if not self.enabled:
+            return
+        key = self.key_for(query, num_results)
+        now = time.time()
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?, ?)",
+                              (key, query, json.dumps(results), now, now))
+            self._evict(now)
+
+    def remember(self, node_id: str, query: str):
+        """Record that `node_id` was expanded with `query`."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO expansions VALUES (?, ?, ?)", (node_id, query, time.time()))
+
+    def _evict(self, now: float):
+        # Expired entries first, then the least recently used beyond the size limit
+        expired = self.conn.execute("DELETE FROM searches WHERE created_at < ?", (now - self.ttl,)).rowcount
+        overflow = self.conn.execute(
+            "DELETE FROM searches WHERE key IN (SELECT key FROM searches ORDER BY accessed_at DESC "
+            "LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+        self.conn.execute("DELETE FROM expansions WHERE created_at < ?", (now - self.ttl,))
+        self.evictions += expired + overflow
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "node_hits": self.node_hits,  # Expansions that reused their node's query
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+search_cache = SearchCache()
@@ -0,0 +1,95 @@
+"""
+In-process coalescing of identical concurrent requests (a double click, a frontend
+retry): the first request for a key starts the work, later requests for the same key
+while it runs wait for that work instead of starting it again.
+
+The work runs as its own task, so it finishes (and its result is persisted) even if
+every request waiting on it goes away.
+"""
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+import metrics
+
+
+class _Broadcast:
+    """Replays the items of one async iterator to any number of subscribers, late ones included."""
+
+    def __init__(self, source: AsyncIterator):
+        self.items: List[Any] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._wake()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator:
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.items):
+                yield self.items[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+def _kind(key: Hashable) -> str:
+    # Keys are (endpoint, id, ...) tuples; the endpoint labels the counters
+    return str(key[0]) if isinstance(key, tuple) else "other"
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self._streams: Dict[Hashable, _Broadcast] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        """Await `fn()`, or the call already running for `key`."""
+        task = self._calls.get(key)
+        if task is None:
+            metrics.incr("singleflight_calls_total", kind=_kind(key))
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._forget(self._calls, key, done))
+        else:
+            metrics.incr("singleflight_coalesced_total", kind=_kind(key))
+        # One waiter giving up must not cancel the call the others wait for
+        return await asyncio.shield(task)
+
+    def stream(self, key: Hashable, factory: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """Iterate `factory()`, or join the stream already running for `key` from its first item."""
+        broadcast = self._streams.get(key)
+        if broadcast is None or broadcast.done:
+            metrics.incr("singleflight_calls_total", kind=_kind(key))
+            broadcast = self._streams[key] = _Broadcast(factory())
+            broadcast.task.add_done_callback(lambda done: self._forget(self._streams, key, broadcast))
+        else:
+            metrics.incr("singleflight_coalesced_total", kind=_kind(key))
+        return broadcast.subscribe()
+
+    @staticmethod
+    def _forget(flights: dict, key: Hashable, flight):
+        if isinstance(flight, asyncio.Future) and not flight.cancelled():
+            flight.exception()  # retrieved here, so an error nobody awaited is not logged as lost
+        if flights.get(key) is flight:
+            del flights[key]
+
+
+inflight = SingleFlight()
@@ -0,0 +1,380 @@
+"""
+Whole sessions in one go. `GET /sessions/{session_id}` returns a session's hubs with
+their nodes, questions and images (a few SELECTs, however big the session), and a
+session can be exported as one zip archive and imported again, here or on another
+server, without re-running the pipeline.
+
+Every change a snapshot shows bumps the session's `version` in the same transaction,
+and the snapshot's weak ETag is made from it: revalidating an unchanged session costs
+one indexed read and a 304. Snapshots are gzip or brotli compressed when the client
+accepts it, and sent as msgpack rather than JSON when it asks for that.
+"""
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+import zipfile
+from datetime import datetime
+from typing import BinaryIO, List, Optional, Tuple
+
+from fastapi import Response
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload
+
+from database import Dataset, Hub, HubResponse, Image, Node, NodeResponse, Question, Session, SessionResponse, \
+    session_scope
+from image_store import (CHUNK_SIZE, accepted, check_digest, check_variant, image_path, legacy_image_bytes,
+                         store_image, store_variant, variant_name, variant_path)
+from uploads import MAX_UPLOAD_BYTES
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # JSON only
+    msgpack = None
+
+SNAPSHOT_MIN_COMPRESS = int(os.getenv("SNAPSHOT_MIN_COMPRESS", "1024"))  # bytes below which compressing is not worth it
+SNAPSHOT_BROTLI_QUALITY = int(os.getenv("SNAPSHOT_BROTLI_QUALITY", "5"))  # 11 compresses a few % better, 10x slower
+ARCHIVE_FORMAT = 1  # version of the export archive layout
+ARCHIVE_SPOOL_BYTES = 16 * 1024 * 1024  # archives bigger than this are built on disk
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def bump_version(db, hub_id: Optional[str] = None, session_id: Optional[str] = None):
+    """
+    Mark a session changed, given it or one of its hubs, so its snapshot ETag changes.
+    Part of the caller's transaction, so the new version and the change commit together.
+    """
+    if session_id is None:
+        session_id = select(Hub.session_id).where(Hub.id == hub_id).scalar_subquery()
+    db.query(Session).filter(Session.id == session_id) \
+        .update({Session.version: func.coalesce(Session.version, 0) + 1}, synchronize_session=False)
+
+
+def session_version(session_id: str) -> Optional[int]:
+    """The session's version, or None if there is no such session."""
+    with session_scope() as db:
+        row = db.query(Session.version).filter(Session.id == session_id).first()
+        return None if row is None else row.version or 0
+
+
+def etag(version: int, fmt: str) -> str:
+    # Weak: gzip, brotli and identity bodies of one version are the same snapshot
+    return f'W/"{version}"' if fmt == "json" else f'W/"{version}-{fmt}"'
+
+
+def not_modified(if_none_match: Optional[str], tag: str) -> bool:
+    # If-None-Match uses the weak comparison, so a W/ prefix on either side does not matter
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return tag.removeprefix("W/") in {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+
+
+def snapshot_format(fmt: Optional[str], accept: Optional[str]) -> str:
+    """The encoding asked for by `?format=`, else by the Accept header; JSON unless msgpack is asked for."""
+    if fmt:
+        return fmt
+    if msgpack is not None and accepted(accept) & set(MSGPACK_TYPES):
+        return "msgpack"
+    return "json"
+
+
+def load_session(session_id: str) -> Optional[Tuple[int, dict]]:
+    """
+    The session's version and SessionResponse (nodes in creation order), read in one
+    transaction so the two match; None if there is no such session.
+    """
+    with session_scope() as db:
+        session = (
+            db.query(Session)
+            .filter(Session.id == session_id)
+            .options(selectinload(Session.hubs).selectinload(Hub.nodes)
+                     .options(selectinload(Node.images), selectinload(Node.questions)))
+            .first()
+        )
+        if session is None:
+            return None
+        version = session.version or 0
+        snapshot = SessionResponse(id=session.id, version=version, hubs=[
+            HubResponse(id=hub.id, file_name=hub.file_name, assistant_id=hub.assistant_id,
+                        reduction=json.loads(hub.reduction) if hub.reduction else None, nodes=[
+                NodeResponse.model_validate(node, from_attributes=True)
+                for node in sorted(hub.nodes, key=lambda node: (node.created_at or datetime.min, node.id))
+            ])
+            for hub in session.hubs
+        ])
+        return version, snapshot.model_dump(mode="json")
+
+
+def _compress(body: bytes, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    encodings = accepted(accept_encoding)
+    if len(body) < SNAPSHOT_MIN_COMPRESS:
+        return body, None
+    if brotli is not None and "br" in encodings:
+        return brotli.compress(body, quality=SNAPSHOT_BROTLI_QUALITY), "br"
+    if "gzip" in encodings:
+        return gzip.compress(body, compresslevel=6), "gzip"
+    return body, None
+
+
+def _headers(tag: str) -> dict:
+    # Clients keep the snapshot but check back with its ETag every time
+    return {"ETag": tag, "Cache-Control": "no-cache", "Vary": "Accept, Accept-Encoding"}
+
+
+def not_modified_response(tag: str) -> Response:
+    return Response(status_code=304, headers=_headers(tag))
+
+
+def snapshot_response(snapshot: dict, tag: str, fmt: str, accept_encoding: Optional[str]) -> Response:
+    """Encode a snapshot as JSON or msgpack, compressed as the client accepts, with its ETag."""
+    if fmt == "msgpack":
+        body, media_type = msgpack.packb(snapshot), MSGPACK_TYPES[0]
+    else:
+        body, media_type = json.dumps(snapshot, separators=(",", ":")).encode(), "application/json"
+    body, encoding = _compress(body, accept_encoding)
+    headers = _headers(tag)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def export_rows(session_id: str) -> Optional[dict]:
+    """The archive manifest: every row of the session's hubs, nodes, questions and images."""
+    with session_scope() as db:
+        session = (
+            db.query(Session)
+            .filter(Session.id == session_id)
+            .options(selectinload(Session.hubs).selectinload(Hub.nodes)
+                     .options(selectinload(Node.images).undefer(Image.data), selectinload(Node.questions)))
+            .first()
+        )
+        if session is None:
+            return None
+        hubs = []
+        for hub in session.hubs:
+            nodes = []
+            for node in sorted(hub.nodes, key=lambda node: (node.created_at or datetime.min, node.id)):
+                nodes.append({
+                    "id": node.id, "prompt": node.prompt, "text": node.text, "title": node.title,
+                    "thread_id": node.thread_id, "parent_node_id": node.parent_node_id,
+                    "created_at": node.created_at.isoformat() if node.created_at else None,
+                    "source_url": node.source_url,
+                    "questions": [{"id": question.id, "content": question.content,
+                                   "answer_node_id": question.answer_node_id} for question in node.questions],
+                    "images": [_image_row(image) for image in node.images],
+                })
+            hubs.append({"id": hub.id, "file_name": hub.file_name, "assistant_id": hub.assistant_id,
+                         "dataset_hash": hub.dataset_hash, "profile": hub.profile, "reduction": hub.reduction,
+                         "nodes": nodes})
+        return {"format": ARCHIVE_FORMAT, "exported_at": datetime.utcnow().isoformat(),
+                "session": {"id": session.id, "hubs": hubs}}
+
+
+def _image_row(image: Image) -> dict:
+    digest = image.sha256
+    data = legacy_image_bytes(image.data) if digest is None else None
+    if data is not None:
+        # A legacy inline image goes in the archive like any other; one with no data is left out
+        digest = store_image(data)
+    return {"sha256": digest, "media_type": image.media_type, "width": image.width, "height": image.height,
+            "derivatives": json.loads(image.derivatives) if image.derivatives else None}
+
+
+def _archive_images(manifest: dict) -> List[dict]:
+    return [image for hub in manifest["session"]["hubs"] for node in hub["nodes"] for image in node["images"]
+            if image["sha256"]]
+
+
+def write_archive(manifest: dict) -> BinaryIO:
+    """
+    The export archive, rewound: `session.json` (the manifest) and under `images/` each
+    chart and its variants, named as in the image store.
+    """
+    archive = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_BYTES)
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("session.json", json.dumps(manifest), compress_type=zipfile.ZIP_DEFLATED)
+        written = set()
+        for image in _archive_images(manifest):
+            digest = image["sha256"]
+            # PNG, WebP and AVIF are compressed already
+            files = [(digest, image_path(digest))] + [
+                (f"{digest}.{variant_name(variant['width'], variant['format'])}",
+                 variant_path(digest, variant["width"], variant["format"]))
+                for variant in image["derivatives"] or []
+            ]
+            for name, path in files:
+                if name not in written and os.path.exists(path):
+                    zf.write(path, f"images/{name}", compress_type=zipfile.ZIP_STORED)
+                    written.add(name)
+    archive.seek(0)
+    return archive
+
+
+def iter_archive(archive: BinaryIO):
+    """The archive in chunks, closing (and so deleting) it at the end."""
+    with archive:
+        while chunk := archive.read(CHUNK_SIZE):
+            yield chunk
+
+
+class _ArchiveImage(BaseModel):
+    sha256: Optional[str]
+    media_type: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    derivatives: Optional[List[dict]] = None
+
+
+class _ArchiveQuestion(BaseModel):
+    content: str
+    answer_node_id: Optional[str] = None
+
+
+class _ArchiveNode(BaseModel):
+    id: str
+    prompt: Optional[str]
+    text: Optional[str]
+    title: Optional[str]
+    thread_id: Optional[str]
+    parent_node_id: Optional[str]
+    created_at: Optional[datetime] = None
+    source_url: Optional[str] = None
+    questions: List[_ArchiveQuestion]
+    images: List[_ArchiveImage]
+
+
+class _ArchiveHub(BaseModel):
+    id: str
+    file_name: Optional[str]
+    assistant_id: Optional[str] = None
+    dataset_hash: Optional[str] = None
+    profile: Optional[str] = None
+    reduction: Optional[str] = None
+    nodes: List[_ArchiveNode]
+
+
+class _ArchiveSession(BaseModel):
+    hubs: List[_ArchiveHub]
+
+
+class _Archive(BaseModel):
+    # The shape of session.json, as export_rows writes it
+    format: int
+    exported_at: Optional[str] = None
+    session: _ArchiveSession
+
+
+def read_archive(file: BinaryIO) -> dict:
+    """
+    Check an export archive and put its images in the image store; returns its manifest.
+    Raises ValueError for anything that is not an intact archive of a known format.
+    """
+    try:
+        zf = zipfile.ZipFile(file)
+    except zipfile.BadZipFile:
+        raise ValueError("Not a zip archive")
+    with zf:
+        if any(info.file_size > MAX_UPLOAD_BYTES for info in zf.infolist()):
+            # Checked before anything is inflated
+            raise ValueError(f"An archive member exceeds {MAX_UPLOAD_BYTES} bytes")
+        try:
+            manifest = json.loads(zf.read("session.json"))
+        except (KeyError, ValueError):
+            raise ValueError("The archive has no readable session.json")
+        if not isinstance(manifest, dict):
+            raise ValueError("session.json is not an object")
+        if manifest.get("format") != ARCHIVE_FORMAT:
+            raise ValueError(f"Unsupported archive format {manifest.get('format')!r}")
+        try:
+            # Every row import_rows reads is checked here, so a malformed manifest is refused as a whole
+            manifest = _Archive.model_validate(manifest).model_dump()
+        except ValidationError as e:
+            error = e.errors()[0]
+            raise ValueError(f"Malformed session.json at {'.'.join(map(str, error['loc']))}: {error['msg']}")
+        names = set(zf.namelist())
+        for image in _archive_images(manifest):
+            digest = image["sha256"]
+            # Names in the manifest become paths in the image store, so only well-formed ones get that far
+            check_digest(digest)
+            for variant in image["derivatives"] or []:
+                check_variant(digest, variant.get("width"), variant.get("format"))
+            if f"images/{digest}" not in names:
+                raise ValueError(f"The archive is missing image {digest}")
+            data = zf.read(f"images/{digest}")
+            # Content addressed: a renamed or damaged image is caught here
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise ValueError(f"Image {digest} does not match its hash")
+            store_image(data)
+            kept = []
+            for variant in image["derivatives"] or []:
+                name = f"images/{digest}.{variant_name(variant['width'], variant['format'])}"
+                if name in names:
+                    store_variant(digest, variant["width"], variant["format"], zf.read(name))
+                    kept.append(variant)
+            # Variants missing from the archive are left out, the original is served instead
+            image["derivatives"] = kept if image["derivatives"] is not None else None
+    return manifest
+
+
+def import_rows(manifest: dict) -> dict:
+    """
+    Insert an archived session, as checked by read_archive, as a new session with new ids
+    throughout. A hub keeps its assistant (and takes a reference on it) only if this server
+    knows its dataset; otherwise its nodes can be browsed but not asked further questions.
+    """
+    hubs = manifest["session"]["hubs"]
+    ids = {row["id"]: str(uuid.uuid4()) for hub in hubs for row in [hub, *hub["nodes"]]}
+
+    def new_id(old_id: Optional[str]) -> Optional[str]:
+        # A reference to a row outside the archive (e.g. an answer node that is gone) is dropped
+        return ids.get(old_id)
+
+    with session_scope() as db:
+        session = Session()
+        db.add(session)
+        hub_ids = []
+        for hub_row in hubs:
+            dataset = db.get(Dataset, hub_row["dataset_hash"]) if hub_row.get("dataset_hash") else None
+            known = dataset is not None and dataset.assistant_id == hub_row.get("assistant_id")
+            if known:
+                dataset.ref_count += 1
+                dataset.last_used_at = datetime.utcnow()
+            hub = Hub(id=new_id(hub_row["id"]), file_name=hub_row["file_name"], profile=hub_row.get("profile"),
+                      reduction=hub_row.get("reduction"), assistant_id=hub_row.get("assistant_id") if known else None,
+                      dataset_hash=hub_row.get("dataset_hash") if known else None, session=session)
+            db.add(hub)
+            hub_ids.append(hub.id)
+            for node_row in hub_row["nodes"]:
+                node = Node(id=new_id(node_row["id"]), prompt=node_row["prompt"], text=node_row["text"],
+                            title=node_row["title"], thread_id=node_row["thread_id"],
+                            parent_node_id=new_id(node_row["parent_node_id"]), hub_id=hub.id,
+                            source_url=node_row.get("source_url"),
+                            created_at=node_row["created_at"] or datetime.utcnow())
+                for question_row in node_row["questions"]:
+                    node.questions.append(Question(content=question_row["content"],
+                                                   answer_node_id=new_id(question_row.get("answer_node_id"))))
+                for image_row in node_row["images"]:
+                    if not image_row["sha256"]:
+                        continue
+                    derivatives = image_row.get("derivatives")
+                    node.images.append(Image(
+                        sha256=image_row["sha256"], size=os.path.getsize(image_path(image_row["sha256"])),
+                        media_type=image_row.get("media_type") or "image/png", width=image_row.get("width"),
+                        height=image_row.get("height"),
+                        derivatives=json.dumps(derivatives) if derivatives is not None else None))
+                db.add(node)
+        # Flush to assign the image ids their URLs are built from
+        db.flush()
+        for image in db.query(Image).join(Node).filter(Node.hub_id.in_(hub_ids)):
+            image.generate_url()
+        return {"session": session.id, "hubs": hub_ids}
@@ -0,0 +1,117 @@
+import json
+import re
+from typing import Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
+
+from consts import DELIMITER
+
+
+class _Strict(BaseModel):
+    # Strict JSON-schema outputs require additionalProperties: false
+    model_config = ConfigDict(extra="forbid")
+
+
+class Instructions(_Strict):
+    instructions: List[str]
+
+
+class Title(_Strict):
+    title: str
+
+
+class Questions(_Strict):
+    questions: List[str]
+
+
+class SourceSummary(_Strict):
+    summary: str
+    title: str
+
+
+def response_format(schema: Type[BaseModel], fields: Optional[List[str]] = None) -> dict:
+    """
+    Structured-output `response_format` for a run, optionally restricted to some fields
+    of the schema (used when asking only for the fields a reply was missing).
+    """
+    json_schema = schema.model_json_schema()
+    if fields:
+        json_schema["properties"] = {name: json_schema["properties"][name] for name in fields}
+        json_schema["required"] = list(fields)
+    return {"type": "json_schema",
+            "json_schema": {"name": schema.__name__, "schema": json_schema, "strict": True}}
+
+
+def _json_object(text: str) -> Optional[dict]:
+    # Models sometimes wrap JSON in prose or a code fence, take the outermost object
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        value = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def _delimited(schema: Type[BaseModel], text: str) -> dict:
+    # Salvage the old ~delimited~ format: lists take every span, scalar fields one span each in order
+    spans = [span.strip() for span in re.findall(rf'{DELIMITER}(.*?){DELIMITER}', text, re.DOTALL) if span.strip()]
+    if not spans:
+        return {}
+    fields = schema.model_fields
+    list_fields = [name for name, field in fields.items() if getattr(field.annotation, "__origin__", None) is list]
+    if list_fields:
+        return {list_fields[0]: spans}
+    return dict(zip(fields, spans))
+
+
+def parse(schema: Type[BaseModel], text: str, counts: Optional[Dict[str, int]] = None,
+          partial: Optional[dict] = None) -> Tuple[dict, Dict[str, str]]:
+    """
+    Parse a reply against `schema`, merging it into `partial` (fields already recovered).
+    `counts` gives the required number of items for list fields; extra items are dropped.
+
+    Returns:
+    Tuple[dict, Dict[str, str]]: The recovered fields and a problem description per field
+    that is still missing or invalid.
+    """
+    data = dict(partial or {})
+    candidate = _json_object(text) or _delimited(schema, text)
+    if not candidate and len(schema.model_fields) == 1 and text.strip():
+        # A single scalar field may come back as plain text
+        name = next(iter(schema.model_fields))
+        if schema.model_fields[name].annotation is str:
+            candidate = {name: text.strip().strip('"')}
+
+    problems = {}
+    for name, field in schema.model_fields.items():
+        try:
+            value = TypeAdapter(field.annotation).validate_python(candidate.get(name))
+        except ValidationError:
+            value = None
+        if isinstance(value, list):
+            value = [item.strip() for item in value if isinstance(item, str) and item.strip()]
+            merged = list(dict.fromkeys((data.get(name) or []) + value))
+            data[name] = merged[:counts[name]] if counts and name in counts else merged
+        elif isinstance(value, str) and value.strip():
+            data[name] = value.strip()
+
+        if name not in data or data[name] in (None, [], ""):
+            problems[name] = "missing"
+        elif counts and name in counts and len(data[name]) < counts[name]:
+            problems[name] = f"needs {counts[name]} items, got {len(data[name])}"
+    return data, problems
+
+
+def repair_prompt(schema: Type[BaseModel], problems: Dict[str, str], data: dict) -> str:
+    """Prompt asking only for the fields that are still missing or short."""
+    asks = []
+    for name, problem in problems.items():
+        if problem.startswith("needs") and data.get(name):
+            asks.append(f"`{name}`: {problem}. Give only the missing additional items, different from: "
+                        f"{json.dumps(data[name])}")
+        else:
+            asks.append(f"`{name}`: {problem}")
+    return (f"Your previous reply could not be used as-is. Reply with only a JSON object containing these "
+            f"fields of {schema.__name__}: " + "; ".join(asks))
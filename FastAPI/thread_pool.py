@@ -0,0 +1,75 @@
+"""
+Empty assistant threads created ahead of time. Every hub build, L2 expansion and
+answer needs fresh threads, and creating one is a full round trip to OpenAI; taking
+one from the pool is not. The pool is refilled in the background whenever it drops
+to its low-water mark.
+"""
+import asyncio
+import os
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional
+
+import metrics
+
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "32"))  # 0 turns the pool off
+THREAD_POOL_LOW_WATER = int(os.getenv("THREAD_POOL_LOW_WATER", "12"))
+THREAD_POOL_CONCURRENCY = int(os.getenv("THREAD_POOL_CONCURRENCY", "4"))  # creations in flight while refilling
+
+
+class ThreadPool:
+    def __init__(self, create: Callable[[], Awaitable[str]], size: int = THREAD_POOL_SIZE,
+                 low_water: int = THREAD_POOL_LOW_WATER, concurrency: int = THREAD_POOL_CONCURRENCY):
+        self._create = create
+        self.size = size
+        self.low_water = min(low_water, size)
+        self.concurrency = max(concurrency, 1)
+        self.hits = 0
+        self.misses = 0
+        self._ready: Deque[str] = deque()
+        self._refill: Optional[asyncio.Task] = None
+
+    async def take(self) -> str:
+        """A ready thread id, or a thread created on the spot when the pool is empty."""
+        if self._ready:
+            self.hits += 1
+            metrics.incr("thread_pool_takes_total", result="hit")
+            thread_id = self._ready.popleft()
+        else:
+            self.misses += 1
+            metrics.incr("thread_pool_takes_total", result="miss")
+            thread_id = await self._create()
+        self.start()
+        return thread_id
+
+    def start(self):
+        """Refill the pool in the background if it is at or below the low-water mark."""
+        if len(self._ready) > self.low_water or self.size <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        if self._refill is not None and not self._refill.done() and self._refill.get_loop() is loop:
+            return
+        self._refill = loop.create_task(self._fill())
+
+    def stop(self):
+        if self._refill is not None and not self._refill.done():
+            self._refill.cancel()
+
+    async def _fill(self):
+        try:
+            while len(self._ready) < self.size:
+                batch = min(self.concurrency, self.size - len(self._ready))
+                self._ready.extend(await asyncio.gather(*(self._create() for _ in range(batch))))
+        except Exception as e:
+            # Requests still get threads, created on the spot, until the next refill works
+            print(f"Refilling the thread pool failed: {e}")
+
+    def stats(self) -> dict:
+        takes = self.hits + self.misses
+        return {
+            "ready": len(self._ready),
+            "size": self.size,
+            "low_water": self.low_water,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / takes if takes else 0.0,
+        }
@@ -0,0 +1,280 @@
+"""
+Spans: named, timed stages of the pipeline (an assistant run, its wait for a scheduler
+slot, the message fetch, an Exa search, a DB commit, ...).
+
+Every span feeds the `span_duration_seconds` histogram on /metrics. Spans recorded
+while working for a hub are also written to the `spans` table in batches, so
+/hubs/{hub_id}/timings can break a slow build down by stage, across the API process
+and every worker process.
+
+The trace (trace id, current span, hub and job) lives in a context variable, so it
+follows the work into the asyncio tasks it starts and, through `run_db`, onto the DB
+executor. Jobs carry it in their payload to whichever worker runs them (see
+jobs.enqueue and worker._run_job), and a request's `traceparent` header is honoured.
+"""
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import metrics
+from database import SessionLocal, Span, run_db, session_scope
+
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "2"))  # seconds between span writes
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "10000"))  # spans held before new ones are dropped
+
+
+class _Trace:
+    __slots__ = ("trace_id", "span_id", "hub_id", "job_id")
+
+    def __init__(self, trace_id: str, span_id: Optional[str] = None, hub_id: Optional[str] = None,
+                 job_id: Optional[str] = None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.hub_id = hub_id
+        self.job_id = job_id
+
+
+_current: ContextVar[Optional[_Trace]] = ContextVar("trace", default=None)
+_lock = threading.Lock()
+_buffer: List[dict] = []
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def _reset(token):
+    try:
+        _current.reset(token)
+    except ValueError:
+        pass  # an async generator closed from another context, which has its own trace
+
+
+def carrier() -> dict:
+    """The current trace as plain values, to hand to a job; empty outside a trace."""
+    trace = _current.get()
+    if trace is None:
+        return {}
+    return {"trace_id": trace.trace_id, "parent_id": trace.span_id}
+
+
+@contextmanager
+def bind(trace_id: Optional[str] = None, parent_id: Optional[str] = None, hub_id: Optional[str] = None,
+         job_id: Optional[str] = None):
+    """
+    Continue the trace `trace_id` (or the current one, or a new one) for the block,
+    attributing the spans recorded in it to `hub_id` and `job_id` when given.
+    """
+    current = _current.get()
+    trace = _Trace(
+        trace_id or (current.trace_id if current else uuid.uuid4().hex),
+        parent_id or (current.span_id if current else None),
+        hub_id or (current.hub_id if current else None),
+        job_id or (current.job_id if current else None),
+    )
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _reset(token)
+
+
+def _finish(trace: Optional[_Trace], span_id: str, name: str, started: float, duration: float,
+            status: str, attrs: dict):
+    metrics.observe("span_duration_seconds", duration, span=name)
+    if status != "ok":
+        metrics.incr("span_errors_total", span=name, status=status)
+    if trace is None or trace.hub_id is None:
+        return
+    record = {
+        "id": span_id, "trace_id": trace.trace_id, "parent_id": trace.span_id, "hub_id": trace.hub_id,
+        "job_id": trace.job_id, "name": name, "started_at": datetime.utcfromtimestamp(started),
+        "duration": duration, "status": status, "attrs": json.dumps(attrs, default=str) if attrs else None,
+    }
+    with _lock:
+        if len(_buffer) >= TRACE_BUFFER_SIZE:
+            metrics.incr("spans_dropped_total")
+            return
+        _buffer.append(record)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Time the block as the span `name`. Yields its attributes, so the block can add
+    what it learns (token usage, run status, ...); a block that raises is recorded
+    with status "error" (or "cancelled") and the error.
+    """
+    parent = _current.get()
+    span_id = _new_id()
+    token = _current.set(_Trace(parent.trace_id if parent else uuid.uuid4().hex, span_id,
+                                parent.hub_id if parent else None, parent.job_id if parent else None))
+    started, start = time.time(), time.perf_counter()
+    status = "ok"
+    try:
+        yield attrs
+    except (asyncio.CancelledError, GeneratorExit):
+        # Cancelled, or a streaming reply whose client went away
+        status = "cancelled"
+        raise
+    except BaseException as e:
+        status = "error"
+        attrs["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _reset(token)
+        _finish(parent, span_id, name, started, time.perf_counter() - start, status, attrs)
+
+
+def record(name: str, duration: float, **attrs):
+    """Record a stage measured elsewhere (e.g. a wait for a scheduler slot) as a span that just ended."""
+    _finish(_current.get(), _new_id(), name, time.time() - duration, duration, "ok", attrs)
+
+
+# DB commits are timed from the session events, so every session_scope and get_db commit is covered
+@event.listens_for(SessionLocal, "before_commit")
+def _commit_started(session):
+    session.info["commit_started"] = (time.time(), time.perf_counter())
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _commit_finished(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        _finish(_current.get(), _new_id(), "db.commit", started[0], time.perf_counter() - started[1], "ok", {})
+
+
+def _store(records: List[dict]):
+    # One executemany for the whole batch (bulk_insert_mappings splits it on every None)
+    with session_scope() as db:
+        db.execute(Span.__table__.insert(), records)
+
+
+async def flush():
+    """Write the buffered spans to the `spans` table."""
+    with _lock:
+        records = _buffer[:]
+        _buffer.clear()
+    if not records:
+        return
+    try:
+        await run_db(_store, records)
+    except Exception as e:
+        metrics.incr("spans_dropped_total", len(records))
+        print(f"Writing {len(records)} spans failed: {e}")
+
+
+async def flush_forever(interval: float = TRACE_FLUSH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        await flush()
+
+
+def _percentile(values: List[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def hub_timings(hub_id: str, slowest: int = 10) -> dict:
+    """
+    Where a hub's time went: per span name the count, errors, total, mean, p50, p95
+    and max seconds (largest total first), OpenAI token usage, the wall time from
+    the first span to the end of the last, the `slowest` single spans and the failures.
+    """
+    with session_scope() as db:
+        spans = db.query(Span).filter(Span.hub_id == hub_id).order_by(Span.started_at).all()
+    if not spans:
+        return {"hub_id": hub_id, "traces": 0, "wall_seconds": 0.0, "stages": [],
+                "tokens": {"prompt": 0, "completion": 0},
+                "slowest": [], "errors": []}
+
+    by_name: Dict[str, List[Span]] = {}
+    tokens = {"prompt": 0, "completion": 0}
+    for row in spans:
+        by_name.setdefault(row.name, []).append(row)
+        attrs = json.loads(row.attrs) if row.attrs else {}
+        if row.name == "openai.run":
+            tokens["prompt"] += attrs.get("prompt_tokens", 0)
+            tokens["completion"] += attrs.get("completion_tokens", 0)
+
+    stages = []
+    for name, rows in by_name.items():
+        durations = sorted(row.duration for row in rows)
+        stages.append({
+            "name": name,
+            "count": len(rows),
+            "errors": sum(row.status != "ok" for row in rows),
+            "total_seconds": sum(durations),
+            "mean_seconds": sum(durations) / len(durations),
+            "p50_seconds": _percentile(durations, 50),
+            "p95_seconds": _percentile(durations, 95),
+            "max_seconds": durations[-1],
+        })
+    stages.sort(key=lambda stage: stage["total_seconds"], reverse=True)
+
+    def describe(row: Span) -> dict:
+        return {"name": row.name, "started_at": row.started_at, "duration": row.duration, "status": row.status,
+                "trace_id": row.trace_id, "job_id": row.job_id, "attrs": json.loads(row.attrs) if row.attrs else {}}
+
+    end = max(row.started_at.timestamp() + row.duration for row in spans)
+    return {
+        "hub_id": hub_id,
+        "traces": len({row.trace_id for row in spans}),
+        "wall_seconds": end - spans[0].started_at.timestamp(),
+        "stages": stages,
+        "tokens": tokens,
+        "slowest": [describe(row) for row in sorted(spans, key=lambda row: row.duration, reverse=True)[:slowest]],
+        "errors": [describe(row) for row in spans if row.status != "ok"],
+    }
+
+
+def delete_hub_spans(db, hub_id: str):
+    db.query(Span).filter(Span.hub_id == hub_id).delete(synchronize_session=False)
+
+
+class TraceMiddleware:
+    """
+    Start (or continue, from a W3C `traceparent` header) a trace for each request,
+    return its id in `X-Trace-Id`, and time the request into `http_request_duration_seconds`.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace_id = parent_id = None
+        traceparent = dict(scope["headers"]).get(b"traceparent", b"").decode("latin-1").split("-")
+        if len(traceparent) == 4 and len(traceparent[1]) == 32 and len(traceparent[2]) == 16:
+            trace_id, parent_id = traceparent[1], traceparent[2]
+        status = [500]
+
+        async def send_with_trace(message: Message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-trace-id", trace.trace_id.encode())]
+            await send(message)
+
+        start = time.perf_counter()
+        with bind(trace_id, parent_id) as trace:
+            try:
+                await self.app(scope, receive, send_with_trace)
+            finally:
+                # Labelled by endpoint function rather than path, which holds ids
+                endpoint = getattr(scope.get("endpoint"), "__name__", "unmatched")
+                metrics.observe("http_request_duration_seconds", time.perf_counter() - start,
+                                endpoint=endpoint, method=scope["method"], status=status[0])
@@ -0,0 +1,97 @@
+"""
+Tree queries over the self-referential Node table. A node's subtree and its ancestry
+are each fetched with a single statement: a recursive CTE walks parent_node_id (using
+ix_nodes_parent_created), and the images and questions are outer-joined into the same
+SELECT. Rows are read as plain columns, not ORM objects, since a subtree can hold
+thousands of nodes.
+"""
+from typing import List, Optional
+
+from sqlalchemy import literal, select
+from sqlalchemy.orm import Session, aliased
+
+from database import Image, Node, Question, image_thumbnail_url, image_variants
+
+# Deepest walk either query makes, also a guard against a parent cycle in bad data
+MAX_TREE_DEPTH = 64
+
+_NODE_COLUMNS = (Node.id, Node.prompt, Node.text, Node.title, Node.thread_id, Node.parent_node_id)
+
+
+def _nodes(db: Session, walk, order) -> List[dict]:
+    # One row per (node, image, question) combination, folded back into NodeResponse dicts
+    rows = db.execute(
+        select(*_NODE_COLUMNS, walk.c.depth, Image.id, Image.url, Image.width, Image.height, Image.derivatives,
+               Question.id, Question.content)
+        .join(walk, Node.id == walk.c.id)
+        .outerjoin(Image, Image.node_id == Node.id)
+        .outerjoin(Question, Question.node_id == Node.id)
+        .order_by(*order)
+    )
+    nodes = {}
+    for (node_id, prompt, text, title, thread_id, parent_id, depth,
+         image_id, url, width, height, derivatives, question_id, content) in rows:
+        node = nodes.get(node_id)
+        if node is None:
+            node = nodes[node_id] = {
+                "id": node_id, "prompt": prompt, "text": text, "title": title, "thread_id": thread_id,
+                "parent_node_id": parent_id, "depth": depth, "images": {}, "questions": {},
+            }
+        if image_id is not None and image_id not in node["images"]:
+            # The same shape as ImageResponse gives the node listings
+            node["images"][image_id] = {"id": image_id, "url": url, "width": width, "height": height,
+                                        "thumbnail_url": image_thumbnail_url(url, width, derivatives),
+                                        "variants": image_variants(url, derivatives)}
+        if question_id is not None:
+            node["questions"].setdefault(question_id, {"id": question_id, "content": content})
+    for node in nodes.values():
+        node["images"] = list(node["images"].values())
+        node["questions"] = list(node["questions"].values())
+    return list(nodes.values())
+
+
+def subtree(db: Session, node_id: str, depth: Optional[int] = None) -> Optional[dict]:
+    """
+    The node and its descendants down to `depth` levels below it, nested through
+    `children` (in creation order). Returns None if the node does not exist.
+    """
+    depth = MAX_TREE_DEPTH if depth is None else min(depth, MAX_TREE_DEPTH)
+    walk = (select(Node.id.label("id"), literal(0).label("depth"))
+            .where(Node.id == node_id)
+            .cte("subtree", recursive=True))
+    child = aliased(Node)
+    walk = walk.union_all(
+        select(child.id, walk.c.depth + 1)
+        .join(walk, child.parent_node_id == walk.c.id)
+        .where(walk.c.depth < depth)
+    )
+    nodes = _nodes(db, walk, (walk.c.depth, Node.created_at, Node.id))
+
+    # Nodes come parents first, so every child finds its parent already placed
+    placed = {}
+    for node in nodes:
+        node["children"] = []
+        placed[node["id"]] = node
+        if node["depth"] > 0:
+            placed[node["parent_node_id"]]["children"].append(node)
+    return nodes[0] if nodes else None
+
+
+def ancestors(db: Session, node_id: str) -> Optional[List[dict]]:
+    """
+    The path from the root of the node's tree down to its parent (empty for a root).
+    Returns None if the node does not exist.
+    """
+    walk = (select(Node.id.label("id"), Node.parent_node_id.label("parent_node_id"), literal(0).label("depth"))
+            .where(Node.id == node_id)
+            .cte("ancestors", recursive=True))
+    parent = aliased(Node)
+    walk = walk.union_all(
+        select(parent.id, parent.parent_node_id, walk.c.depth + 1)
+        .join(walk, parent.id == walk.c.parent_node_id)
+        .where(walk.c.depth < MAX_TREE_DEPTH)
+    )
+    nodes = _nodes(db, walk, (walk.c.depth.desc(),))
+    if not nodes:
+        return None
+    return [node for node in nodes if node["depth"] > 0]
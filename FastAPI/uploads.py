@@ -0,0 +1,95 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Tuple
+
+from fastapi import HTTPException, UploadFile
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(1024 ** 3)))  # 1 GiB
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./uploads")  # Datasets kept until the hub build has uploaded them to OpenAI
+CHUNK_SIZE = 1024 * 1024
+
+
+async def hash_upload(file: UploadFile) -> Tuple[str, int]:
+    """
+    Hash an upload chunk by chunk, enforcing MAX_UPLOAD_BYTES, and rewind it for reading.
+    Starlette has already spooled the body to a temporary file, so nothing here holds
+    more than one chunk in memory.
+
+    Returns:
+    Tuple[str, int]: The SHA-256 hex digest and size in bytes of the upload.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    await file.seek(0)
+    while chunk := await file.read(CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"File exceeds {MAX_UPLOAD_BYTES} bytes")
+        digest.update(chunk)
+    await file.seek(0)
+    return digest.hexdigest(), size
+
+
+def upload_path(hub_id: str) -> str:
+    return os.path.join(UPLOAD_DIR, hub_id)
+
+
+def reduced_path(hub_id: str) -> str:
+    # The reduced copy the build uploads instead, see reduction.py
+    return os.path.join(UPLOAD_DIR, f"{hub_id}.reduced")
+
+
+def save_upload(file: BinaryIO, hub_id: str) -> str:
+    """
+    Copy a spooled upload to the hub's file under UPLOAD_DIR, chunk by chunk, so the
+    build can read it after the request (and its temporary file) is gone.
+
+    Returns:
+    str: The path of the saved file.
+    """
+    path = upload_path(hub_id)
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    file.seek(0)
+    # Write to a temp file and rename so the build never reads a partial upload
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR)
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            shutil.copyfileobj(file, tmp, CHUNK_SIZE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+def remove_upload(hub_id: str):
+    for path in (upload_path(hub_id), reduced_path(hub_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadLimitMiddleware:
+    """
+    Reject uploads whose declared Content-Length is over the limit before the multipart
+    body is parsed (and spooled to disk) at all.
+    """
+
+    def __init__(self, app: ASGIApp, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and scope["method"] == "POST":
+            content_length = dict(scope["headers"]).get(b"content-length")
+            if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+                await send({"type": "http.response.start", "status": 413,
+                            "headers": [(b"content-type", b"application/json"), (b"connection", b"close")]})
+                await send({"type": "http.response.body",
+                            "body": f'{{"detail": "File exceeds {self.max_bytes} bytes"}}'.encode()})
+                return
+        await self.app(scope, receive, send)
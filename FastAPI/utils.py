@@ -1,23 +1,45 @@
-import multiprocessing
+import asyncio
 import os
+import random
 import re
 import uuid
 from io import BytesIO
 from dotenv import load_dotenv, find_dotenv
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI, NotFoundError
 from exa_py import Exa
 from pydantic import BaseModel
-from typing import BinaryIO, Tuple, List, Optional
+from typing import Any, AsyncIterator, BinaryIO, Dict, Tuple, List, Optional
+from datetime import datetime, timedelta
 import json
 from sqlalchemy.orm import Session
 
-from database import Hub, Node, Image, Question, get_db
+from database import Dataset, Hub, Node, Image, Question, get_db, run_db, session_scope
+from events import hub_events, node_event, BUILDING, COMPLETE, FAILED
+from image_store import run_encode, store_image, store_variants
+from llm_cache import llm_cache
+from search_cache import search_cache
+from snapshots import bump_version
+from thread_pool import ThreadPool
+from reduction import describe, plan as plan_reduction, reduce_file, reduced_hash, reduced_name
+from uploads import reduced_path, remove_upload, upload_path
+from jobs import JobRun, new_id as new_job_id
+from prefetch import prefetcher, skip_reason as prefetch_skip_reason
+from profiling import profile_csv, profile_nodes, profile_summary
+from scheduler import (BACKGROUND, EXA, INTERACTIVE, L2, OPENAI, openai_http_client,
+                       priority_context, scheduler)
+import metrics
+import structured
+import tracing
 from consts import INSTRUCTIONS, LEVEL_ONE_PROMPT_SUFFIX, ONE_LINER, INITIAL_PROMPT, SURPRISING, \
-    SUGGESTED_QUESTION_PROMPT, L2_OUTPUT, DELIMITER, RETRIES, LEVEL_ONE_HALF_PROMPT
+    SUGGESTED_QUESTION_PROMPT, L2_OUTPUT, L2_SEARCH_RESULTS, L2_MAX_SEARCH_RESULTS, DELIMITER, RETRIES, LEVEL_ONE_HALF_PROMPT, RUN_TOKEN_ESTIMATE, MODEL, \
+    ASSISTANT_METADATA, DATASET_GC_INTERVAL, DATASET_GC_GRACE, PROFILE_PROMPT, NUM_PROMPTS, NUM_QUESTIONS, \
+    STRUCTURED_OUTPUTS, REPAIR_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RATE_LIMIT_BACKOFF
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-exa = Exa(api_key=os.getenv("EXA_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=openai_http_client())
+# OPENAI_BASE_URL (read by the client) and EXA_BASE_URL point both at benchmarks/fake_server.py
+exa = Exa(api_key=os.getenv("EXA_API_KEY"), base_url=os.getenv("EXA_BASE_URL", "https://api.exa.ai"))
 
 class Response:
     def __init__(self, text_list: List[str], image_list: List[str]):
@@ -38,45 +60,282 @@ class ExaSearchResponse(BaseModel):
     total_results: int
 
 
-def create_assistant_for_file(file: BinaryIO) -> Tuple[str, str]:
+# One lock per content hash, so concurrent uploads of the same bytes create a single assistant
+_dataset_locks: Dict[str, asyncio.Lock] = {}
+
+
+async def _assistant_is_live(assistant_id: str) -> bool:
+    try:
+        await client.beta.assistants.retrieve(assistant_id)
+        return True
+    except NotFoundError:
+        return False
+
+
+async def create_assistant_for_file(file: BinaryIO, content_hash: str,
+                                    instructions: str = INSTRUCTIONS) -> Tuple[str, str]:
     """
     This function creates a file object and uses it to generate an assistant
     with access to the Code Interpreter tool. It also creates a new thread.
+    If the same bytes were uploaded before and their assistant still exists, the
+    upload and assistant creation are skipped and that assistant is reused.
 
     Args:
-    file (str): The file path or file content to be uploaded.
+    file (BinaryIO): The file content to be uploaded, or a (file name, open file) tuple to stream it.
+    content_hash (str): SHA-256 hex digest of the file content.
+    instructions (str): The assistant's instructions, INSTRUCTIONS plus any note on what the file holds.
 
     Returns:
     Tuple[str, str]: A tuple containing the thread ID and assistant ID.
     """
 
-
-    # Upload the file
-    uploaded_file = client.files.create(
-        file=file,
-        purpose='assistants'
-    )
-
-    # Create the assistant with the uploaded file and Code Interpreter tool
-    assistant = client.beta.assistants.create(
-        instructions=INSTRUCTIONS,
-        model="gpt-4o",
-        tools=[{"type": "code_interpreter"}],
-        tool_resources={
-            "code_interpreter": {
-                "file_ids": [uploaded_file.id]
-            }
-        }
-    )
+    async with _dataset_locks.setdefault(content_hash, asyncio.Lock()):
+        known_assistant = await run_db(_dataset_assistant, content_hash)
+        if known_assistant and await _assistant_is_live(known_assistant):
+            file_id, assistant_id = None, known_assistant
+        else:
+            # Upload the file
+            with tracing.span("openai.upload"):
+                uploaded_file = await client.files.create(
+                    file=file,
+                    purpose='assistants'
+                )
+
+            # Create the assistant with the uploaded file and Code Interpreter tool
+            with tracing.span("openai.assistant"):
+                assistant = await client.beta.assistants.create(
+                    instructions=instructions,
+                    model=MODEL,
+                    tools=[{"type": "code_interpreter"}],
+                    tool_resources={
+                        "code_interpreter": {
+                            "file_ids": [uploaded_file.id]
+                        }
+                    },
+                    metadata={**ASSISTANT_METADATA, "content_hash": content_hash},
+                )
+            file_id, assistant_id = uploaded_file.id, assistant.id
+
+            # Replies from this assistant are cached against the dataset it was built on
+            await asyncio.to_thread(llm_cache.register_assistant, assistant.id, content_hash)
+
+        # The new hub holds a reference until it is deleted
+        await run_db(_reference_dataset, content_hash, file_id, assistant_id)
 
     # Create a new thread
-    thread = client.beta.threads.create()
+    thread_id = await _create_thread()
 
     # Return thread ID and assistant ID
-    return assistant.id, thread.id
+    return assistant_id, thread_id
+
+
+def _dataset_assistant(content_hash: str) -> Optional[str]:
+    with session_scope() as db:
+        dataset = db.get(Dataset, content_hash)
+        return dataset.assistant_id if dataset else None
+
+
+def _reference_dataset(content_hash: str, file_id: Optional[str], assistant_id: str):
+    # Record a new upload (when file_id is given) and take one hub's reference on the dataset
+    with session_scope() as db:
+        dataset = db.get(Dataset, content_hash)
+        if not dataset:
+            dataset = Dataset(content_hash=content_hash, ref_count=0)
+            db.add(dataset)
+        if file_id:
+            dataset.file_id = file_id
+            dataset.assistant_id = assistant_id
+        dataset.ref_count += 1
+        dataset.last_used_at = datetime.utcnow()
 
 
-def _message_and_wait_for_reply(assistant_id: str, thread_id: str, message: str) -> Response:
+def release_dataset(db: Session, content_hash: Optional[str]):
+    """Drop one hub's reference to a dataset; the remote objects are removed later by collect_datasets."""
+    dataset = db.get(Dataset, content_hash) if content_hash else None
+    if dataset:
+        dataset.ref_count = max(dataset.ref_count - 1, 0)
+        dataset.last_used_at = datetime.utcnow()
+
+
+async def _delete_remote(assistant_id: Optional[str], file_id: Optional[str]):
+    # Either object may already be gone, which is the state we want anyway
+    for delete, object_id in ((client.beta.assistants.delete, assistant_id), (client.files.delete, file_id)):
+        if object_id:
+            try:
+                await delete(object_id)
+            except NotFoundError:
+                pass
+
+
+async def collect_datasets(grace: float = DATASET_GC_GRACE) -> int:
+    """
+    Delete the remote assistant and file of every dataset no hub has used for `grace`
+    seconds, plus any tagged assistant with no dataset record (e.g. left behind by a crash).
+
+    Returns:
+    int: The number of assistants removed.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    removed = 0
+
+    stale = await run_db(_stale_datasets, cutoff)
+    for content_hash, assistant_id, file_id in stale:
+        async with _dataset_locks.setdefault(content_hash, asyncio.Lock()):
+            await _delete_remote(assistant_id, file_id)
+            await run_db(_delete_dataset, content_hash)
+        _dataset_locks.pop(content_hash, None)
+        removed += 1
+
+    known = await run_db(_known_assistants)
+    async for assistant in client.beta.assistants.list(limit=100):
+        metadata = assistant.metadata or {}
+        if (metadata.get("app") != ASSISTANT_METADATA["app"] or assistant.id in known
+                or datetime.utcfromtimestamp(assistant.created_at) > cutoff):
+            continue
+        file_ids = assistant.tool_resources.code_interpreter.file_ids if assistant.tool_resources \
+            and assistant.tool_resources.code_interpreter else []
+        await _delete_remote(assistant.id, None)
+        for file_id in file_ids:
+            await _delete_remote(None, file_id)
+        removed += 1
+    return removed
+
+
+def _stale_datasets(cutoff: datetime) -> List[Tuple[str, str, str]]:
+    with session_scope() as db:
+        return [tuple(row) for row in db.query(Dataset.content_hash, Dataset.assistant_id, Dataset.file_id)
+                .filter(Dataset.ref_count <= 0, Dataset.last_used_at < cutoff)]
+
+
+def _delete_dataset(content_hash: str):
+    # Only if no hub took a new reference while the remote objects were being deleted
+    with session_scope() as db:
+        db.query(Dataset).filter(Dataset.content_hash == content_hash, Dataset.ref_count <= 0) \
+            .delete(synchronize_session=False)
+
+
+def _known_assistants() -> set:
+    with session_scope() as db:
+        return {assistant_id for assistant_id, in db.query(Dataset.assistant_id)}
+
+
+async def collect_datasets_forever(interval: float = DATASET_GC_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await collect_datasets()
+            if removed:
+                print(f"Removed {removed} unused assistants")
+        except Exception as e:
+            print(f"Dataset collection failed: {e}")
+
+
+async def _new_thread() -> str:
+    # Threads created here start with an empty, known history, so their replies can be cached
+    thread = await client.beta.threads.create()
+    await asyncio.to_thread(llm_cache.register_thread, thread.id)
+    return thread.id
+
+
+# Threads are created ahead of time, so builds, expansions and answers skip that round trip
+thread_pool = ThreadPool(_new_thread)
+
+
+async def _create_thread() -> str:
+    return await thread_pool.take()
+
+
+async def _send_message(thread_id: str, message: str):
+    with tracing.span("openai.send") as attrs:
+        # Write any cache hits the remote thread has not seen yet, so the model has the full conversation
+        pending = await asyncio.to_thread(llm_cache.take_pending, thread_id)
+        attrs["replayed"] = len(pending)
+        for exchange in pending:
+            await client.beta.threads.messages.create(thread_id=thread_id, role="user", content=exchange["prompt"])
+            await client.beta.threads.messages.create(thread_id=thread_id, role="assistant",
+                                                      content="\n".join(exchange["texts"]) or "(chart)")
+
+        # Send a message to the thread
+        await client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=message
+        )
+
+
+async def _read_message_content(contents) -> Response:
+    # Split an assistant message into its texts and image files, downloading the images concurrently
+    texts = []
+    downloads = []
+    for content in contents:
+        if hasattr(content, "image_file"):
+            downloads.append(client.files.with_raw_response.retrieve_content(content.image_file.file_id))
+        else:
+            text = content.text.value
+            texts.append(text)
+    if not downloads:
+        return Response(text_list=texts, image_list=[])
+    with tracing.span("openai.images", count=len(downloads)) as attrs:
+        images = [resp.content for resp in await asyncio.gather(*downloads) if resp.status_code == 200]
+        attrs["bytes"] = sum(len(image) for image in images)
+    return Response(text_list=texts, image_list=images)
+
+
+def _record_usage(run, attrs: dict):
+    # Token usage of a run, on its span (summed over retries) and in the token counters
+    usage = getattr(run, "usage", None)
+    if usage is None:
+        return
+    attrs["prompt_tokens"] = attrs.get("prompt_tokens", 0) + usage.prompt_tokens
+    attrs["completion_tokens"] = attrs.get("completion_tokens", 0) + usage.completion_tokens
+    metrics.incr("openai_tokens_total", usage.prompt_tokens, kind="prompt", model=MODEL)
+    metrics.incr("openai_tokens_total", usage.completion_tokens, kind="completion", model=MODEL)
+
+
+def _failure_kind(run=None, error: Optional[Exception] = None) -> Optional[str]:
+    """
+    Classify a failed run or API error as "rate_limit" or "transient" (worth retrying),
+    or None when retrying cannot help (bad request, auth, invalid prompt, ...).
+    """
+    if error is not None:
+        if isinstance(error, openai.RateLimitError):
+            return "rate_limit"
+        if isinstance(error, (openai.APIConnectionError, openai.InternalServerError, openai.ConflictError)):
+            return "transient"
+        return None
+    if run.status == "failed":
+        code = run.last_error.code if run.last_error else None
+        return {"rate_limit_exceeded": "rate_limit", "server_error": "transient"}.get(code)
+    if run.status in ("expired", "cancelled", "incomplete"):
+        return "transient"
+    return None
+
+
+async def _backoff(attempt: int, kind: Optional[str], message: str, error: Optional[Exception] = None):
+    """
+    Wait before retry `attempt + 1` (full jitter, capped at RETRY_MAX_DELAY; rate limits
+    start RATE_LIMIT_BACKOFF times higher and honour Retry-After), or raise when `kind`
+    is not retryable or the retries are used up.
+    """
+    if kind is None or attempt >= RETRIES:
+        if error is not None:
+            raise error
+        raise Exception(f"Failed to receive response for message: {message}")
+    metrics.incr("run_retries_total", reason=kind)
+    base = RETRY_BASE_DELAY * (RATE_LIMIT_BACKOFF if kind == "rate_limit" else 1)
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, base * 2 ** (attempt - 1)))
+    retry_after = getattr(getattr(error, "response", None), "headers", {}).get("retry-after")
+    if retry_after:
+        try:
+            delay = max(delay, min(RETRY_MAX_DELAY, float(retry_after)))
+        except ValueError:
+            pass
+    print(f"Retrying run after {kind} failure in {delay:.1f}s (attempt {attempt + 1} of {RETRIES})")
+    await asyncio.sleep(delay)
+
+
+async def _message_and_wait_for_reply(assistant_id: str, thread_id: str, message: str,
+                                      use_cache: bool = True, response_format: Optional[dict] = None) -> Response:
     """
     Sends a message to the assistant in a specified thread, waits for the assistant's response,
     and returns the assistant's reply.
@@ -85,56 +344,168 @@ def _message_and_wait_for_reply(assistant_id: str, thread_id: str, message: str)
     assistant_id (str): The ID of the assistant.
     thread_id (str): The ID of the thread to send the message in.
     message (str): The content of the message to send.
+    use_cache (bool): Whether the reply may be served from and stored in the LLM cache.
+    response_format (dict): Optional structured-output format for the run.
 
     Returns:
     str, bool: The response from the assistant, if it is a file
     """
 
-    # Send a message to the thread
-    client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=message
-    )
-    tries = 0
-    while tries < RETRIES:
-        tries += 1
+    model = f"{MODEL}:{json.dumps(response_format, sort_keys=True)}" if response_format else MODEL
+    # The cache's SQLite calls and image file reads and writes all block, so they run off the event loop
+    key = await asyncio.to_thread(llm_cache.key_for, assistant_id, thread_id, message, model) if use_cache else None
+    # JSON-schema formats are only accepted on runs whose tools are all functions, and the structured
+    # stages need no code, so those runs drop the assistant's code_interpreter
+    run_options = {"response_format": response_format, "tools": []} if response_format else {}
+    # The reply's span holds its slot wait ("openai.queue"), send, runs, message fetch and image downloads
+    with tracing.span("openai.reply") as reply_attrs:
+        if key:
+            cached = await asyncio.to_thread(llm_cache.get, key)
+            reply_attrs["cached"] = bool(cached)
+            if cached:
+                texts, images = cached
+                await asyncio.to_thread(llm_cache.advance, thread_id, key, message, texts)
+                return Response(text_list=texts, image_list=images)
 
-        # Run the assistant and wait for the response
-        run = client.beta.threads.runs.create_and_poll(
-            thread_id=thread_id,
-            assistant_id=assistant_id,
-        )
-        # Check if the run is completed and fetch the messages
-        if run.status == 'completed':
-            # Retrieve the list of messages from the thread
-            messages_page = client.beta.threads.messages.list(
-                thread_id=thread_id,
-                order="asc"
-            )
+        # Runs wait for a scheduler slot at the caller's priority (see scheduler.priority_context)
+        async with scheduler.slot(OPENAI, tokens=len(message) // 4 + RUN_TOKEN_ESTIMATE) as budget:
+            await _send_message(thread_id, message)
+            tries = 0
+            while tries < RETRIES:
+                tries += 1
+                reply_attrs["tries"] = tries
+
+                # Run the assistant and wait for the response
+                try:
+                    with tracing.span("openai.run", attempt=tries) as run_attrs:
+                        run = await client.beta.threads.runs.create_and_poll(
+                            thread_id=thread_id,
+                            assistant_id=assistant_id,
+                            **run_options,
+                        )
+                        run_attrs["status"] = run.status
+                        _record_usage(run, run_attrs)
+                except openai.APIError as e:
+                    await _backoff(tries, _failure_kind(error=e), message, error=e)
+                    continue
+                budget.settle(run.usage.total_tokens if getattr(run, "usage", None) else None)
+                # Check if the run is completed and fetch the messages
+                if run.status == 'completed':
+                    # Only the reply is needed: newest message of this run, one page of one item,
+                    # so the cost does not grow with the thread
+                    with tracing.span("openai.fetch"):
+                        messages = (await client.beta.threads.messages.list(
+                            thread_id=thread_id,
+                            run_id=run.id,
+                            order="desc",
+                            limit=1,
+                        )).data
+
+                    if messages:
+                        response = await _read_message_content(messages[0].content)
+                        if key:
+                            await asyncio.to_thread(llm_cache.put, key, response.text_list, response.image_list)
+                        await asyncio.to_thread(llm_cache.advance, thread_id, key)
+                        return response
+                    await _backoff(tries, "transient", message)
+                else:
+                    await _backoff(tries, _failure_kind(run=run), message)
+
+        raise Exception(f"Failed to receive response for message: {message}")
+
+
+async def _stream_message_reply(assistant_id: str, thread_id: str, message: str,
+                                use_cache: bool = True) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Streaming variant of _message_and_wait_for_reply: runs the assistant on the Assistants
+    streaming events and yields progress as it arrives instead of polling for the result.
 
-            # Convert the SyncCursorPage object to a list
-            messages = list(messages_page)
-
-            # Return the last message content (assuming the assistant's reply is the last one)
-            if messages:
-                contents = messages[-1].content
-                images = []
-                texts = []
-
-                for content in contents:
-                    if hasattr(content, "image_file"):
-                        file_id = content.image_file.file_id
-                        resp = client.files.with_raw_response.retrieve_content(file_id)
-                        if resp.status_code == 200:
-                            images.append(resp.content)
-                    else:
-                        text = content.text.value
-                        texts.append(text)
+    Args:
+    assistant_id (str): The ID of the assistant.
+    thread_id (str): The ID of the thread to send the message in.
+    message (str): The content of the message to send.
+    use_cache (bool): Whether the reply may be served from and stored in the LLM cache.
 
-                return Response(text_list=texts, image_list=images)
+    Yields:
+    (str, Any): ("text", {"delta"}) for answer text, ("code", {"delta"}) for code-interpreter input,
+    ("code_output", {"logs"}) for its output, ("image", {"index"}) when a chart is attached,
+    ("retry", {"attempt"}) when a failed run is restarted (discard the partial answer), and
+    finally ("reply", Response) with the complete reply.
+    """
 
-    raise Exception(f"Failed to receive response for message: {message}")
+    key = await asyncio.to_thread(llm_cache.key_for, assistant_id, thread_id, message, MODEL) if use_cache else None
+    with tracing.span("openai.reply", streaming=True) as reply_attrs:
+        if key:
+            cached = await asyncio.to_thread(llm_cache.get, key)
+            reply_attrs["cached"] = bool(cached)
+            if cached:
+                texts, images = cached
+                await asyncio.to_thread(llm_cache.advance, thread_id, key, message, texts)
+                for text in texts:
+                    yield "text", {"delta": text}
+                for index in range(len(images)):
+                    yield "image", {"index": index}
+                yield "reply", Response(text_list=texts, image_list=images)
+                return
+
+        async with scheduler.slot(OPENAI, tokens=len(message) // 4 + RUN_TOKEN_ESTIMATE) as budget:
+            await _send_message(thread_id, message)
+            tries = 0
+            while tries < RETRIES:
+                tries += 1
+                reply_attrs["tries"] = tries
+                if tries > 1:
+                    yield "retry", {"attempt": tries}
+
+                reply_message, final_run, status, images = None, None, None, 0
+                try:
+                    with tracing.span("openai.run", attempt=tries, streaming=True) as run_attrs:
+                        async with client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=assistant_id) as stream:
+                            async for event in stream:
+                                if event.event == "thread.message.delta":
+                                    for content in event.data.delta.content or []:
+                                        if content.type == "text" and content.text and content.text.value:
+                                            yield "text", {"delta": content.text.value}
+                                        elif content.type == "image_file":
+                                            yield "image", {"index": images}
+                                            images += 1
+                                elif event.event == "thread.run.step.delta":
+                                    details = event.data.delta.step_details
+                                    if details is None or details.type != "tool_calls":
+                                        continue
+                                    for call in details.tool_calls or []:
+                                        if call.type != "code_interpreter" or not call.code_interpreter:
+                                            continue
+                                        if call.code_interpreter.input:
+                                            yield "code", {"delta": call.code_interpreter.input}
+                                        for output in call.code_interpreter.outputs or []:
+                                            if output.type == "logs" and output.logs:
+                                                yield "code_output", {"logs": output.logs}
+                                elif event.event == "thread.message.completed":
+                                    # The completed message carries the full content, no messages.list round trip
+                                    reply_message = event.data
+                                elif event.event in ("thread.run.completed", "thread.run.failed",
+                                                     "thread.run.cancelled", "thread.run.expired"):
+                                    final_run = event.data
+                                    status = final_run.status
+                        run_attrs["status"] = status
+                        _record_usage(final_run, run_attrs)
+                except openai.APIError as e:
+                    await _backoff(tries, _failure_kind(error=e), message, error=e)
+                    continue
+
+                if final_run is not None and getattr(final_run, "usage", None):
+                    budget.settle(final_run.usage.total_tokens)
+                if status == 'completed' and reply_message is not None:
+                    response = await _read_message_content(reply_message.content)
+                    if key:
+                        await asyncio.to_thread(llm_cache.put, key, response.text_list, response.image_list)
+                    await asyncio.to_thread(llm_cache.advance, thread_id, key)
+                    yield "reply", response
+                    return
+                await _backoff(tries, _failure_kind(run=final_run) if final_run else "transient", message)
+
+        raise Exception(f"Failed to receive response for message: {message}")
 
 
 def _parse_one_liner(one_liner, node):
@@ -152,134 +523,381 @@ def _parse_one_liner(one_liner, node):
             return None
 
 
+async def _gather_or_raise(coroutines) -> list:
+    # Let every sibling finish before surfacing the first failure, like Pool.starmap did;
+    # the other failures are logged and counted rather than dropped
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    failures = [result for result in results if isinstance(result, BaseException)]
+    for failure in failures:
+        metrics.incr("task_failures_total", error=type(failure).__name__)
+        print(f"Task failed ({len(failures)} of {len(results)}): {type(failure).__name__}: {failure}")
+    if failures:
+        raise failures[0]
+    return results
+
+
+async def _ask_structured(stage: str, assistant_id: str, thread_id: str, prompt: str, schema,
+                          counts: Optional[Dict[str, int]] = None) -> dict:
+    """
+    Ask for a reply matching `schema`, validate it locally and, instead of re-running the
+    whole prompt, follow up asking only for the fields that are missing or short.
+    List fields that stay short after REPAIR_ATTEMPTS are returned as they are.
+
+    Args:
+    stage (str): Name of the node stage, used to label the metrics.
+    counts (Dict[str, int]): Required number of items for list fields.
+
+    Returns:
+    dict: The validated fields of `schema`.
+    """
+    with tracing.span(f"ask.{stage}") as attrs:
+        response_format = structured.response_format(schema) if STRUCTURED_OUTPUTS else None
+        response = await _message_and_wait_for_reply(assistant_id, thread_id, prompt, response_format=response_format)
+        data, problems = structured.parse(schema, "\n".join(response.text_list), counts)
+        metrics.incr("structured_replies_total", stage=stage)
+        if problems:
+            metrics.incr("structured_parse_failures_total", stage=stage)
+
+        attempts = 0
+        while problems and attempts < REPAIR_ATTEMPTS:
+            attempts += 1
+            metrics.incr("structured_repairs_total", stage=stage)
+            fields = list(problems)
+            attrs["repairs"] = attempts
+            response = await _message_and_wait_for_reply(
+                assistant_id, thread_id, structured.repair_prompt(schema, problems, data),
+                response_format=structured.response_format(schema, fields) if STRUCTURED_OUTPUTS else None,
+            )
+            data, problems = structured.parse(schema, "\n".join(response.text_list), counts, partial=data)
+
+        if problems:
+            metrics.incr("structured_repair_failures_total", stage=stage)
+            if "missing" in problems.values():
+                raise Exception(f"Failed to receive a valid {schema.__name__} for message: {prompt}")
+        elif attempts:
+            metrics.incr("structured_repair_successes_total", stage=stage)
+        return data
+
+
  # Get interesting questions for a given Node (if any)
-def _generate_questions(node: Node, assistant_id: str, thread_id: str):
-    response = _message_and_wait_for_reply(assistant_id, thread_id, SUGGESTED_QUESTION_PROMPT)
-    suggested_questions = re.findall(rf'{DELIMITER}(.*?){DELIMITER}', response.text_list[0])
-    for question_text in suggested_questions:
+async def _generate_questions(node: Node, assistant_id: str, thread_id: str):
+    reply = await _ask_structured("questions", assistant_id, thread_id, SUGGESTED_QUESTION_PROMPT,
+                                  structured.Questions, {"questions": NUM_QUESTIONS})
+    for question_text in reply["questions"]:
         question = Question(content=question_text)  # Create a Question object
         node.questions.append(question)  # Associate the question with the node
 
-def _generate_title(assistant_id: str, thread_id: str):
+async def _generate_title(assistant_id: str, thread_id: str):
     # Determine the concise title of the node
     one_liner_prompt = ONE_LINER
     if SURPRISING.get("enabled"):
         one_liner_prompt += SURPRISING.get("prompt")
-    title = _message_and_wait_for_reply(assistant_id, thread_id, one_liner_prompt).text_list[0]
+    title = (await _ask_structured("title", assistant_id, thread_id, one_liner_prompt, structured.Title))["title"]
     return title
 
-def _l1_create_node(hub: Hub, thread_id: str, prompt: str, db: Session = next(get_db())):
-    # Process the prompt for the new node
-    response = _message_and_wait_for_reply(hub.assistant_id, thread_id, prompt)
-    text = "\n".join(response.text_list)
-
-    # Determine the concise title of the node
-    one_liner_prompt = ONE_LINER
-    if SURPRISING.get("enabled"):
-        one_liner_prompt += SURPRISING.get("prompt")
-
-    title = _message_and_wait_for_reply(hub.assistant_id, thread_id, one_liner_prompt).text_list[0]
-
-    # Create the base of the Node in DB
-    new_node = Node(
-        prompt=prompt,
-        text=text,
-        title=title,
-        thread_id=thread_id,
-        hub_id=hub.id
-    )
-
-    # Process the images (if any) for the Node
-    images = []
-    for image_data in response.image_list:
-        # Create the image object
-        image = Image(data=image_data)
+async def _l1_create_node(hub_id: str, assistant_id: str, thread_id: str, prompt: str, node_id: str):
+    with tracing.span("l1.node"):
+        # Process the prompt for the new node
+        response = await _message_and_wait_for_reply(assistant_id, thread_id, prompt)
+        text = "\n".join(response.text_list)
+
+        # Determine the concise title of the node
+        title = await _generate_title(assistant_id, thread_id)
+
+        # Create the base of the Node in DB
+        new_node = Node(
+            id=node_id,
+            prompt=prompt,
+            text=text,
+            title=title,
+            thread_id=thread_id,
+            hub_id=hub_id
+        )
 
-        # Add the image to the session so it gets an id upon commit
-        db.add(image)
+        await _generate_questions(new_node, assistant_id, thread_id)
 
-        # Commit to generate the ID and get the URL
-        db.commit()
-        db.refresh(image)  # Ensure the ID is generated
+        node = await _save_node_with_images(new_node, response.image_list)
+    await prefetcher.schedule(hub_id, node)
 
-        # Generate the URL based on the image ID
-        image.generate_url()
 
-        # Commit again to save the URL
-        db.commit()
+async def _save_node_with_images(new_node: Node, image_list: List[bytes]):
+    with tracing.span("node.save", images=len(image_list)):
+        # Write the chart bytes and their thumbnails and variants to the content-addressed
+        # image store on the encoder threads, all charts queued at once
+        stored = await asyncio.gather(*(run_encode(_store_image, image_data) for image_data in image_list))
+        hub_id = new_node.hub_id
+        data = await run_db(_store_node, new_node, stored)
+    hub_events.publish(hub_id, "node", data)
+    return data
 
-        # Append the image to the new_node's images relationship
-        new_node.images.append(image)
-        images.append(image)  # Optionally collect them for further processing
 
-    _generate_questions(new_node, hub.assistant_id, thread_id)
+def _store_image(image_data: bytes) -> dict:
+    # The Image columns of one chart: its digest and size, and its dimensions and variants
+    digest = store_image(image_data)
+    variants = store_variants(digest, image_data)
+    return {"sha256": digest, "size": len(image_data), "width": variants["width"], "height": variants["height"],
+            "derivatives": json.dumps(variants["variants"])}
 
-    # Save Node to DB
-    db.add(new_node)
-    db.commit()
 
+def _store_node(new_node: Node, stored: List[dict]) -> dict:
+    # Blocking part of saving a node, run on the DB executor; returns the node's event payload
+    # Each node task gets its own session rather than sharing one across tasks
+    with session_scope() as db:
+        # The node and all of its images go in as one transaction
+        for columns in stored:
+            new_node.images.append(Image(**columns))
+        db.add(new_node)
 
-def l1_init(hub: Hub, initial_thread: str):
-    # Determine the five initial prompts per node
-    response = _message_and_wait_for_reply(hub.assistant_id, initial_thread, INITIAL_PROMPT)
-    next_prompts = re.findall(rf'{DELIMITER}(.*?){DELIMITER}', response.text_list[0])
+        # Flush to assign the image ids their URLs are built from
+        db.flush()
+        for image in new_node.images:
+            image.generate_url()
+        bump_version(db, hub_id=new_node.hub_id)
+        return node_event(new_node)
 
-    # Extract and create threads per node
-    prompts_with_threads = [(prompt + LEVEL_ONE_PROMPT_SUFFIX + prompt, client.beta.threads.create().id) for prompt in
-                            next_prompts]
 
-    # Run each l1 node creation in parallel
-    with multiprocessing.Pool() as pool:
-        pool.starmap(_l1_create_node, [
-            (hub, thread_id, prompt) for prompt, thread_id in prompts_with_threads
-        ])
+async def _prepare_dataset(hub: Hub, job: Optional[JobRun]) -> Tuple[Optional[dict], Optional[dict]]:
+    """
+    Profile the hub's saved upload, in chunks and off the event loop, and plan its reduction
+    if the build asks for one, as the first step of the build rather than on the session/start
+    request. Both are kept on the hub, so a retried build does not redo them.
 
-def create_level_one_half_node(question: Question, node: Node, db: Session = next(get_db())):
-    prompt = question.content + LEVEL_ONE_HALF_PROMPT
-    response = _message_and_wait_for_reply(node.hub.assistant_id, node.thread_id, prompt)
-    title = _generate_title(node.hub.assistant_id, node.thread_id)
+    Returns:
+    Tuple[Optional[dict], Optional[dict]]: The profile (None if the file is not a readable CSV)
+    and the reduction plan (None without one).
+    """
+    profile = json.loads(hub.profile) if hub.profile else None
+    params = json.loads(hub.reduction) if hub.reduction else None
+    path = upload_path(hub.id)
+    changed = False
+    if profile is None and os.path.exists(path):
+        with tracing.span("profile"):
+            with open(path, "rb") as file:
+                profile = await asyncio.to_thread(profile_csv, file)
+        changed = profile is not None
+    options = job.payload.get("reduce") if job else None
+    if params is None and options is not None:
+        if not profile:
+            raise Exception("Reduction needs a CSV file that can be profiled")
+        params = plan_reduction(profile, **options)
+        changed = True
+    if changed:
+        await run_db(_set_hub_dataset, hub.id, profile, params)
+    return profile, params
+
+def _set_hub_dataset(hub_id: str, profile: Optional[dict], params: Optional[dict]):
+    with session_scope() as db:
+        db.query(Hub).filter(Hub.id == hub_id).update({
+            Hub.profile: json.dumps(profile) if profile else None,
+            Hub.reduction: json.dumps(params) if params else None})
+        # The hub shows how its upload is reduced before the build makes the file
+        bump_version(db, hub_id=hub_id)
+
+async def l1_init(hub: Hub, initial_thread: Optional[str], job: Optional[JobRun] = None):
+    # Only plain ids are handed to the node tasks, never the ORM object itself
+    hub_id, assistant_id = hub.id, hub.assistant_id
+    hub_events.publish_status(hub_id, BUILDING)
+    try:
+        profile, params = await _prepare_dataset(hub, job)
+        # Hub builds run in the background, behind interactive questions and L2 expansions
+        with priority_context(BACKGROUND, hub.session_id):
+            if assistant_id is None or initial_thread is None:
+                assistant_id, initial_thread = await _provision_assistant(hub_id, job, params)
+            await _l1_build(hub_id, assistant_id, initial_thread, profile, job)
+    except Exception as e:
+        hub_events.publish_status(hub_id, FAILED, str(e))
+        raise
+    hub_events.publish_status(hub_id, COMPLETE)
+
+async def _l1_build(hub_id: str, assistant_id: str, initial_thread: str, profile: Optional[dict],
+                    job: Optional[JobRun] = None):
+    # A job retried after a crash keeps its plan: the same prompts, threads and node ids
+    plan = job.checkpoint if job else {}
+    if "node_ids" not in plan:
+        # Give the model the locally computed profile so it picks prompts without re-deriving the basics
+        initial_prompt = INITIAL_PROMPT
+        if profile:
+            initial_prompt += PROFILE_PROMPT + profile_summary(profile)
+
+        # Determine the five initial prompts per node
+        next_prompts = (await _ask_structured("instructions", assistant_id, initial_thread, initial_prompt,
+                                              structured.Instructions, {"instructions": NUM_PROMPTS}))["instructions"]
+
+        # Extract and create threads per node
+        threads = await asyncio.gather(*(_create_thread() for _ in next_prompts))
+        plan = {
+            "prompts": [prompt + LEVEL_ONE_PROMPT_SUFFIX + prompt for prompt in next_prompts],
+            "threads": threads,
+            "node_ids": [new_job_id() for _ in next_prompts],
+        }
+        if job:
+            await run_db(job.save, **plan)
 
-    new_thread = client.beta.threads.create()
+    # Nodes saved before a crash are the checkpoint: only the missing ones are built
+    done = await run_db(_existing_node_ids, plan["node_ids"])
 
-    new_node = Node(
-        prompt=prompt,
-        text=response.text_list[0],
-        title=title,
-        thread_id=new_thread.id,
-        hub_id=node.hub.id,
+    # Run each l1 node creation concurrently on the event loop
+    await _gather_or_raise(
+        _l1_create_node(hub_id, assistant_id, thread_id, prompt, node_id)
+        for prompt, thread_id, node_id in zip(plan["prompts"], plan["threads"], plan["node_ids"])
+        if node_id not in done
     )
-    _generate_questions(new_node, node.hub.assistant_id, node.thread_id)
 
-    # Save Node to DB
-    db.add(new_node)
-    db.commit()
-    return new_node
+async def _provision_assistant(hub_id: str, job: JobRun, params: Optional[dict]) -> Tuple[str, str]:
+    """
+    Upload the hub's saved dataset and create (or reuse) its assistant and first thread,
+    as the first step of the build rather than on the session/start request.
 
-def create_level_one_half_node_prompted(prompt: str, node: Node, db: Session = next(get_db())):
-    response = _message_and_wait_for_reply(node.hub.assistant_id, node.thread_id, prompt + LEVEL_ONE_HALF_PROMPT)
-    title = _generate_title(node.hub.assistant_id, node.thread_id)
+    Returns:
+    Tuple[str, str]: The assistant ID and the initial thread ID.
+    """
+    if "initial_thread" in job.checkpoint:
+        return job.checkpoint["assistant_id"], job.checkpoint["initial_thread"]
+    with tracing.span("provision"):
+        content_hash, file_name = job.payload["content_hash"], job.payload["file_name"]
+        path, instructions = upload_path(hub_id), INSTRUCTIONS
+        if params:
+            # Upload the reduced copy; its own dataset key keeps it apart from the full file's assistant
+            params = await _reduce_upload(hub_id, path, params)
+            content_hash, file_name = reduced_hash(content_hash, params), reduced_name(file_name, params)
+            path, instructions = reduced_path(hub_id), instructions + describe(params)
+        with open(path, "rb") as file:
+            assistant_id, initial_thread = await create_assistant_for_file((file_name, file), content_hash,
+                                                                           instructions)
+        await run_db(_set_hub_assistant, hub_id, assistant_id, content_hash)
+        await run_db(job.save, assistant_id=assistant_id, initial_thread=initial_thread)
+    # OpenAI holds the file now
+    remove_upload(hub_id)
+    return assistant_id, initial_thread
+
+async def _reduce_upload(hub_id: str, path: str, params: dict) -> dict:
+    # Deterministic, so a retried build writes the same file again
+    with tracing.span("reduce", sampling=params["sampling"]):
+        with open(path, "rb") as source:
+            result = await asyncio.to_thread(reduce_file, source, reduced_path(hub_id), params)
+    print(f"Reduced the dataset of hub {hub_id} from {result['rows_in']} rows, {result['bytes_in']} bytes "
+          f"to {result['rows_out']} rows, {result['bytes_out']} bytes in {result['seconds']}s")
+    metrics.incr("dataset_reduced_bytes_total", result["bytes_in"] - result["bytes_out"])
+    params = {**params, "result": result}
+    await run_db(_set_hub_reduction, hub_id, params)
+    return params
+
+def _set_hub_reduction(hub_id: str, params: dict):
+    with session_scope() as db:
+        db.query(Hub).filter(Hub.id == hub_id).update({Hub.reduction: json.dumps(params)})
+        bump_version(db, hub_id=hub_id)
+
+def _set_hub_assistant(hub_id: str, assistant_id: str, content_hash: str):
+    # The dataset reference is only recorded on the hub once it was taken, so deleting the hub releases it
+    with session_scope() as db:
+        db.query(Hub).filter(Hub.id == hub_id).update({Hub.assistant_id: assistant_id,
+                                                        Hub.dataset_hash: content_hash})
+        bump_version(db, hub_id=hub_id)
+
+def _existing_node_ids(node_ids: List[str]) -> set:
+    with session_scope() as db:
+        return {node_id for (node_id,) in db.query(Node.id).filter(Node.id.in_(node_ids))}
+
+async def l1_local_init(hub: Hub, job: Optional[JobRun] = None):
+    """
+    Build a hub's L1 nodes from its local profile alone, with charts rendered locally
+    and no assistant runs.
+    """
+    hub_id = hub.id
+    hub_events.publish_status(hub_id, BUILDING)
+    try:
+        profile, _ = await _prepare_dataset(hub, job)
+        # Only the profile is used
+        remove_upload(hub_id)
+        if not profile:
+            raise Exception("The dataset could not be profiled locally")
+        contents = await asyncio.to_thread(profile_nodes, profile)
+        # The profile gives the same nodes every time, so a retried job plans the same ids
+        # and only saves the ones missing
+        node_ids = job.checkpoint.get("node_ids") if job else None
+        if node_ids is None:
+            node_ids = [new_job_id() for _ in contents]
+            if job:
+                await run_db(job.save, node_ids=node_ids)
+        done = await run_db(_existing_node_ids, node_ids)
+        for content, node_id in zip(contents, node_ids):
+            if node_id in done:
+                continue
+            new_node = Node(id=node_id, prompt=content["prompt"], text=content["text"], title=content["title"],
+                            thread_id="", hub_id=hub_id)
+            await _save_node_with_images(new_node, content["images"])
+    except Exception as e:
+        hub_events.publish_status(hub_id, FAILED, str(e))
+        raise
+    hub_events.publish_status(hub_id, COMPLETE)
+
+def _node_target(node_id: str) -> dict:
+    # What answering on a node needs, loaded in one go on the DB executor
+    with session_scope() as db:
+        node = db.get(Node, node_id)
+        if node is None:
+            raise Exception(f"Node {node_id} no longer exists")
+        return {"node_id": node.id, "hub_id": node.hub_id, "thread_id": node.thread_id,
+                "assistant_id": node.hub.assistant_id, "session_id": node.hub.session_id}
+
+async def stream_level_one_half_node(node_id: str, prompt: str, message: str,
+                                     question_id: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Streaming variant of the question job: yields the events of _stream_message_reply
+    while the answer is generated, ("status", {"stage"}) while the title and questions
+    are made, and finally ("node", dict) with the saved node.
 
-    new_thread = client.beta.threads.create()
+    Args:
+    node_id (str): The ID of the node the question is asked on.
+    prompt (str): The prompt stored on the new node.
+    message (str): The message sent to the assistant.
+    question_id (str, optional): The stored question answered, which keeps the answer.
+    """
+    target = await run_db(_node_target, node_id)
+    # Answered on the request rather than by a job, so the spans are attributed to the hub here
+    with tracing.bind(hub_id=target["hub_id"]), tracing.span("answer"):
+        response = None
+        async for event, data in _stream_message_reply(target["assistant_id"], target["thread_id"], message):
+            if event == "reply":
+                response = data
+            else:
+                yield event, data
+        yield "status", {"stage": "title"}
+        node = await _save_level_one_half_node(prompt, response, target)
+        if question_id:
+            await run_db(_record_answer, question_id, node["id"])
+    yield "node", node
+    await prefetcher.schedule(target["hub_id"], node)
+
+async def _save_level_one_half_node(prompt: str, response: Response, target: dict,
+                                    node_id: Optional[str] = None) -> dict:
+    title = await _generate_title(target["assistant_id"], target["thread_id"])
+
+    new_thread_id = await _create_thread()
 
     new_node = Node(
+        id=node_id or new_job_id(),
         prompt=prompt,
         text=response.text_list[0],
         title=title,
-        thread_id=new_thread.id,
-        hub_id=node.hub.assistant_id,
-
+        thread_id=new_thread_id,
+        hub_id=target["hub_id"],
     )
-    _generate_questions(new_node, node.hub.assistant_id, node.thread_id)
+    await _generate_questions(new_node, target["assistant_id"], target["thread_id"])
 
     # Save Node to DB
-    db.add(new_node)
-    db.commit()
-    return new_node
+    return await _save_node_with_images(new_node, [])
+
+def _record_answer(question_id: str, node_id: str, prefetched: bool = False):
+    # Later requests for the question get this node back instead of a new answer
+    with session_scope() as db:
+        db.query(Question).filter(Question.id == question_id).update({Question.answer_node_id: node_id,
+                                                                      Question.prefetched: prefetched})
 
 # Define exa search function
-def exa_search(query: str) -> ExaSearchResponse:
+def exa_search(query: str, num_results: int = L2_OUTPUT) -> ExaSearchResponse:
     # Perform the Exa search (assumed to return a list of dicts or similar)
-    raw_results = exa.search_and_contents(query=query, type='auto', summary=True, num_results=L2_OUTPUT)
+    raw_results = exa.search_and_contents(query=query, type='auto', summary=True, num_results=num_results)
 
     # Example of how you would format the results into the Pydantic model
     formatted_results = [
@@ -293,82 +911,203 @@ def exa_search(query: str) -> ExaSearchResponse:
 
     return ExaSearchResponse(results=formatted_results, total_results=len(raw_results.results))
 
-# Create L2 node
-def _l2_create_node(hub: Hub, thread_id: str, prompt: str, parent_node: Node, url: str, article_title: str, db: Session = next(get_db())):
-    
-    # Create the unified contextual summary with title
-    response = _message_and_wait_for_reply(hub.assistant_id, thread_id, prompt)
-    summary, title = tuple(re.findall(rf'{DELIMITER}(.*?){DELIMITER}', response.text_list[0]))
-    # print(f"For the following prompt: {prompt}\nTitle: {title}\nSummary: {summary}\n\n\n")
-
-    final_summary = f"[{article_title}]({url})\n\n\n{summary}"
-    # Create the base of the Node in DB
-    new_node = Node(
-        prompt=prompt,
-        text=final_summary,
-        title=title,
-        thread_id=thread_id,
-        hub_id=hub.id,
-        parent_node_id=parent_node.id
-    )
-
-    # TODO: Stretch goal would be to add questions so someone could do more layers
 
-    # Save Node to DB
-    db.add(new_node)
-    db.commit()
-    db.refresh(new_node)
+async def _search(query: str, num_results: int) -> List[dict]:
+    # Results for the normalized query come from the search cache when another expansion
+    # (or a sibling with a near-identical query) already ran it
+    with tracing.span("exa.search", num_results=num_results) as attrs:
+        # The search cache's SQLite calls block, so they run off the event loop like llm_cache's
+        results = await asyncio.to_thread(search_cache.get, query, num_results)
+        attrs["cached"] = results is not None
+        if results is not None:
+            return results
+        # The Exa client is synchronous, so it runs on a worker thread to keep the event loop free
+        async with scheduler.slot(EXA, tokens=0):
+            response = await asyncio.to_thread(exa_search, query=query, num_results=num_results)
+        results = [result.model_dump() for result in response.results]
+        await asyncio.to_thread(search_cache.put, query, num_results, results)
+        return results
+
+
+async def _new_sources(hub_id: str, query: str) -> List[SearchResult]:
+    """
+    Up to L2_OUTPUT search results for `query` whose articles no node of the hub
+    summarizes yet, searching further down the ranking while the top ones are taken.
+    """
+    num_results = L2_SEARCH_RESULTS
+    while True:
+        results = await _search(query, num_results)
+        taken = await run_db(_hub_source_urls, hub_id, [result["url"] for result in results])
+        sources = []
+        for result in results:
+            if result["url"] in taken:
+                metrics.incr("l2_duplicate_sources_total")
+                continue
+            taken.add(result["url"])
+            sources.append(SearchResult(**result))
+        if len(sources) >= L2_OUTPUT or len(results) < num_results or num_results >= L2_MAX_SEARCH_RESULTS:
+            return sources[:L2_OUTPUT]
+        num_results = min(num_results * 2, L2_MAX_SEARCH_RESULTS)
+
+
+def _hub_source_urls(hub_id: str, urls: List[str]) -> set:
+    with session_scope() as db:
+        return {url for (url,) in db.query(Node.source_url).filter(Node.hub_id == hub_id, Node.source_url.in_(urls))}
 
-    # def to_dict(obj):
-    #     return {column.name: getattr(obj, column.name) for column in obj.__table__.columns}
+# Create L2 node
+async def _l2_create_node(hub_id: str, assistant_id: str, thread_id: str, prompt: str, parent_node_id: str, url: str, article_title: str, node_id: str) -> str:
+
+    with tracing.span("l2.node"):
+        # Create the unified contextual summary with title
+        reply = await _ask_structured("l2_summary", assistant_id, thread_id, prompt, structured.SourceSummary)
+        summary, title = reply["summary"], reply["title"]
+        # print(f"For the following prompt: {prompt}\nTitle: {title}\nSummary: {summary}\n\n\n")
+
+        final_summary = f"[{article_title}]({url})\n\n\n{summary}"
+        # Create the base of the Node in DB
+        new_node = Node(
+            id=node_id,
+            prompt=prompt,
+            text=final_summary,
+            title=title,
+            thread_id=thread_id,
+            hub_id=hub_id,
+            parent_node_id=parent_node_id,
+            source_url=url,
+        )
 
-    # print(to_dict(new_node))
+        # TODO: Stretch goal would be to add questions so someone could do more layers
 
-    return new_node
+        # Save Node to DB
+        return (await _save_node_with_images(new_node, []))["id"]
 
 # Create L2 node
-def l2_init(hub: Hub, prev_node: Node):
-    # Use the findings from level one to prompt OpenAI for a query that Exa can use, and incorporate Exa prompt guidelines for better query formulation
-    level_two_prompt = (
-        f"""Our findings about {prev_node.title} suggest the following trends: 
-        {prev_node.text}. Now, use create an exa query that used this information.
-
-        Include only relevant trusted sources. Focus on journals or articles that delve into statistical analyses or provide clear empirical evidence.
+async def l2_init(hub: Hub, prev_node: Node, job: Optional[JobRun] = None) -> List[str]:
+    # Only plain values are handed to the node tasks, never the ORM objects themselves
+    hub_id, assistant_id = hub.id, hub.assistant_id
+
+    # L2 expansions are asked for by a user, but rank behind their interactive questions
+    with priority_context(L2, hub.session_id):
+        # A job retried after a crash keeps its plan: the same sources, threads and node ids
+        plan = job.checkpoint if job else {}
+        if "node_ids" not in plan:
+            # Use the findings from level one to prompt OpenAI for a query that Exa can use, and incorporate Exa prompt guidelines for better query formulation
+            level_two_prompt = (
+                f"""Our findings about {prev_node.title} suggest the following trends: 
+                {prev_node.text}. Now, use create an exa query that used this information.
+
+                Include only relevant trusted sources. Focus on journals or articles that delve into statistical analyses or provide clear empirical evidence.
         
-        Example prompt: "Here's a great article on the relationship between {prev_node.title} and its long-term implications:".
-
-        Use the following guide to help craft a prompt as well:
-        1. Phrase as Statements: "Here's a great article about X:" works better than "What is X?"
-        2. Add Context: Include modifiers like "funny", "academic", or specific websites to narrow results.
-        3. End with a Colon: Many effective prompts end with ":", mimicking natural link sharing.
-        """
-    )
-
-    # Send this prompt to OpenAI to generate a search query for Exa
-    generated_query = _message_and_wait_for_reply(hub.assistant_id, prev_node.thread_id, level_two_prompt)
-
-    # Parse the generated search query
-    search_query = generated_query.text_list[0]  # (Assuming first response contains the search query)
+                Example prompt: "Here's a great article on the relationship between {prev_node.title} and its long-term implications:".
 
-    # Use the search query to call Exa's search function and fetch relevant papers and resources
-    search_results = exa_search(query=search_query)
-
-    # Extract and create threads per node
-    prompts_with_threads = []
-    for result in search_results.results:
-        prompt = f"You have a summary for a new source, {result.title} which has the summary {result.summary}. Explain how this relates to the previous information {prev_node.title} with text {prev_node.text}. Output a summary enclosed in ~ and then a title based on this summary that is one sentence <= 50 characters also surrounded by ~ (don't forget that both the summary and the title should be enclosed in ~). Heavily emphasize the connection to the previous information. Provide a little bit of the context for the new source summary as well."
-        prompts_with_threads.append((prompt, client.beta.threads.create().id, result.url, result.title))
-
-    # Run each l2 node creation in parallel
-    with multiprocessing.Pool() as pool:
-        results = pool.starmap(_l2_create_node, [
-            (hub, thread_id, prompt, prev_node, url, title) for prompt, thread_id, url, title in prompts_with_threads
-        ])
-
-    pool.close()
-    pool.join()
-
-    # print(results)
-    # print([result.id for result in results])
+                Use the following guide to help craft a prompt as well:
+                1. Phrase as Statements: "Here's a great article about X:" works better than "What is X?"
+                2. Add Context: Include modifiers like "funny", "academic", or specific websites to narrow results.
+                3. End with a Colon: Many effective prompts end with ":", mimicking natural link sharing.
+                """
+            )
 
-    return [result.id for result in results]
\ No newline at end of file
+            # A node expanded before reuses its query, and with it the cached search
+            search_query = await asyncio.to_thread(search_cache.query_for_node, prev_node.id)
+            if search_query is None:
+                # Send this prompt to OpenAI to generate a search query for Exa
+                generated_query = await _message_and_wait_for_reply(assistant_id, prev_node.thread_id, level_two_prompt)
+
+                # Parse the generated search query
+                search_query = generated_query.text_list[0]  # (Assuming first response contains the search query)
+                await asyncio.to_thread(search_cache.remember, prev_node.id, search_query)
+
+            # Use the search query to fetch relevant papers and resources, skipping articles
+            # already summarized into a node of this hub
+            sources = await _new_sources(hub_id, search_query)
+
+            # Extract and create threads per node
+            threads = await asyncio.gather(*(_create_thread() for _ in sources))
+            prompts_with_threads = []
+            for result, thread_id in zip(sources, threads):
+                prompt = f"You have a summary for a new source, {result.title} which has the summary {result.summary}. Explain how this relates to the previous information {prev_node.title} with text {prev_node.text}. Reply with a JSON object with a `summary` field and then a `title` field based on this summary that is one sentence <= 50 characters. Heavily emphasize the connection to the previous information. Provide a little bit of the context for the new source summary as well."
+                prompts_with_threads.append((prompt, thread_id, result.url, result.title))
+
+            plan = {
+                "prompts": [prompt for prompt, _, _, _ in prompts_with_threads],
+                "threads": threads,
+                "urls": [url for _, _, url, _ in prompts_with_threads],
+                "titles": [title for _, _, _, title in prompts_with_threads],
+                "node_ids": [new_job_id() for _ in prompts_with_threads],
+            }
+            if job:
+                await run_db(job.save, **plan)
+
+        # Nodes saved before a crash are the checkpoint: only the missing ones are built
+        done = await run_db(_existing_node_ids, plan["node_ids"])
+
+        # Run each l2 node creation concurrently on the event loop
+        await _gather_or_raise(
+            _l2_create_node(hub_id, assistant_id, thread_id, prompt, prev_node.id, url, title, node_id)
+            for prompt, thread_id, url, title, node_id in zip(plan["prompts"], plan["threads"], plan["urls"],
+                                                               plan["titles"], plan["node_ids"])
+            if node_id not in done
+        )
+        return plan["node_ids"]
+
+
+# Job handlers, run by worker.py for the jobs the API enqueues
+def _load(model, object_id: str, *relationships: str):
+    # Load a row (and the relationships named) on the DB executor, detached for use on the loop
+    with session_scope() as db:
+        row = db.get(model, object_id)
+        if row is None:
+            raise Exception(f"{model.__name__} {object_id} no longer exists")
+        for relationship in relationships:
+            getattr(row, relationship)
+        return row
+
+async def run_l1_job(job: JobRun):
+    hub = await run_db(_load, Hub, job.hub_id)
+    await l1_init(hub, job.payload.get("initial_thread"), job)
+    return {"node_ids": job.checkpoint["node_ids"]}
+
+async def run_l1_local_job(job: JobRun):
+    hub = await run_db(_load, Hub, job.hub_id)
+    await l1_local_init(hub, job)
+    return {"node_ids": job.checkpoint["node_ids"]}
+
+async def run_l2_job(job: JobRun):
+    prev_node = await run_db(_load, Node, job.payload["node_id"], "hub")
+    return {"node_ids": await l2_init(prev_node.hub, prev_node, job)}
+
+async def run_question_job(job: JobRun):
+    # The answer's node id is planned at enqueue time, so a retry never answers twice
+    answer_node_id = job.payload["answer_node_id"]
+    node = None
+    if not await run_db(_existing_node_ids, [answer_node_id]):
+        target = await run_db(_node_target, job.payload["node_id"])
+        with priority_context(INTERACTIVE, target["session_id"]):
+            response = await _message_and_wait_for_reply(target["assistant_id"], target["thread_id"], job.payload["message"])
+            node = await _save_level_one_half_node(job.payload["prompt"], response, target, answer_node_id)
+    if job.payload.get("question_id"):
+        await run_db(_record_answer, job.payload["question_id"], answer_node_id)
+    if node is not None:
+        # The user is reading this answer now, its own questions are the likely next clicks
+        await prefetcher.schedule(target["hub_id"], node)
+    return {"node_id": answer_node_id}
+
+async def run_prefetch_job(job: JobRun):
+    # A question job nobody asked for yet (see prefetch.py), answered from the scheduler's spare
+    # budget; a click on the question turns it into a question job while it is queued, and
+    # promotes its runs while it is running
+    question_id, answer_node_id = job.payload["question_id"], job.payload["answer_node_id"]
+    if not await run_db(_existing_node_ids, [answer_node_id]):
+        reason = await run_db(prefetch_skip_reason, question_id)
+        if reason:
+            return {"skipped": reason}
+        target = await run_db(_node_target, job.payload["node_id"])
+        with prefetcher.running(question_id):
+            response = await _message_and_wait_for_reply(target["assistant_id"], target["thread_id"], job.payload["message"])
+            # The title and questions cost two more runs, not worth it once the user has left
+            reason = await run_db(prefetch_skip_reason, question_id)
+            if reason:
+                return {"skipped": reason}
+            await _save_level_one_half_node(job.payload["prompt"], response, target, answer_node_id)
+    await run_db(_record_answer, question_id, answer_node_id, True)
+    return {"node_id": answer_node_id}
@@ -0,0 +1,129 @@
+"""
+Job worker: claims hub builds (with the assistant or local), L2 expansions, questions
+and prefetched answers from the job table and runs them, renewing each job's lease
+while it runs.
+
+The API process runs one embedded worker (set EMBEDDED_WORKER=0 to turn it off);
+more can run on their own, from the FastAPI directory:
+
+    python -m worker --concurrency l1=8
+"""
+import argparse
+import asyncio
+import os
+import socket
+import traceback
+import uuid
+from typing import Dict, Optional
+
+import jobs
+import metrics
+import tracing
+from consts import JOB_CONCURRENCY, JOB_LEASE_SECONDS, JOB_POLL_INTERVAL
+from database import create_db_and_tables, run_db
+from utils import run_l1_job, run_l1_local_job, run_l2_job, run_prefetch_job, run_question_job
+
+HANDLERS = {
+    "l1": run_l1_job,
+    "l1_local": run_l1_local_job,
+    "l2": run_l2_job,
+    "question": run_question_job,
+    "prefetch": run_prefetch_job,
+}
+
+
+async def _keep_lease(job: jobs.JobRun, task: asyncio.Task):
+    # Renew well before expiry; if the lease was lost another worker owns the job now
+    while not task.done():
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        if not await run_db(jobs.renew, job.id, job.worker_id):
+            print(f"Lost the lease on job {job.id}, stopping it")
+            task.cancel()
+            return
+
+
+async def _run_job(job: jobs.JobRun):
+    print(f"Worker {job.worker_id} running {job.kind} job {job.id} (attempt {job.attempts})")
+    task = asyncio.ensure_future(_handle(job))
+    lease = asyncio.create_task(_keep_lease(job, task))
+    try:
+        result = await task
+    except asyncio.CancelledError:
+        if lease.done():
+            return  # lease lost, the new owner carries on from the checkpoint
+        await run_db(jobs.release, job.id, job.worker_id)
+        raise
+    except jobs.LeaseLost:
+        return
+    except Exception as e:
+        traceback.print_exc()
+        metrics.incr("jobs_failed_total", kind=job.kind, error=type(e).__name__)
+        await run_db(jobs.fail, job.id, job.worker_id, str(e), job.attempts)
+        return
+    finally:
+        lease.cancel()
+    await run_db(jobs.finish, job.id, job.worker_id, result)
+
+
+async def _handle(job: jobs.JobRun):
+    with tracing.span(f"job.{job.kind}", attempt=job.attempts):
+        return await HANDLERS[job.kind](job)
+
+
+async def run_worker(stop: Optional[asyncio.Event] = None, concurrency: Optional[Dict[str, int]] = None,
+                     worker_id: Optional[str] = None):
+    """
+    Claim and run jobs until `stop` is set. Each kind has its own concurrency limit, so
+    long hub builds never hold the slots questions need.
+    """
+    stop = stop or asyncio.Event()
+    concurrency = concurrency or JOB_CONCURRENCY
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    running: Dict[str, set] = {kind: set() for kind in HANDLERS}
+    # Spans of the jobs run here go to the spans table in batches
+    flusher = asyncio.create_task(tracing.flush_forever())
+    try:
+        while not stop.is_set():
+            free = [kind for kind in HANDLERS if len(running[kind]) < concurrency.get(kind, 0)]
+            job = await run_db(jobs.claim, worker_id, free)
+            if job is None:
+                try:
+                    await asyncio.wait_for(stop.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # The job's task continues the trace of the request that queued it, attributed to its hub
+            with tracing.bind(**job.payload.get("trace", {}), hub_id=job.hub_id, job_id=job.id):
+                task = asyncio.create_task(_run_job(job))
+            running[job.kind].add(task)
+            task.add_done_callback(running[job.kind].discard)
+    finally:
+        # Jobs cut short here go back to the queue for the next worker; wait for them to release
+        # their leases, or the jobs sit unclaimed until the leases expire
+        tasks = [task for kind_tasks in running.values() for task in kind_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        flusher.cancel()
+        await tracing.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run pipeline jobs from the job table.")
+    parser.add_argument("--concurrency", nargs="*", default=[], metavar="KIND=N",
+                        help="jobs of a kind run at once, e.g. l1=8 question=32")
+    args = parser.parse_args()
+    concurrency = dict(JOB_CONCURRENCY)
+    for item in args.concurrency:
+        kind, _, count = item.partition("=")
+        concurrency[kind] = int(count)
+
+    create_db_and_tables()
+    try:
+        asyncio.run(run_worker(concurrency=concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -28,7 +28,7 @@ import L0node from './L0node';
 import L2Node from './L2node';
 import Papa, { ParseResult } from 'papaparse';  // Import the type definitions from PapaParse
 import { set } from 'zod';
-import {type ApiResponseItem, createSession, pollApiUntilNItems, type SessionResponse, fetchQuestionNode, fetchExaNodes, fetchQuestionNodePrompted} from "@/lib/api";
+import {type ApiResponseItem, createSession, streamHubNodes, type SessionResponse, fetchQuestionNode, fetchExaNodes, fetchQuestionNodePrompted} from "@/lib/api";
 
 const nodeTypes = {
   L0: L0node,
@@ -211,6 +211,7 @@ function generateL1NodesAndEdges(parentNode: Node, data: {
   images: {
     id: string;
     url: string;
+    thumbnail_url?: string | null;
   }[];
   questions: {
     id: string;
@@ -256,7 +257,7 @@ function generateL1NodesAndEdges(parentNode: Node, data: {
         expanded: false,
         edgePoints: edgePoints,
         questions: item.questions.map((question) => question.content),
-        images: item.images.map((image) => image.url),
+        images: item.images.map((image) => image.thumbnail_url ?? image.url),
         id: item.id
       }
     };
@@ -571,9 +572,9 @@ function FlowCanvas() {
   }
 };
 
-  // Poll API to fetch nodes and update progressively
+  // Stream nodes from the API and update progressively
   const pollHubNodes = useCallback(async (hubId: string) => {
-    const url = `http://localhost:8001/hubs/${hubId}/nodes`;
+    const url = `http://localhost:8001/hubs/${hubId}`;
 
     // Callback to handle partial data updates
     const handlePartialResult = (items: ApiResponseItem[]) => {
@@ -614,7 +615,7 @@ function FlowCanvas() {
                       title: currentItem.title,
                       text: currentItem.text,
                       questions: currentItem.questions,
-                      images: currentItem.images.map((image) => image.url),
+                      images: currentItem.images.map((image) => image.thumbnail_url ?? image.url),
                       id: currentItem.id,
                       addAdditionalNode: addAdditionalNode
                     },
@@ -638,7 +639,7 @@ function FlowCanvas() {
 
 
     try {
-      await pollApiUntilNItems(url, 5, handlePartialResult); // Pass the callback to handle partial data
+      await streamHubNodes(url, 5, handlePartialResult); // Pass the callback to handle partial data
     } catch (error) { /* empty */
     }
   }, [setNodes]);
@@ -38,7 +38,8 @@ export interface ApiResponseItem {
   title: string;
   thread_id: string;
   parent_node_id: string | null;
-  images: { id: string; url: string }[];
+  // thumbnail_url is a small preview (AVIF/WebP by Accept), url the full-size chart
+  images: { id: string; url: string; thumbnail_url?: string | null }[];
   questions: { id: string; content: string }[];
 }
 
@@ -82,6 +83,35 @@ export const pollApiUntilNItems = async (
   await poll(); // Start polling immediately
 };
 
+// Subscribe to a hub's server-sent node stream, falling back to polling if EventSource is unavailable.
+// The browser reconnects on its own and resumes from the last node id via the Last-Event-ID header.
+export const streamHubNodes = async (
+  baseUrl: string,
+  n: number,
+  onPartialResult: (data: ApiResponseItem[]) => void // callback for partial results
+): Promise<void> => {
+  if (typeof EventSource === "undefined") {
+    return pollApiUntilNItems(`${baseUrl}/nodes`, n, onPartialResult);
+  }
+
+  let currentData: ApiResponseItem[] = []; // Keep track of the data we have
+  const source = new EventSource(`${baseUrl}/stream`);
+
+  source.addEventListener("node", (event: MessageEvent<string>) => {
+    const item = JSON.parse(event.data) as ApiResponseItem;
+    if (currentData.some((existing) => existing.id === item.id)) return;
+
+    currentData = [...currentData, item];
+    onPartialResult(currentData);
+    if (currentData.length >= n) source.close();
+  });
+
+  source.addEventListener("status", (event: MessageEvent<string>) => {
+    const { status } = JSON.parse(event.data) as { status: string };
+    if (status === "complete" || status === "failed") source.close();
+  });
+};
+
 export const fetchQuestionNode = async (url: string, id: string): Promise<ApiResponseItem | null> => {
   try {
     const response = await fetch(`${url}/${id}`);